@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark of extract_first_json_dict against the previous brace-counting
+implementation, on large and malformed model outputs.
+
+Run from the repository root:
+    python benchmarks/bench_json_extraction.py
+"""
+import json
+import os
+import sys
+import timeit
+
+# The repository root, so that the package imports without being installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from genagents_simulation.simulation_engine.llm_json_parser import (
+    FirstJSONObjectScanner, extract_first_json_dict)
+
+
+def legacy_extract_first_json_dict(input_str):
+    """The brace-counting extractor that extract_first_json_dict replaced."""
+    try:
+        input_str = (input_str.replace("“", "\"")
+                              .replace("”", "\"")
+                              .replace("‘", "'")
+                              .replace("’", "'"))
+        start_index = input_str.index('{')
+        count = 1
+        end_index = start_index + 1
+        while count > 0 and end_index < len(input_str):
+            if input_str[end_index] == '{':
+                count += 1
+            elif input_str[end_index] == '}':
+                count -= 1
+            end_index += 1
+        return json.loads(input_str[start_index:end_index])
+    except ValueError:
+        return None
+
+
+def survey_response(n_questions, reasoning_words):
+    response = {}
+    for i in range(n_questions):
+        response[str(i + 1)] = {
+            "Q": f"Question {i + 1}?",
+            "Option Interpretation": {"Yes": "word " * reasoning_words, "No": "word " * reasoning_words},
+            "Reasoning": "word " * reasoning_words,
+            "Response": "Yes"}
+    return json.dumps(response, indent=2)
+
+
+def cases():
+    large = survey_response(40, 200)
+    return {
+        "small": "Here is my answer:\n" + survey_response(1, 30),
+        "large (%d KB)" % (len(large) // 1024): "```json\n" + large + "\n```",
+        "large + trailing text": large + "\n\nLet me know if you need {anything} else." * 200,
+        "brace in string": survey_response(1, 30).replace("word", "a} b", 1),
+        "curly quotes": "{“1”: {“Reasoning”: “fine”, “Response”: “Yes”}}",
+        "truncated (malformed)": large[:len(large) // 2],
+        "no JSON (malformed)": "I cannot answer that. " * 2000,
+    }
+
+
+def main():
+    print(f"{'case':<26}{'legacy':>12}{'new':>12}{'stream':>12}   legacy ok / new ok")
+    for name, text in cases().items():
+        number = max(1, 20000 // max(1, len(text) // 100))
+        legacy = timeit.timeit(lambda: legacy_extract_first_json_dict(text), number=number) / number
+        new = timeit.timeit(lambda: extract_first_json_dict(text), number=number) / number
+
+        def scan():
+            scanner = FirstJSONObjectScanner()
+            for i in range(0, len(text), 16):
+                if scanner.feed(text[i:i + 16]):
+                    break
+            return scanner.first_dict()
+        stream = timeit.timeit(scan, number=number) / number
+
+        print(f"{name:<26}{legacy * 1e6:>10.1f}us{new * 1e6:>10.1f}us{stream * 1e6:>10.1f}us"
+              f"   {legacy_extract_first_json_dict(text) is not None!s:>5} / {extract_first_json_dict(text) is not None!s}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import datetime
+import io
+
+from genagents_simulation.genagents.genagents import *
+
+
+# ############################################################################
+# ###                            JOB FOLDERS                               ###
+# ############################################################################
+
+# Batch states after which a batch's results no longer change.
+FINAL_BATCH_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+
+def get_batch_job_folder(job_id):
+  return f"{BATCH_JOB_DIR}/{job_id}"
+
+
+def read_batch_job(job_id):
+  job_file = f"{get_batch_job_folder(job_id)}/job.json"
+  if not os.path.exists(job_file):
+    raise ValueError(f"There is no batch job '{job_id}'.")
+  with open(job_file) as json_file:
+    return json.load(json_file)
+
+
+def _write_batch_job(job):
+  atomic_write_json(f"{get_batch_job_folder(job['id'])}/job.json", job,
+                    indent=2)
+
+
+# ############################################################################
+# ###                            SURVEY JOBS                               ###
+# ############################################################################
+
+def submit_survey_job(agents, questions, batch_client,
+                      model=LLM_VERS, token_budget=None, prompt_version="1",
+                      max_tokens=1500):
+  """
+  Submitting the categorical survey <questions> for every agent as one
+  batch job instead of one synchronous request per agent. Each agent's
+  prompt (the one categorical_resp would send) is rendered into the job's
+  requests.jsonl, which is uploaded to the batch endpoint. The job's state
+  is kept in BATCH_JOB_DIR/<job id>/job.json, so its results can be
+  collected later, from another process, with collect_survey_job.
+
+  Parameters:
+    agents: list of GenerativeAgent
+    questions: dictionary from question to its list of options
+    batch_client: 'openai' for OpenAI's batch endpoint, or 'synchronous'
+      to send the requests as ordinary requests (see get_batch_client)
+    model: the model of the requests
+    token_budget: token budget of the agent descriptions (None for no
+      limit)
+    prompt_version: the categorical response template version
+    max_tokens: the maximum number of completion tokens per request
+  Returns:
+    The job dictionary
+  """
+  # An unusable batch client fails before anything is written.
+  client = get_batch_client(batch_client)
+  job_id = uuid.uuid4().hex[:16]
+  job_folder = get_batch_job_folder(job_id)
+  os.makedirs(job_folder, exist_ok=True)
+
+  # Completions are mapped back to agents by their custom id, which is the
+  # agent's position in the job.
+  lines = []
+  for count, agent in enumerate(agents):
+    prompt = categorical_resp_prompt(agent, questions, token_budget,
+                                     prompt_version)
+    lines += [json.dumps(batch_request_line(str(count), prompt, model,
+                                            max_tokens)) + "\n"]
+  requests = "".join(lines).encode("utf-8")
+  with open(f"{job_folder}/requests.jsonl", "wb") as jsonl_file:
+    jsonl_file.write(requests)
+
+  job = {"id": job_id,
+         "created": datetime.datetime.now().isoformat(timespec="seconds"),
+         "status": "created",
+         "batch_client": batch_client,
+         "model": model,
+         "questions": questions,
+         "agent_ids": [str(agent.id) for agent in agents],
+         "batch_id": None}
+  _write_batch_job(job)
+
+  input_file = client.files.create(file=io.BytesIO(requests), purpose="batch")
+  batch = client.batches.create(input_file_id=input_file.id,
+                                endpoint="/v1/chat/completions",
+                                completion_window="24h")
+  job["batch_id"] = batch.id
+  job["status"] = batch.status
+  _write_batch_job(job)
+  return job
+
+
+def poll_survey_job(job_id):
+  """
+  Updating a survey job with the state of its batch. Once the batch
+  finished, its output is downloaded to the job's results.jsonl.
+
+  Returns:
+    The job dictionary
+  """
+  job = read_batch_job(job_id)
+  if job["status"] in FINAL_BATCH_STATUSES:
+    return job
+
+  client = get_batch_client(job["batch_client"])
+  batch = client.batches.retrieve(job["batch_id"])
+  if batch.status in FINAL_BATCH_STATUSES:
+    output = ""
+    for file_id in [getattr(batch, "output_file_id", None),
+                    getattr(batch, "error_file_id", None)]:
+      if file_id:
+        output += client.files.content(file_id).text.rstrip("\n") + "\n"
+    results_file = f"{get_batch_job_folder(job_id)}/results.jsonl"
+    with open(f"{results_file}.tmp", "w") as jsonl_file:
+      jsonl_file.write(output.lstrip("\n"))
+    os.replace(f"{results_file}.tmp", results_file)
+  job["status"] = batch.status
+  _write_batch_job(job)
+  return job
+
+
+def collect_survey_job(job_id, wait=False, poll_interval=30, timeout=None):
+  """
+  Collecting the agent responses of a survey job.
+
+  Parameters:
+    job_id: the id submit_survey_job returned
+    wait: if True, the batch is polled every <poll_interval> seconds until
+      it finished (or <timeout> seconds passed)
+  Returns:
+    (job, responses) where responses is None while the batch has not
+    finished, and otherwise a list aligned with the job's agents of
+    {"responses", "reasonings"} dictionaries with the answers snapped to
+    the options (None for the agents whose request failed or whose
+    response could not be validated)
+  """
+  start = time.time()
+  job = poll_survey_job(job_id)
+  while (wait and job["status"] not in FINAL_BATCH_STATUSES
+         and (timeout is None or time.time() - start < timeout)):
+    time.sleep(poll_interval)
+    job = poll_survey_job(job_id)
+  if job["status"] not in FINAL_BATCH_STATUSES:
+    return job, None
+
+  responses = [None] * len(job["agent_ids"])
+  results_file = f"{get_batch_job_folder(job_id)}/results.jsonl"
+  if os.path.exists(results_file):
+    with open(results_file) as jsonl_file:
+      for line in jsonl_file:
+        if not line.strip():
+          continue
+        line = json.loads(line)
+        content = batch_response_content(line)
+        if content is None:
+          continue
+        responses[int(line["custom_id"])] = validate_categorical_resp(
+          job["questions"], parse_categorical_resp(content))
+  return job, responses
@@ -1,7 +1,73 @@
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from genagents_simulation.genagents.modules.interaction import *
 from genagents_simulation.genagents.modules.memory_stream import *
+from genagents_simulation.genagents.modules.memory_log import *
+
+
+# ############################################################################
+# ###                         POPULATION METADATA                          ###
+# ############################################################################
+
+def read_population_meta(population_folder): 
+  """
+  Reading a population's population.json. It records population-wide 
+  settings such as the embedding model of the agents' memory streams. 
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+  Returns: 
+    The metadata dictionary, empty if the population has no population.json
+  """
+  if not check_if_file_exists(f"{population_folder}/population.json"): 
+    return dict()
+  with open(f"{population_folder}/population.json") as json_file:
+    return json.load(json_file)
+
+
+def write_population_meta(population_folder, meta): 
+  with open(f"{population_folder}/population.json", "w") as json_file:
+    json.dump(meta, json_file, indent=2)
+
+
+# ############################################################################
+# ###                             AGENT FILES                              ###
+# ############################################################################
+
+FULL_PRECISION_FILES = ["embeddings_unit.npz", "embeddings_unit.json", 
+                        "embeddings.json"]
+QUANTIZED_FILES = ["embeddings_q.npz", "embeddings_q.json"]
+MEMORY_STREAM_FILES = (["nodes.json", "ann_index.json"] 
+                       + FULL_PRECISION_FILES + QUANTIZED_FILES)
+
+
+def remove_agent_files(agent_folder, file_names): 
+  """
+  Deleting the <file_names> of an agent's memory_stream folder that exist.
+  """
+  for file_name in file_names: 
+    if check_if_file_exists(f"{agent_folder}/memory_stream/{file_name}"): 
+      os.remove(f"{agent_folder}/memory_stream/{file_name}")
+
+
+# The agents that forks saved on disk branch from, loaded once per process so
+# that all forks of an agent share its memory stream. 
+_fork_parents = dict()
+_fork_parents_lock = threading.RLock()
+
+
+def get_fork_parent(agent_folder): 
+  """
+  Returns the GenerativeAgent saved in <agent_folder>, loaded once per 
+  process. The returned agent is shared and must not be changed. 
+  """
+  agent_folder = os.path.abspath(agent_folder)
+  with _fork_parents_lock: 
+    if agent_folder not in _fork_parents: 
+      _fork_parents[agent_folder] = GenerativeAgent(agent_folder)
+    return _fork_parents[agent_folder]
 
 
 # ############################################################################
@@ -10,27 +76,117 @@ from genagents_simulation.genagents.modules.memory_stream import *
 
 class GenerativeAgent: 
   def __init__(self, agent_folder=None):
+    # The scratch version is incremented whenever the scratch is replaced or
+    # updated, and the rendered self description is cached until then. 
+    self.scratch_version = 0
+    self._self_description = None
+
     # Initialize defaults
     self.id = uuid.uuid4()
     self.scratch = {}
     self.memory_stream = MemoryStream([], {})
+
+    # What the agent folder it was loaded from or last saved to holds, so 
+    # that saving to it again only appends the changes to its memory log. 
+    self._persisted = None
+
+    # For a fork, the agent folder it branches from, the number of nodes and
+    # embedding rows it shares with it, and its matrix when it branched. 
+    self._fork = None
     if agent_folder: 
       # We stop the process if the agent storage folder already exists. 
       if not check_if_file_exists(f"{agent_folder}/scratch.json"):
         print ("Generative agent does not exist in the current location.")
         return 
       
-      # Loading the agent's memories. 
       with open(f"{agent_folder}/scratch.json") as json_file:
         scratch = json.load(json_file)
-      with open(f"{agent_folder}/memory_stream/embeddings.json") as json_file:
-        embeddings = json.load(json_file)
-      with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
-        nodes = json.load(json_file)
+
+      fork = None
+      if check_if_file_exists(f"{agent_folder}/fork.json"): 
+        # A fork only stores what it changed: its memory stream branches 
+        # from its parent agent's, and its scratch.json holds its updates 
+        # to the parent's scratch. 
+        with open(f"{agent_folder}/fork.json") as json_file:
+          fork = json.load(json_file)
+        fork["parent"] = os.path.abspath(
+          os.path.join(agent_folder, fork["parent"]))
+        parent = get_fork_parent(fork["parent"])
+        scratch = {**parent.scratch, **scratch}
+        memory_stream = parent.memory_stream.fork(fork["nodes"], fork["rows"])
+        base_nodes = fork["nodes"]
+
+      else: 
+        # Loading the agent's memories. References into a population embedding
+        # store take precedence over quantized embeddings, then come the 
+        # unit-normalized full precision embeddings, and last the original 
+        # embeddings.json format. 
+        with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
+          nodes = json.load(json_file)
+
+        # The embedding model is recorded in the agent's meta.json; older 
+        # agents fall back to their population's model, then to the default. 
+        meta = dict()
+        if check_if_file_exists(f"{agent_folder}/meta.json"): 
+          with open(f"{agent_folder}/meta.json") as json_file:
+            meta = json.load(json_file)
+        embedding_model = meta.get("embedding_model") or read_population_meta(
+          os.path.dirname(os.path.normpath(agent_folder))).get("embedding_model")
+        embedding_provider = get_embedding_provider(embedding_model)
+
+        store_folder, refs = read_embedding_refs(f"{agent_folder}/memory_stream")
+        if store_folder is not None: 
+          matrix = SharedMatrix(get_embedding_store(store_folder))
+          for key in refs.values(): 
+            matrix.append_key(key)
+          memory_stream = MemoryStream(nodes, list(refs.keys()), matrix, 
+                                       embedding_provider)
+        elif (check_if_file_exists(f"{agent_folder}/memory_stream/embeddings_q.npz")
+              or check_if_file_exists(f"{agent_folder}/memory_stream/embeddings_unit.npz")):
+          file_name = ("embeddings_q" if check_if_file_exists(
+            f"{agent_folder}/memory_stream/embeddings_q.npz") 
+            else "embeddings_unit")
+          with open(f"{agent_folder}/memory_stream/{file_name}.json") as json_file:
+            contents = json.load(json_file)
+          with np.load(f"{agent_folder}/memory_stream/{file_name}.npz") as arrays:
+            matrix = load_matrix(arrays)
+          memory_stream = MemoryStream(nodes, contents, matrix, 
+                                       embedding_provider)
+        else: 
+          with open(f"{agent_folder}/memory_stream/embeddings.json") as json_file:
+            embeddings = json.load(json_file)
+          memory_stream = MemoryStream(nodes, embeddings, None, 
+                                       embedding_provider)
+        base_nodes = len(nodes)
 
       self.id = uuid.uuid4()
       self.scratch = scratch
-      self.memory_stream = MemoryStream(nodes, embeddings)
+      self.memory_stream = memory_stream
+
+      # Loading the approximate nearest neighbor index if the agent has one.
+      # An index saved for a different node count or embedding layout than 
+      # the memory stream files is stale; only its settings are kept, and it
+      # is rebuilt at its first use. 
+      if (fork is None and check_if_file_exists(
+            f"{agent_folder}/memory_stream/ann_index.json")):
+        with open(f"{agent_folder}/memory_stream/ann_index.json") as json_file:
+          index_package = json.load(json_file)
+        index = IVFIndex.from_package(index_package)
+        if (index_package.get("nodes") != base_nodes 
+            or index_package.get("rows") != len(memory_stream.matrix)): 
+          index.reset()
+        self.memory_stream.attach_index(index)
+
+      # Replaying the memory log of the saves since the memory stream files
+      # were last written in full, or since the fork branched. 
+      log_entries, log_bytes, vector_bytes = read_committed_log(
+        f"{agent_folder}/memory_stream")
+      for entry, vectors in log_entries: 
+        self.memory_stream.extend(entry["nodes"], entry["contents"], vectors, 
+                                  entry["last_retrieved"])
+      self._set_persisted(agent_folder, base_nodes, (log_bytes, vector_bytes))
+      if fork is not None: 
+        self._fork = {**fork, "matrix": self.memory_stream.matrix}
 
     else: 
       self.id = uuid.uuid4()
@@ -38,8 +194,22 @@ class GenerativeAgent:
       self.memory_stream = MemoryStream([], {})
 
 
+  @property
+  def scratch(self): 
+    return self._scratch
+
+
+  @scratch.setter
+  def scratch(self, scratch): 
+    self._scratch = scratch
+    self.scratch_version += 1
+    self._self_description = None
+
+
   def update_scratch(self, update): 
     self.scratch.update(update)
+    self.scratch_version += 1
+    self._self_description = None
       
 
   def package(self): 
@@ -51,10 +221,11 @@ class GenerativeAgent:
     Returns: 
       packaged dictionary
     """
-    return {"id": str(self.id)}
+    return {"id": str(self.id), 
+            "embedding_model": self.memory_stream.embedding_provider.name}
 
 
-  def save(self, save_directory): 
+  def save(self, save_directory, compact=False): 
     """
     Given a save_code, save the agents' state in the storage. Right now, the 
     save directory works as follows: 
@@ -64,8 +235,17 @@ class GenerativeAgent:
     a different save code location. Remember that 'init' is the originally
     initialized agent directory.
 
+    Saving to the folder the agent was loaded from or last saved to only 
+    appends the nodes and embeddings added since then (and changed 
+    last_retrieved values) to the memory log, memory_stream/log.jsonl and 
+    log_vectors.f64. The log is compacted into full memory stream files 
+    when it holds more nodes than they do, when <compact> is True, or when 
+    the embeddings are not in full precision. Files are replaced 
+    atomically, so an interrupted save leaves the previous state loadable.
+
     Parameters:
       save_code: str
+      compact: if True, the memory stream files are always written in full
     Returns: 
       None
     """
@@ -74,21 +254,217 @@ class GenerativeAgent:
     create_folder_if_not_there(f"{storage}/memory_stream")
     
     # Saving the agent's memory stream. This includes saving the embeddings 
-    # as well as the nodes. 
-    with open(f"{storage}/memory_stream/embeddings.json", "w") as json_file:
-      json.dump(self.memory_stream.embeddings, 
-                json_file)
-    with open(f"{storage}/memory_stream/nodes.json", "w") as json_file:
-      json.dump([node.package() for node in self.memory_stream.seq_nodes], 
-                json_file, indent=2)
+    # as well as the nodes. A fork saves its changes as a fork folder, and 
+    # its scratch updates instead of its scratch. 
+    if not compact and self._can_save_as_fork(storage): 
+      scratch = self._save_fork(storage)
+    else: 
+      if compact or not self._can_append_log(storage): 
+        self._save_memory_stream(storage)
+      else: 
+        self._append_memory_log(storage)
+      # A detached index is not loaded again. 
+      if (self.memory_stream.index is None and check_if_file_exists(
+            f"{storage}/memory_stream/ann_index.json")): 
+        os.remove(f"{storage}/memory_stream/ann_index.json")
+      scratch = self.scratch
 
     # Saving the agent's scratch memories. 
-    with open(f"{storage}/scratch.json", "w") as json_file:
-      json.dump(self.scratch, json_file, indent=2)
+    atomic_write_json(f"{storage}/scratch.json", scratch, indent=2)
 
     # Saving the agent's meta information. 
-    with open(f"{storage}/meta.json", "w") as json_file:
-      json.dump(self.package(), json_file, indent=2)
+    atomic_write_json(f"{storage}/meta.json", self.package(), indent=2)
+
+    # Forks loaded from this folder from now on branch from the saved state.
+    with _fork_parents_lock: 
+      _fork_parents.pop(os.path.abspath(storage), None)
+
+
+  def fork(self): 
+    """
+    Creating a copy-on-write branch of the agent, e.g. for a counterfactual
+    simulation. The branch shares the agent's memory embeddings and persona
+    and only keeps its own new memories and scratch updates. If the agent 
+    was loaded from or saved to a folder and has not changed since, saving 
+    the branch writes a fork folder that only holds those changes and 
+    references that folder (which must then be kept as it is); otherwise 
+    the branch is saved as a full agent. 
+
+    Parameters:
+      None
+    Returns: 
+      GenerativeAgent
+    """
+    branch = GenerativeAgent()
+    branch.scratch = dict(self.scratch)
+    branch.memory_stream = self.memory_stream.fork()
+
+    parent_folder = None
+    if self._persisted is not None and not self._has_unsaved_changes(): 
+      parent_folder = self._persisted["folder"]
+    branch._fork = {"parent": parent_folder, 
+                    "nodes": branch.memory_stream.count_nodes(), 
+                    "rows": len(branch.memory_stream.matrix), 
+                    "matrix": branch.memory_stream.matrix}
+    return branch
+
+
+  def _has_unsaved_changes(self): 
+    persisted = self._persisted
+    return (persisted["matrix"] is not self.memory_stream.matrix
+            or persisted["nodes"] != self.memory_stream.count_nodes()
+            or bool(self.memory_stream._retrieved_rows))
+
+
+  def _can_save_as_fork(self, storage): 
+    fork = self._fork
+    if (fork is None or fork["parent"] is None 
+        or fork["parent"] == os.path.abspath(storage)
+        or fork["matrix"] is not self.memory_stream.matrix): 
+      return False
+    parent = get_fork_parent(fork["parent"])
+    return (parent.memory_stream.count_nodes() >= fork["nodes"]
+            and len(parent.memory_stream.matrix) >= fork["rows"])
+
+
+  def _save_fork(self, storage): 
+    """
+    Saving a fork as its parent folder reference (fork.json) and the memory
+    log of its changes. 
+
+    Parameters:
+      storage: the agent folder
+    Returns: 
+      The scratch updates to save
+    """
+    fork = self._fork
+    parent = get_fork_parent(fork["parent"])
+    if (self._persisted is None 
+        or self._persisted["folder"] != os.path.abspath(storage)): 
+      # Starting a new fork folder: its log holds every change since the 
+      # fork branched, including the changed last_retrieved values of the 
+      # nodes it shares with the parent. 
+      memory_stream_folder = f"{storage}/memory_stream"
+      release_embedding_refs(memory_stream_folder)
+      remove_agent_files(storage, MEMORY_STREAM_FILES)
+      remove_memory_log(memory_stream_folder)
+      atomic_write_json(f"{storage}/fork.json", 
+                        {"parent": os.path.relpath(fork["parent"], storage), 
+                         "nodes": fork["nodes"], 
+                         "rows": fork["rows"]}, indent=2)
+
+      changed = np.flatnonzero(
+        self.memory_stream._last_retrieved[:fork["nodes"]] 
+        != parent.memory_stream._last_retrieved[:fork["nodes"]])
+      self.memory_stream._retrieved_rows.update(changed.tolist())
+      self._persisted = {"folder": os.path.abspath(storage), 
+                         "matrix": self.memory_stream.matrix, 
+                         "rows": fork["rows"], 
+                         "nodes": fork["nodes"], 
+                         "base_nodes": fork["nodes"], 
+                         "committed": (0, 0)}
+    self._append_memory_log(storage)
+
+    return {key: value for key, value in self.scratch.items() 
+            if key not in parent.scratch or parent.scratch[key] != value}
+
+
+  def _set_persisted(self, agent_folder, base_nodes, committed): 
+    self._persisted = {"folder": os.path.abspath(agent_folder), 
+                       "matrix": self.memory_stream.matrix, 
+                       "rows": len(self.memory_stream.matrix), 
+                       "nodes": self.memory_stream.count_nodes(), 
+                       "base_nodes": base_nodes, 
+                       "committed": committed}
+
+
+  def _can_append_log(self, storage): 
+    persisted = self._persisted
+    if (persisted is None 
+        or persisted["folder"] != os.path.abspath(storage)
+        or persisted["matrix"] is not self.memory_stream.matrix
+        or self.memory_stream.matrix.kind != "float"): 
+      return False
+    log_nodes = self.memory_stream.count_nodes() - persisted["base_nodes"]
+    return log_nodes <= max(LOG_COMPACTION_MIN_NODES, persisted["base_nodes"])
+
+
+  def _save_memory_stream(self, storage): 
+    """
+    Writing the memory stream files in full and dropping the memory log. 
+    The embeddings are written before the nodes that reference them, and 
+    replaying a log that outlived a crash here skips what the files hold. 
+    """
+    memory_stream_folder = f"{storage}/memory_stream"
+    self._save_embeddings(memory_stream_folder)
+    atomic_write_json(f"{memory_stream_folder}/nodes.json", 
+                      self.memory_stream.package_nodes(), indent=2)
+    if self.memory_stream.index is not None: 
+      # The node count and embedding rows the index was saved for. 
+      atomic_write_json(f"{memory_stream_folder}/ann_index.json", 
+                        {**self.memory_stream.index.package(), 
+                         "nodes": self.memory_stream.count_nodes(), 
+                         "rows": len(self.memory_stream.matrix)})
+    remove_memory_log(memory_stream_folder)
+    if check_if_file_exists(f"{storage}/fork.json"): 
+      os.remove(f"{storage}/fork.json")
+    self._fork = None
+    self.memory_stream.pop_retrieved_updates(0)
+    self._set_persisted(storage, self.memory_stream.count_nodes(), (0, 0))
+
+
+  def _append_memory_log(self, storage): 
+    """
+    Appending the memory stream's changes since it was last persisted to 
+    <storage> to the memory log. 
+    """
+    persisted = self._persisted
+    stream = self.memory_stream
+    nodes = stream.package_nodes(persisted["nodes"])
+    last_retrieved = stream.pop_retrieved_updates(persisted["nodes"])
+    rows = range(persisted["rows"], len(stream.matrix))
+    if not nodes and not last_retrieved and not rows: 
+      return
+    contents = stream.get_contents_by_row()[persisted["rows"]:]
+    vectors = np.array([stream.matrix.get(row) for row in rows])
+    committed = append_memory_log(f"{storage}/memory_stream", nodes, contents,
+                                  vectors, last_retrieved, 
+                                  persisted["committed"])
+    self._set_persisted(storage, persisted["base_nodes"], committed)
+
+
+  def _save_embeddings(self, memory_stream_folder): 
+    """
+    Saving the memory stream's embeddings in the format of its matrix: 
+    references into a population embedding store (embedding_refs.json), 
+    quantized codes (embeddings_q.npz with the contents of their rows in 
+    embeddings_q.json), or unit-normalized full precision vectors and their
+    norms (embeddings_unit.npz and embeddings_unit.json). Files of a format 
+    that would be loaded in preference to the saved one are removed. 
+
+    Parameters:
+      memory_stream_folder: the agent's memory_stream folder 
+    Returns: 
+      None
+    """
+    matrix = self.memory_stream.matrix
+    if matrix.kind == "shared": 
+      write_embedding_refs(memory_stream_folder, matrix.store, 
+                           self.memory_stream.get_embedding_refs())
+      return
+    if matrix.kind == "fork": 
+      matrix = matrix.materialize()
+
+    release_embedding_refs(memory_stream_folder)
+    file_name = "embeddings_unit" if matrix.kind == "float" else "embeddings_q"
+    atomic_savez(f"{memory_stream_folder}/{file_name}.npz", 
+                 package_matrix(matrix))
+    atomic_write_json(f"{memory_stream_folder}/{file_name}.json", 
+                      self.memory_stream.get_contents_by_row())
+    if matrix.kind == "float": 
+      for file_name in ["embeddings_q.npz", "embeddings_q.json"]: 
+        if check_if_file_exists(f"{memory_stream_folder}/{file_name}"): 
+          os.remove(f"{memory_stream_folder}/{file_name}")
 
 
   def get_fullname(self): 
@@ -98,7 +474,9 @@ class GenerativeAgent:
       return ""
 
   def get_self_description(self): 
-    return str(self.scratch)
+    if self._self_description is None: 
+      self._self_description = str(self.scratch)
+    return self._self_description
 
   def remember(self, content, time_step=0): 
     """
@@ -120,23 +498,74 @@ class GenerativeAgent:
     Parameters:
       anchor: str reflection anchor
     Returns: 
-      None
+      The list of str reflections that were added
     """
-    self.memory_stream.reflect(anchor, time_step)
+    return self.memory_stream.reflect(anchor, time_step=time_step)
 
 
-  def categorical_resp(self, questions): 
-    ret = categorical_resp(self, questions)
+  def categorical_resp(self, questions, token_budget=None, 
+                       prompt_version="1", stream=False, structured=False): 
+    ret = categorical_resp(self, questions, token_budget, prompt_version, 
+                           stream, structured)
     return ret
     
 
-  def numerical_resp(self, questions, float_resp=False): 
-    ret = numerical_resp(self, questions, float_resp)
+  def categorical_resp_samples(self, questions, n, token_budget=None, 
+                               prompt_version="1", stream=False, 
+                               structured=False, retries=0): 
+    ret = categorical_resp_samples(self, questions, n, token_budget, 
+                                   prompt_version, stream, structured, 
+                                   retries)
     return ret
 
 
-  def utterance(self, curr_dialogue, context=""): 
-    ret = utterance(self, curr_dialogue, context)
+  def numerical_resp(self, questions, float_resp=False, token_budget=None, 
+                     prompt_version="1", stream=False, structured=False): 
+    ret = numerical_resp(self, questions, float_resp, token_budget, 
+                         prompt_version, stream, structured)
+    return ret
+
+
+  def ask(self, questions, token_budget=None, prompt_version="1", 
+          stream=False): 
+    ret = ask(self, questions, token_budget, prompt_version, stream)
+    return ret
+
+
+  def utterance(self, curr_dialogue, context="", token_budget=None): 
+    ret = utterance(self, curr_dialogue, context, token_budget)
     return ret 
 
 
+# ############################################################################
+# ###                        POPULATION-LEVEL HELPERS                      ###
+# ############################################################################
+
+def reflect_all(agents, anchor, time_step=0, max_workers=MAX_WORKERS): 
+  """
+  Run reflection on the same anchor for many agents concurrently. Each 
+  agent's reflection is independent of the others, so the LLM and embedding 
+  requests are issued from a thread pool instead of one agent at a time. 
+
+  Parameters:
+    agents: list of GenerativeAgent
+    anchor: str reflection anchor
+    time_step: Current time_step 
+    max_workers: the maximum number of agents reflecting at the same time
+  Returns: 
+    A list with the str reflections added for each agent, in the same order 
+    as <agents>. Agents whose reflection failed get None. 
+  """
+  def _reflect(agent): 
+    try: 
+      return agent.reflect(anchor, time_step)
+    except Exception as e: 
+      print (f"Reflection failed for agent {agent.id}: {str(e)}")
+      return None
+
+  if not agents: 
+    return []
+  with ThreadPoolExecutor(max_workers=max_workers) as executor: 
+    return list(executor.map(in_current_run(_reflect), agents))
+
+
@@ -0,0 +1,277 @@
+import math
+
+import numpy as np
+from numpy.linalg import norm
+
+
+# ##############################################################################
+# ###                          HELPER FUNCTIONS                              ###
+# ##############################################################################
+
+def normalize_rows(matrix):
+  """
+  Scales every row of <matrix> to unit length. Rows of all zeros are left as
+  they are.
+
+  Parameters:
+    matrix: 2-D numpy array
+  Returns:
+    A new 2-D numpy array with unit-length rows.
+  """
+  norms = norm(matrix, axis=1, keepdims=True)
+  norms[norms == 0] = 1
+  return matrix / norms
+
+
+def spherical_kmeans(vectors, n_clusters, n_iter=10, seed=0):
+  """
+  Clusters unit-length <vectors> by cosine similarity with Lloyd's
+  algorithm.
+
+  Parameters:
+    vectors: 2-D numpy array of unit-length rows
+    n_clusters: the number of clusters
+    n_iter: the number of Lloyd iterations
+    seed: random seed for the initial centroids
+  Returns:
+    centroids: 2-D numpy array of unit-length centroids
+  """
+  rng = np.random.RandomState(seed)
+  init = rng.choice(len(vectors), n_clusters, replace=False)
+  centroids = vectors[init].copy()
+
+  for _ in range(n_iter):
+    assignments = np.argmax(vectors @ centroids.T, axis=1)
+    for cluster in range(n_clusters):
+      members = vectors[assignments == cluster]
+      if len(members) == 0:
+        # Re-seeding empty clusters with a random vector.
+        centroids[cluster] = vectors[rng.randint(len(vectors))]
+      else:
+        centroids[cluster] = members.sum(axis=0)
+    centroids = normalize_rows(centroids)
+
+  return centroids
+
+
+# ##############################################################################
+# ###                               IVF INDEX                                ###
+# ##############################################################################
+
+class IVFIndex:
+  """
+  An inverted-file approximate nearest neighbor index over the rows of a
+  memory stream's embedding matrix. The rows are clustered by cosine
+  similarity; a query only looks at the rows in its <n_probe> closest
+  clusters. <n_probe> is calibrated at build time to reach <recall_target>
+  on sample queries from the stored vectors.
+  """
+  def __init__(self, recall_target=0.95, min_size=2048, n_lists=None,
+               calibration_k=120, seed=0):
+    # Below <min_size> candidate rows, retrieval stays exact.
+    self.recall_target = recall_target
+    self.min_size = min_size
+    self.n_lists = n_lists
+    self.calibration_k = calibration_k
+    self.seed = seed
+
+    self.n_probe = None
+    self.centroids = None
+    self.assignments = np.zeros(0, dtype=np.int64)
+    self.lists = []
+    self.built_size = 0
+
+
+  @property
+  def assignments(self):
+    """
+    The cluster of every row. Rows are stored in a buffer whose capacity
+    doubles when it is full, so adding a row is amortized O(1).
+    """
+    return self._assignments[:self._size]
+
+
+  @assignments.setter
+  def assignments(self, assignments):
+    self._assignments = np.asarray(assignments, dtype=np.int64)
+    self._size = len(self._assignments)
+
+
+  def __len__(self):
+    return self._size
+
+
+  def reset(self):
+    """
+    Dropping the clusters so that the index is rebuilt before its next use.
+    """
+    self.n_probe = None
+    self.centroids = None
+    self.assignments = np.zeros(0, dtype=np.int64)
+    self.lists = []
+    self.built_size = 0
+
+
+  def build(self, matrix):
+    """
+    Clustering the rows of <matrix> and calibrating <n_probe>.
+
+    Parameters:
+      matrix: 2-D numpy array whose rows are the stored embeddings
+    Returns:
+      None
+    """
+    vectors = normalize_rows(matrix)
+    n_lists = self.n_lists or max(1, int(math.sqrt(len(vectors))))
+    n_lists = min(n_lists, len(vectors))
+
+    if n_lists == 0:
+      self.centroids = None
+    else:
+      self.centroids = spherical_kmeans(vectors, n_lists, seed=self.seed)
+    self._assign_all(vectors)
+    self.built_size = len(vectors)
+    self.n_probe = self.calibrate(vectors)
+
+
+  def _assign_all(self, vectors):
+    if self.centroids is None:
+      self.assignments = np.zeros(0, dtype=np.int64)
+      self.lists = []
+      return
+    self.assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+    self.lists = [list(np.flatnonzero(self.assignments == cluster))
+                  for cluster in range(len(self.centroids))]
+
+
+  def calibrate(self, vectors, n_queries=256):
+    """
+    Finding the smallest number of probed clusters whose candidates contain
+    at least <recall_target> of the exact top-k neighbors. Stored vectors
+    are used as sample queries, each left out of its own neighbors, as a
+    new query is not one of them. The sampled recall is an estimate, so it
+    has to reach the target by two standard errors.
+
+    Parameters:
+      vectors: 2-D numpy array of the unit-length stored embeddings
+      n_queries: the number of sample queries
+    Returns:
+      n_probe: int
+    """
+    if self.centroids is None:
+      return 0
+    n_lists = len(self.centroids)
+    k = min(self.calibration_k, len(vectors) - 1)
+    if k < 1:
+      return n_lists
+    rng = np.random.RandomState(self.seed)
+    query_rows = rng.choice(len(vectors), min(n_queries, len(vectors)),
+                            replace=False)
+
+    # hits[i, j]: the neighbors of query i in its (j+1)-th probed cluster.
+    hits = np.zeros((len(query_rows), n_lists))
+    for count, query_row in enumerate(query_rows):
+      query = vectors[query_row]
+      similarities = vectors @ query
+      similarities[query_row] = -np.inf
+      neighbors = np.argpartition(-similarities, k - 1)[:k]
+      # Position of every cluster in this query's probing order.
+      probe_rank = np.empty(n_lists, dtype=np.int64)
+      probe_rank[np.argsort(-(self.centroids @ query))] = np.arange(n_lists)
+      hits[count] = np.bincount(probe_rank[self.assignments[neighbors]],
+                                minlength=n_lists)
+
+    recall = np.cumsum(hits, axis=1) / k
+    lower_bound = (recall.mean(axis=0)
+                   - 2 * recall.std(axis=0) / np.sqrt(len(query_rows)))
+    reached = np.flatnonzero(lower_bound >= self.recall_target)
+    return int(reached[0] + 1) if len(reached) else n_lists
+
+
+  def add(self, row, embedding):
+    """
+    Adding the embedding matrix row <row> to its closest cluster. Rows have
+    to be added in order.
+
+    Parameters:
+      row: int row index in the embedding matrix
+      embedding: list of floats
+    Returns:
+      None
+    """
+    if self.centroids is None:
+      return
+    vector = np.asarray(embedding, dtype=float)
+    cluster = int(np.argmax(self.centroids @ vector))
+    if self._size == len(self._assignments):
+      grown = np.zeros(max(16, 2 * self._size), dtype=np.int64)
+      grown[:self._size] = self._assignments[:self._size]
+      self._assignments = grown
+    self._assignments[self._size] = cluster
+    self._size += 1
+    self.lists[cluster] += [row]
+
+
+  def needs_rebuild(self):
+    """
+    Clusters are fixed at build time, so the index is rebuilt once the
+    number of rows has doubled since then.
+    """
+    return self.centroids is None or len(self) > 2 * self.built_size
+
+
+  def search(self, query):
+    """
+    Returning the candidate rows for <query>.
+
+    Parameters:
+      query: 1-D numpy array
+    Returns:
+      1-D numpy array of embedding matrix rows
+    """
+    if self.centroids is None:
+      return np.zeros(0, dtype=np.int64)
+    probed = np.argsort(-(self.centroids @ query))[:self.n_probe]
+    rows = [row for cluster in probed for row in self.lists[cluster]]
+    return np.asarray(rows, dtype=np.int64)
+
+
+  def package(self):
+    """
+    Packaging the index for saving.
+
+    Parameters:
+      None
+    Returns:
+      packaged dictionary
+    """
+    curr_package = {}
+    curr_package["recall_target"] = self.recall_target
+    curr_package["min_size"] = self.min_size
+    curr_package["n_lists"] = self.n_lists
+    curr_package["calibration_k"] = self.calibration_k
+    curr_package["seed"] = self.seed
+    curr_package["n_probe"] = self.n_probe
+    curr_package["built_size"] = self.built_size
+    if self.centroids is None:
+      curr_package["centroids"] = None
+    else:
+      curr_package["centroids"] = self.centroids.tolist()
+    curr_package["assignments"] = self.assignments.tolist()
+    return curr_package
+
+
+  @classmethod
+  def from_package(cls, curr_package):
+    index = cls(curr_package["recall_target"], curr_package["min_size"],
+                curr_package["n_lists"], curr_package["calibration_k"],
+                curr_package["seed"])
+    index.n_probe = curr_package["n_probe"]
+    index.built_size = curr_package["built_size"]
+    if curr_package["centroids"] is not None:
+      index.centroids = np.asarray(curr_package["centroids"], dtype=float)
+      index.assignments = np.asarray(curr_package["assignments"],
+                                     dtype=np.int64)
+      index.lists = [list(np.flatnonzero(index.assignments == cluster))
+                     for cluster in range(len(index.centroids))]
+    return index
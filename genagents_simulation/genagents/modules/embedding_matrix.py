@@ -0,0 +1,507 @@
+import numpy as np
+from numpy.linalg import norm
+
+from genagents_simulation.genagents.modules.ann_index import spherical_kmeans
+
+
+# ##############################################################################
+# ###                          HELPER FUNCTIONS                              ###
+# ##############################################################################
+
+# Rows are scored in blocks so that decompressing the codes of a large stream
+# never materializes the whole float matrix at once.
+SCORE_BLOCK_SIZE = 4096
+
+
+def _grow(array, capacity):
+  """
+  Returns a copy of <array> whose first axis is extended to <capacity>.
+  """
+  grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+  grown[:len(array)] = array
+  return grown
+
+
+def _safe_divide(numerator, denominator):
+  denominator = np.where(denominator == 0, 1, denominator)
+  return numerator / denominator
+
+
+def _pick_n_subvectors(dim, subvector_dim=16):
+  """
+  Returns the number of product quantization subvectors for <dim>: the
+  largest divisor of <dim> whose subvectors are at least <subvector_dim>
+  wide.
+  """
+  for n_subvectors in range(max(1, dim // subvector_dim), 0, -1):
+    if dim % n_subvectors == 0:
+      return n_subvectors
+  return 1
+
+
+# ##############################################################################
+# ###                              DENSE MATRIX                              ###
+# ##############################################################################
+
+class DenseMatrix:
+  """
+  Full precision embedding matrix. Rows are stored unit-normalized next to
+  their original norms, so cosine similarity against a query is a single
+  matrix-vector product and the original vectors can still be recovered.
+  """
+  kind = "float"
+
+  def __init__(self, dim=None):
+    self.dim = dim
+    self.size = 0
+    self.data = np.zeros((0, dim or 0))
+    self.norms = np.zeros(0)
+
+
+  @classmethod
+  def from_unit(cls, data, norms):
+    """
+    Creating a matrix from already unit-normalized rows and their norms.
+    """
+    matrix = cls(data.shape[1])
+    matrix.data = np.asarray(data, dtype=float)
+    matrix.norms = np.asarray(norms, dtype=float)
+    matrix.size = len(matrix.data)
+    return matrix
+
+
+  def __len__(self):
+    return self.size
+
+
+  def append(self, vector):
+    """
+    Appending <vector> as a new row.
+
+    Parameters:
+      vector: list of floats
+    Returns:
+      The row index of the vector
+    """
+    if self.size == len(self.data):
+      if self.size == 0:
+        self.dim = len(vector)
+        self.data = np.zeros((16, self.dim))
+        self.norms = np.zeros(16)
+      else:
+        self.data = _grow(self.data, 2 * len(self.data))
+        self.norms = _grow(self.norms, 2 * len(self.norms))
+    row = self.size
+    vector = np.asarray(vector, dtype=float)
+    length = norm(vector)
+    self.data[row] = vector / length if length else vector
+    self.norms[row] = length
+    self.size += 1
+    return row
+
+
+  def get(self, row):
+    return self.data[row] * self.norms[row]
+
+
+  def get_unit(self):
+    return self.data[:self.size]
+
+
+  def to_dense(self):
+    return self.data[:self.size] * self.norms[:self.size, None]
+
+
+  def cosine(self, rows, query):
+    """
+    Cosine similarity between <query> and each of <rows>.
+
+    Parameters:
+      rows: 1-D numpy array of row indices
+      query: 1-D numpy array
+    Returns:
+      1-D numpy array of floats aligned with <rows>
+    """
+    length = norm(query)
+    if length == 0:
+      return np.zeros(len(rows))
+    # Scoring the whole matrix avoids copying the rows out when most of
+    # them are needed anyway.
+    if 2 * len(rows) >= self.size:
+      return (self.data[:self.size] @ query)[rows] / length
+    return (self.data[rows] @ query) / length
+
+
+  def nbytes(self):
+    return self.data[:self.size].nbytes + self.norms[:self.size].nbytes
+
+
+# ##############################################################################
+# ###                              INT8 MATRIX                               ###
+# ##############################################################################
+
+class Int8Matrix:
+  """
+  Per-vector scaled int8 embedding matrix. Each row is stored as int8 codes
+  and one float scale, so that row ~= codes * scale. The row norms are kept
+  so cosine similarity is computed from the codes without decompressing.
+  """
+  kind = "int8"
+
+  def __init__(self, dim=None):
+    self.dim = dim
+    self.size = 0
+    self.codes = np.zeros((0, dim or 0), dtype=np.int8)
+    self.scales = np.zeros(0, dtype=np.float32)
+    self.norms = np.zeros(0, dtype=np.float32)
+
+
+  def __len__(self):
+    return self.size
+
+
+  def append(self, vector):
+    vector = np.asarray(vector, dtype=float)
+    if self.size == len(self.codes):
+      if self.size == 0:
+        self.dim = len(vector)
+        self.codes = np.zeros((16, self.dim), dtype=np.int8)
+        self.scales = np.zeros(16, dtype=np.float32)
+        self.norms = np.zeros(16, dtype=np.float32)
+      else:
+        self.codes = _grow(self.codes, 2 * len(self.codes))
+        self.scales = _grow(self.scales, 2 * len(self.scales))
+        self.norms = _grow(self.norms, 2 * len(self.norms))
+
+    row = self.size
+    scale = np.abs(vector).max() / 127 or 1
+    self.codes[row] = np.round(vector / scale)
+    self.scales[row] = scale
+    self.norms[row] = norm(self.codes[row].astype(np.float32)) * scale
+    self.size += 1
+    return row
+
+
+  def get(self, row):
+    return self.codes[row].astype(float) * self.scales[row]
+
+
+  def to_dense(self):
+    return self.codes[:self.size].astype(float) * self.scales[:self.size, None]
+
+
+  def cosine(self, rows, query):
+    query = np.asarray(query, dtype=np.float32)
+    out = np.zeros(len(rows))
+    for start in range(0, len(rows), SCORE_BLOCK_SIZE):
+      block = rows[start:start + SCORE_BLOCK_SIZE]
+      dots = (self.codes[block] @ query) * self.scales[block]
+      out[start:start + SCORE_BLOCK_SIZE] = _safe_divide(
+        dots, self.norms[block] * norm(query))
+    return out
+
+
+  def nbytes(self):
+    return (self.codes[:self.size].nbytes + self.scales[:self.size].nbytes
+            + self.norms[:self.size].nbytes)
+
+
+# ##############################################################################
+# ###                        PRODUCT QUANTIZED MATRIX                        ###
+# ##############################################################################
+
+class PQMatrix:
+  """
+  Product quantized embedding matrix. Every vector is split into
+  <n_subvectors> subvectors, and each subvector is stored as the uint8 id of
+  its closest centroid in that subspace's codebook. Queries are scored with
+  a per-query lookup table (asymmetric distance computation), so rows are
+  never decompressed.
+  """
+  kind = "pq"
+
+  def __init__(self, codebooks):
+    # <codebooks> has the shape (n_subvectors, n_centroids, subvector_dim).
+    self.codebooks = np.asarray(codebooks, dtype=np.float32)
+    self.n_subvectors, self.n_centroids, self.subvector_dim = (
+      self.codebooks.shape)
+    self.dim = self.n_subvectors * self.subvector_dim
+    self.size = 0
+    self.codes = np.zeros((0, self.n_subvectors), dtype=np.uint8)
+    self.norms = np.zeros(0, dtype=np.float32)
+
+
+  @classmethod
+  def train(cls, matrix, n_subvectors=None, n_centroids=256, seed=0):
+    """
+    Training the codebooks on the rows of <matrix>.
+
+    Parameters:
+      matrix: 2-D numpy array of training vectors
+      n_subvectors: the number of subspaces (must divide the dimension)
+      n_centroids: the codebook size of each subspace, at most 256
+    Returns:
+      An empty PQMatrix with the trained codebooks
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    dim = matrix.shape[1]
+    n_subvectors = n_subvectors or _pick_n_subvectors(dim)
+    if dim % n_subvectors != 0:
+      raise ValueError(f"n_subvectors ({n_subvectors}) must divide the "
+                       f"embedding dimension ({dim}).")
+    n_centroids = min(n_centroids, 256, len(matrix))
+
+    subvectors = matrix.reshape(len(matrix), n_subvectors, -1)
+    codebooks = []
+    for m in range(n_subvectors):
+      codebooks += [_kmeans(subvectors[:, m], n_centroids, seed)]
+    return cls(np.stack(codebooks))
+
+
+  def __len__(self):
+    return self.size
+
+
+  def _encode(self, vector):
+    subvectors = np.asarray(vector, dtype=np.float32).reshape(
+      self.n_subvectors, 1, -1)
+    distances = ((self.codebooks - subvectors) ** 2).sum(axis=2)
+    return np.argmin(distances, axis=1).astype(np.uint8)
+
+
+  def append(self, vector):
+    if self.size == len(self.codes):
+      capacity = max(16, 2 * len(self.codes))
+      self.codes = _grow(self.codes, capacity)
+      self.norms = _grow(self.norms, capacity)
+
+    row = self.size
+    self.codes[row] = self._encode(vector)
+    self.norms[row] = norm(self.get(row))
+    self.size += 1
+    return row
+
+
+  def get(self, row):
+    return self.codebooks[np.arange(self.n_subvectors),
+                          self.codes[row]].reshape(-1).astype(float)
+
+
+  def to_dense(self):
+    codes = self.codes[:self.size]
+    return self.codebooks[np.arange(self.n_subvectors),
+                          codes].reshape(self.size, -1).astype(float)
+
+
+  def cosine(self, rows, query):
+    query = np.asarray(query, dtype=np.float32)
+    # lookup[m, c] is the dot product of the query's m-th subvector with
+    # centroid c of the m-th codebook.
+    lookup = np.einsum("mcd,md->mc", self.codebooks,
+                       query.reshape(self.n_subvectors, -1))
+    out = np.zeros(len(rows))
+    for start in range(0, len(rows), SCORE_BLOCK_SIZE):
+      block = rows[start:start + SCORE_BLOCK_SIZE]
+      dots = lookup[np.arange(self.n_subvectors), self.codes[block]].sum(axis=1)
+      out[start:start + SCORE_BLOCK_SIZE] = _safe_divide(
+        dots, self.norms[block] * norm(query))
+    return out
+
+
+  def nbytes(self):
+    return (self.codes[:self.size].nbytes + self.norms[:self.size].nbytes
+            + self.codebooks.nbytes)
+
+
+def _kmeans(vectors, n_clusters, seed=0, n_iter=10):
+  """
+  Euclidean k-means for the product quantization codebooks.
+  """
+  rng = np.random.RandomState(seed)
+  centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+  for _ in range(n_iter):
+    distances = ((vectors ** 2).sum(axis=1)[:, None]
+                 - 2 * vectors @ centroids.T
+                 + (centroids ** 2).sum(axis=1)[None, :])
+    assignments = np.argmin(distances, axis=1)
+    for cluster in range(n_clusters):
+      members = vectors[assignments == cluster]
+      if len(members):
+        centroids[cluster] = members.mean(axis=0)
+  return centroids
+
+
+# ##############################################################################
+# ###                             FORKED MATRIX                              ###
+# ##############################################################################
+
+def empty_like(matrix):
+  """
+  Returns an empty matrix of the same format as <matrix>, sharing its
+  product quantization codebooks.
+  """
+  if matrix.kind == "fork":
+    return empty_like(matrix.overlay)
+  if matrix.kind == "pq":
+    return PQMatrix(matrix.codebooks)
+  return type(matrix)()
+
+
+class ForkedMatrix:
+  """
+  Copy-on-write view of another embedding matrix. The first <base_size>
+  rows are read from <base>, which is shared and never written to, and rows
+  appended to the fork go to an overlay of the same format.
+  """
+  kind = "fork"
+
+  def __init__(self, base, base_size=None):
+    self.base = base
+    self.base_size = len(base) if base_size is None else base_size
+    self.overlay = empty_like(base)
+
+
+  @property
+  def dim(self):
+    return self.base.dim
+
+
+  @property
+  def size(self):
+    return self.base_size + len(self.overlay)
+
+
+  def __len__(self):
+    return self.size
+
+
+  def append(self, vector):
+    return self.base_size + self.overlay.append(vector)
+
+
+  def get(self, row):
+    if row < self.base_size:
+      return self.base.get(row)
+    return self.overlay.get(row - self.base_size)
+
+
+  def to_dense(self):
+    dense = self.base.to_dense()[:self.base_size]
+    if len(self.overlay) == 0:
+      return dense
+    return np.vstack([dense, self.overlay.to_dense()])
+
+
+  def cosine(self, rows, query):
+    out = np.zeros(len(rows))
+    in_base = rows < self.base_size
+    if in_base.any():
+      out[in_base] = self.base.cosine(rows[in_base], query)
+    if not in_base.all():
+      out[~in_base] = self.overlay.cosine(rows[~in_base] - self.base_size,
+                                          query)
+    return out
+
+
+  def materialize(self):
+    """
+    Returns a standalone copy of the fork in the format of its base.
+    """
+    matrix = empty_like(self)
+    for vector in self.to_dense():
+      matrix.append(vector)
+    return matrix
+
+
+  def nbytes(self):
+    return self.overlay.nbytes()
+
+
+# ##############################################################################
+# ###                         CONVERSION AND STORAGE                         ###
+# ##############################################################################
+
+def quantize_matrix(matrix, kind, **kwargs):
+  """
+  Converting an embedding matrix to the <kind> format.
+
+  Parameters:
+    matrix: a DenseMatrix, Int8Matrix or PQMatrix
+    kind: 'float', 'int8' or 'pq'
+    kwargs: PQMatrix.train keyword arguments
+  Returns:
+    A new matrix of the <kind> format with the same rows
+  """
+  dense = matrix.to_dense()
+  if kind == "float":
+    new_matrix = DenseMatrix()
+  elif kind == "int8":
+    new_matrix = Int8Matrix()
+  elif kind == "pq":
+    if len(dense) == 0:
+      raise ValueError("Product quantization needs at least one vector to "
+                       "train its codebooks.")
+    new_matrix = PQMatrix.train(dense, **kwargs)
+  else:
+    raise ValueError(f"Unknown embedding format '{kind}'.")
+
+  for vector in dense:
+    new_matrix.append(vector)
+  return new_matrix
+
+
+def package_matrix(matrix):
+  """
+  Packaging a matrix for saving. Full precision matrices are saved as their
+  unit-normalized rows and norms, so loading them needs no normalization.
+
+  Parameters:
+    matrix: a DenseMatrix, Int8Matrix or PQMatrix
+  Returns:
+    A dictionary of the numpy arrays to save
+  """
+  arrays = {"kind": np.array(matrix.kind)}
+  if matrix.kind == "float":
+    arrays["unit"] = matrix.get_unit()
+    arrays["norms"] = matrix.norms[:matrix.size]
+  elif matrix.kind == "int8":
+    arrays["codes"] = matrix.codes[:matrix.size]
+    arrays["scales"] = matrix.scales[:matrix.size]
+  elif matrix.kind == "pq":
+    arrays["codes"] = matrix.codes[:matrix.size]
+    arrays["codebooks"] = matrix.codebooks
+  else:
+    raise ValueError(f"Cannot package a '{matrix.kind}' matrix.")
+  return arrays
+
+
+def load_matrix(arrays):
+  """
+  Loading a matrix packaged by package_matrix.
+
+  Parameters:
+    arrays: a dictionary (or NpzFile) of numpy arrays
+  Returns:
+    A DenseMatrix, Int8Matrix or PQMatrix
+  """
+  kind = str(arrays["kind"])
+  if kind == "float":
+    return DenseMatrix.from_unit(arrays["unit"], arrays["norms"])
+
+  codes = arrays["codes"]
+  if kind == "int8":
+    matrix = Int8Matrix(codes.shape[1])
+    matrix.codes = codes.astype(np.int8)
+    matrix.scales = arrays["scales"].astype(np.float32)
+    matrix.norms = (norm(matrix.codes.astype(np.float32), axis=1)
+                    * matrix.scales)
+  elif kind == "pq":
+    matrix = PQMatrix(arrays["codebooks"])
+    matrix.codes = codes.astype(np.uint8)
+    matrix.norms = norm(
+      matrix.codebooks[np.arange(matrix.n_subvectors), matrix.codes].reshape(
+        len(codes), -1), axis=1).astype(np.float32)
+  else:
+    raise ValueError(f"Unknown embedding format '{kind}'.")
+  matrix.size = len(codes)
+  return matrix
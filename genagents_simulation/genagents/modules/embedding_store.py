@@ -0,0 +1,444 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from genagents_simulation.genagents.modules.embedding_matrix import (
+  DenseMatrix, _grow)
+from genagents_simulation.genagents.modules.memory_log import atomic_write_json
+
+
+# ##############################################################################
+# ###                          HELPER FUNCTIONS                              ###
+# ##############################################################################
+
+def content_hash(content):
+  """
+  Returns the id of <content> in an embedding store.
+  """
+  return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+_open_stores = dict()
+_open_stores_lock = threading.Lock()
+
+
+def get_embedding_store(store_folder):
+  """
+  Returns the EmbeddingStore of <store_folder>. A store is only loaded once
+  per process, so all agents of a population share the same vectors in
+  memory.
+
+  Parameters:
+    store_folder: path to the store folder
+  Returns:
+    EmbeddingStore
+  """
+  store_folder = os.path.abspath(store_folder)
+  with _open_stores_lock:
+    if store_folder not in _open_stores:
+      _open_stores[store_folder] = EmbeddingStore(store_folder)
+    return _open_stores[store_folder]
+
+
+# ##############################################################################
+# ###                            EMBEDDING STORE                             ###
+# ##############################################################################
+
+class EmbeddingStore:
+  """
+  A population-level, content-addressed store of embeddings. Vectors are
+  keyed by the hash of their content, so a memory shared by many agents
+  (e.g. the same interview prompt) is stored and embedded once. Every
+  vector is refcounted by the number of saved agent folders that reference
+  it.
+
+  On disk, the store folder holds vectors.f64 (the raw float64 rows, only
+  ever appended to), index.json (the row keys, their refcounts, the
+  dimension and the embedding model that produced the vectors) and
+  index_log.jsonl. A save only appends the keys it added and the refcounts
+  it changed to the index log, so saving after every agent costs the size
+  of the change, not of the store; the log is folded into a rewritten
+  index.json once it is larger than it.
+  """
+  def __init__(self, store_folder):
+    self.store_folder = store_folder
+    self.matrix = DenseMatrix()
+    self.key_to_row = dict()
+    self.keys = []
+    self.refcounts = np.zeros(0, dtype=np.int64)
+    self.saved_size = 0
+    self.model = None
+    self.lock = threading.RLock()
+
+    # The rows whose refcount changed since the last save, and the state of
+    # the index files. index.json is rewritten under a new generation, so
+    # a log that outlived a crash in between is not replayed on top of it.
+    self.dirty_rows = set()
+    self.generation = 0
+    self.index_bytes = 0
+    self.log_bytes = 0
+
+    if os.path.exists(f"{store_folder}/index.json"):
+      with open(f"{store_folder}/index.json") as json_file:
+        index = json.load(json_file)
+      self.generation = index.get("generation", 0)
+      self.index_bytes = os.path.getsize(f"{store_folder}/index.json")
+      keys = list(index["keys"])
+      refcounts = list(index["refcounts"])
+      dim = index["dim"]
+      self.model = index.get("model")
+
+      entries, self.log_bytes = self._read_log()
+      for entry in entries:
+        # Keys are appended from their start row, so replaying an entry
+        # twice does not add its keys twice.
+        keys += entry["keys"][len(keys) - entry["start"]:]
+        refcounts += [0] * (len(keys) - len(refcounts))
+        for row, count in entry["refcounts"]:
+          refcounts[row] = count
+        dim = dim or entry["dim"]
+        self.model = self.model or entry["model"]
+
+      if keys:
+        vectors = np.fromfile(f"{store_folder}/vectors.f64",
+                              dtype=np.float64)
+        vectors = vectors[:len(keys) * dim]
+        for key, vector in zip(keys, vectors.reshape(-1, dim)):
+          self._append(key, vector)
+        self.refcounts[:len(self.keys)] = refcounts
+      self.saved_size = len(self.keys)
+
+
+  def _read_log(self):
+    """
+    Returns the committed entries of the index log of the current
+    generation, and the committed length of the log file. A line that a
+    crashed save did not finish ends the log.
+    """
+    log_file_name = f"{self.store_folder}/index_log.jsonl"
+    if not os.path.exists(log_file_name):
+      return [], 0
+    with open(log_file_name, "rb") as log_file:
+      lines = log_file.read().split(b"\n")
+    entries = []
+    log_bytes = 0
+    for line in lines[:-1]:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        break
+      if entry["generation"] == self.generation:
+        entries += [entry]
+      log_bytes += len(line) + 1
+    return entries, log_bytes
+
+
+  def __len__(self):
+    return len(self.keys)
+
+
+  def _append(self, key, vector):
+    row = self.matrix.append(vector)
+    if row == len(self.refcounts):
+      self.refcounts = _grow(self.refcounts, max(16, 2 * len(self.refcounts)))
+    self.key_to_row[key] = row
+    self.keys += [key]
+    return row
+
+
+  def has(self, key):
+    return key in self.key_to_row
+
+
+  def add(self, key, vector=None):
+    """
+    Adding the vector of <key> if the store does not have it yet.
+
+    Parameters:
+      key: content hash
+      vector: list of floats, only needed if <key> is new
+    Returns:
+      The store row of <key>
+    """
+    with self.lock:
+      if key in self.key_to_row:
+        return self.key_to_row[key]
+      if vector is None:
+        raise KeyError(f"Embedding store has no vector for {key}.")
+      return self._append(key, vector)
+
+
+  def update_refs(self, added_keys, removed_keys):
+    """
+    Updating the refcounts after an agent folder started referencing
+    <added_keys> and stopped referencing <removed_keys>.
+    """
+    with self.lock:
+      for key in added_keys:
+        self.refcounts[self.key_to_row[key]] += 1
+        self.dirty_rows.add(self.key_to_row[key])
+      for key in removed_keys:
+        if key in self.key_to_row:
+          self.refcounts[self.key_to_row[key]] -= 1
+          self.dirty_rows.add(self.key_to_row[key])
+
+
+  def save(self, rewrite_index=False):
+    """
+    Appending the new vectors to vectors.f64, and the new keys and changed
+    refcounts to index_log.jsonl. The vectors are written before the log
+    entry that commits them, so a crash never leaves an index that points
+    past the saved vectors. index.json is rewritten (atomically) instead
+    when the log has grown larger than it, or when <rewrite_index>.
+    """
+    with self.lock:
+      os.makedirs(self.store_folder, exist_ok=True)
+      vector_file_name = f"{self.store_folder}/vectors.f64"
+      if os.path.exists(vector_file_name):
+        # Dropping any vectors appended by a save that crashed before its
+        # index entry was written.
+        os.truncate(vector_file_name,
+                    self.saved_size * (self.matrix.dim or 0) * 8)
+
+      new_vectors = self.matrix.to_dense()[self.saved_size:]
+      with open(vector_file_name, "ab") as vector_file:
+        new_vectors.astype(np.float64).tofile(vector_file)
+        vector_file.flush()
+        os.fsync(vector_file.fileno())
+
+      if (rewrite_index or self.log_bytes > self.index_bytes
+          or not os.path.exists(f"{self.store_folder}/index.json")):
+        self._write_index()
+      elif len(self.keys) > self.saved_size or self.dirty_rows:
+        self._append_log()
+      self.saved_size = len(self.keys)
+      self.dirty_rows = set()
+
+
+  def _write_index(self):
+    self.generation += 1
+    index = {"generation": self.generation,
+             "dim": self.matrix.dim,
+             "model": self.model,
+             "keys": self.keys,
+             "refcounts": self.refcounts[:len(self.keys)].tolist()}
+    atomic_write_json(f"{self.store_folder}/index.json", index)
+    self.index_bytes = os.path.getsize(f"{self.store_folder}/index.json")
+    if os.path.exists(f"{self.store_folder}/index_log.jsonl"):
+      os.remove(f"{self.store_folder}/index_log.jsonl")
+    self.log_bytes = 0
+
+
+  def _append_log(self):
+    log_file_name = f"{self.store_folder}/index_log.jsonl"
+    # Dropping anything a crashed save wrote after the last committed
+    # entry.
+    if (os.path.exists(log_file_name)
+        and os.path.getsize(log_file_name) != self.log_bytes):
+      os.truncate(log_file_name, self.log_bytes)
+    entry = {"generation": self.generation,
+             "start": self.saved_size,
+             "dim": self.matrix.dim,
+             "model": self.model,
+             "keys": self.keys[self.saved_size:],
+             "refcounts": [[row, int(self.refcounts[row])]
+                           for row in sorted(self.dirty_rows)]}
+    line = (json.dumps(entry) + "\n").encode("utf-8")
+    with open(log_file_name, "ab") as log_file:
+      log_file.write(line)
+      log_file.flush()
+      os.fsync(log_file.fileno())
+    self.log_bytes += len(line)
+
+
+  def compact(self):
+    """
+    Dropping the vectors that no saved agent references and rewriting the
+    store. Rows move, so agents loaded from this store before compacting
+    must be reloaded.
+
+    Parameters:
+      None
+    Returns:
+      The number of dropped vectors
+    """
+    with self.lock:
+      keep = np.flatnonzero(self.refcounts[:len(self.keys)] > 0)
+      dropped = len(self.keys) - len(keep)
+      vectors = self.matrix.to_dense()[keep]
+      keys = [self.keys[row] for row in keep]
+      refcounts = self.refcounts[keep]
+
+      self.matrix = DenseMatrix()
+      self.key_to_row = dict()
+      self.keys = []
+      self.refcounts = np.zeros(0, dtype=np.int64)
+      for key, vector in zip(keys, vectors):
+        self._append(key, vector)
+      self.refcounts[:len(keys)] = refcounts
+
+      if os.path.exists(f"{self.store_folder}/vectors.f64"):
+        os.remove(f"{self.store_folder}/vectors.f64")
+      self.saved_size = 0
+      self.save(rewrite_index=True)
+      return dropped
+
+
+# ##############################################################################
+# ###                             SHARED MATRIX                              ###
+# ##############################################################################
+
+class SharedMatrix:
+  """
+  An agent's embedding matrix whose rows are references into a population
+  EmbeddingStore. It follows the DenseMatrix interface, and adding a row
+  whose content the store already has costs no vector memory.
+  """
+  kind = "shared"
+
+  def __init__(self, store):
+    self.store = store
+    self.size = 0
+    self.store_rows = np.zeros(0, dtype=np.int64)
+
+
+  @property
+  def dim(self):
+    return self.store.matrix.dim
+
+
+  def __len__(self):
+    return self.size
+
+
+  def append_key(self, key, vector=None):
+    """
+    Appending the store vector of <key> as a new row, adding <vector> to the
+    store first if it is new.
+
+    Parameters:
+      key: content hash
+      vector: list of floats, only needed if the store does not have <key>
+    Returns:
+      The row index of the vector
+    """
+    if self.size == len(self.store_rows):
+      self.store_rows = _grow(self.store_rows,
+                              max(16, 2 * len(self.store_rows)))
+    row = self.size
+    self.store_rows[row] = self.store.add(key, vector)
+    self.size += 1
+    return row
+
+
+  def get_key(self, row):
+    return self.store.keys[self.store_rows[row]]
+
+
+  def get(self, row):
+    return self.store.matrix.get(self.store_rows[row])
+
+
+  def to_dense(self):
+    store_rows = self.store_rows[:self.size]
+    return (self.store.matrix.data[store_rows]
+            * self.store.matrix.norms[store_rows, None])
+
+
+  def cosine(self, rows, query):
+    return self.store.matrix.cosine(self.store_rows[rows], query)
+
+
+  def nbytes(self):
+    return self.store_rows[:self.size].nbytes
+
+
+# ##############################################################################
+# ###                          AGENT REFERENCE FILES                         ###
+# ##############################################################################
+
+def read_embedding_refs(memory_stream_folder):
+  """
+  Reading an agent's memory_stream/embedding_refs.json.
+
+  Parameters:
+    memory_stream_folder: path to the agent's memory_stream folder
+  Returns:
+    (store_folder, refs) where refs is a dictionary from content to its
+    content hash, or (None, {}) if the agent has no reference file
+  """
+  refs_file = f"{memory_stream_folder}/embedding_refs.json"
+  if not os.path.exists(refs_file):
+    return None, dict()
+  with open(refs_file) as json_file:
+    package = json.load(json_file)
+  store_folder = os.path.abspath(
+    os.path.join(memory_stream_folder, package["store"]))
+  return store_folder, package["refs"]
+
+
+def write_embedding_refs(memory_stream_folder, store, refs):
+  """
+  Writing an agent's memory_stream/embedding_refs.json and updating the
+  store's refcounts against the references the folder had before. The
+  refs file is written atomically, after the store saved the new vectors
+  and references it needs and before the references it dropped are
+  released, so a crash at any point leaves refcounts that are at worst too
+  high (a leak until the next save), never references to missing vectors.
+
+  Parameters:
+    memory_stream_folder: path to the agent's memory_stream folder
+    store: EmbeddingStore
+    refs: a dictionary from content to its content hash
+  Returns:
+    None
+  """
+  old_store_folder, old_refs = read_embedding_refs(memory_stream_folder)
+  old_keys = set(old_refs.values())
+  if old_store_folder != store.store_folder:
+    # The references to the old store are all released (below).
+    same_store_keys = set()
+  else:
+    same_store_keys = old_keys
+
+  new_keys = set(refs.values())
+  store.update_refs(new_keys - same_store_keys, [])
+  store.save()
+
+  package = {"store": os.path.relpath(store.store_folder,
+                                      memory_stream_folder),
+             "refs": refs}
+  atomic_write_json(f"{memory_stream_folder}/embedding_refs.json", package)
+
+  if old_store_folder != store.store_folder:
+    _release_refs(old_store_folder, old_keys)
+  else:
+    store.update_refs([], old_keys - new_keys)
+    store.save()
+
+
+def _release_refs(store_folder, keys):
+  # Dropping <keys> from the refcounts of the store in <store_folder> (if
+  # it still exists).
+  if store_folder is None or not keys:
+    return
+  if os.path.exists(f"{store_folder}/index.json"):
+    store = get_embedding_store(store_folder)
+    store.update_refs([], keys)
+    store.save()
+
+
+def release_embedding_refs(memory_stream_folder):
+  """
+  Deleting an agent's memory_stream/embedding_refs.json and dropping its
+  references from the store's refcounts. The file is removed first, so a
+  crash in between leaves refcounts that are too high, not too low.
+  """
+  store_folder, refs = read_embedding_refs(memory_stream_folder)
+  if store_folder is None:
+    return
+  os.remove(f"{memory_stream_folder}/embedding_refs.json")
+  _release_refs(store_folder, set(refs.values()))
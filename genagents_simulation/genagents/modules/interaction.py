@@ -4,6 +4,9 @@ import datetime
 import random
 import string
 import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from numpy import dot
 from numpy.linalg import norm
@@ -12,35 +15,243 @@ from genagents_simulation.simulation_engine.settings import *
 from genagents_simulation.simulation_engine.global_methods import *
 from genagents_simulation.simulation_engine.gpt_structure import *
 from genagents_simulation.simulation_engine.llm_json_parser import *
+from genagents_simulation.genagents.modules.response_validation import *
+
+
+class DescriptionCache: 
+  """
+  Thread-safe LRU cache of rendered agent descriptions, bounded by the total 
+  number of characters it holds. 
+  """
+  def __init__(self, max_chars): 
+    self.max_chars = max_chars
+    self.entries = OrderedDict()
+    self.chars = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+
+  def get(self, key, render): 
+    """
+    Returns the description cached under <key>, rendering and caching it 
+    with <render>() if there is none. 
+    """
+    with self.lock: 
+      if key in self.entries: 
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+      self.misses += 1
+
+    description = render()
+    with self.lock: 
+      if key not in self.entries and len(description) <= self.max_chars: 
+        self.entries[key] = description
+        self.chars += len(description)
+        while self.chars > self.max_chars: 
+          _, evicted = self.entries.popitem(last=False)
+          self.chars -= len(evicted)
+    return description
+
+
+  def __contains__(self, key): 
+    with self.lock: 
+      return key in self.entries
+
+
+  def clear(self): 
+    with self.lock: 
+      self.entries.clear()
+      self.chars = 0
+
+
+# Descriptions are keyed by the agent, the anchor and the versions of the 
+# agent's scratch and memory stream, so any change to either is a new key and
+# stale descriptions age out of the cache. 
+description_cache = DescriptionCache(DESCRIPTION_CACHE_MAX_CHARS)
+
+
+class DescriptionStats(RunStats): 
+  """
+  Per-run counters of how much token-budgeted agent descriptions trim. 
+  """
+  def new_counters(self): 
+    return {"renders": 0, "memories_retrieved": 0, "memories_included": 0, 
+            "tokens_full": 0, "tokens_used": 0}
+
+
+  def record(self, memories_retrieved, memories_included, tokens_full, 
+             tokens_used): 
+    with self.lock: 
+      counters = self.counters()
+      counters["renders"] += 1
+      counters["memories_retrieved"] += memories_retrieved
+      counters["memories_included"] += memories_included
+      counters["tokens_full"] += tokens_full
+      counters["tokens_used"] += tokens_used
+
+
+  def package(self): 
+    with self.lock: 
+      counters = dict(self.counters())
+    return {"renders": counters["renders"], 
+            "memories_retrieved": counters["memories_retrieved"], 
+            "memories_trimmed": (counters["memories_retrieved"] 
+                                 - counters["memories_included"]), 
+            "tokens_full": counters["tokens_full"], 
+            "tokens_used": counters["tokens_used"], 
+            "tokens_trimmed": (counters["tokens_full"] 
+                               - counters["tokens_used"])}
+
+
+description_stats = DescriptionStats()
+
+
+def render_persona(scratch): 
+  """
+  Renders the agent's scratch as compact "field: value" pairs, leaving out 
+  empty fields. 
+  """
+  return "; ".join(f"{key.replace('_', ' ')}: {value}" 
+                   for key, value in scratch.items() 
+                   if value not in (None, "", [], {}))
+
+
+def _render_agent_desc(agent, anchor, token_budget=None): 
+  """
+  Renders the agent description for <anchor>: the agent's self description
+  and up to 120 retrieved memories in chronological order. With a 
+  <token_budget>, the persona is rendered compactly and the retrieved 
+  memories are packed greedily from the highest retrieval score down, 
+  skipping those that no longer fit, so the description stays within the 
+  estimated budget. The persona is always included, even if it alone 
+  exceeds the budget. 
+  """
+  retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120, 
+                                           sort_by_created=False)
+  nodes = list(retrieved.values())[0] if retrieved else []
+  return _render_agent_desc_from_nodes(agent, nodes, token_budget)
+
+
+def _render_agent_desc_from_nodes(agent, nodes, token_budget=None): 
+  """
+  Renders the agent description (see _render_agent_desc) from the <nodes> 
+  retrieved for its anchor, ordered from the highest retrieval score down.
+  """
+  if token_budget is None: 
+    nodes = sorted(nodes, key=lambda node: node.created)
+    agent_desc = [f"Self description: {agent.get_self_description()}\n==\n", 
+                  f"Other observations about the subject:\n\n"]
+    agent_desc += [f"{node.content}\n" for node in nodes]
+    return "".join(agent_desc)
+
+  header = (f"Self description: {render_persona(agent.scratch)}\n==\n"
+            f"Other observations about the subject:\n\n")
+
+  remaining = token_budget - estimate_tokens(header)
+  node_tokens = [estimate_tokens(f"{node.content}\n") for node in nodes]
+  included = []
+  for node, tokens in zip(nodes, node_tokens): 
+    if tokens <= remaining: 
+      included += [node]
+      remaining -= tokens
+  included = sorted(included, key=lambda node: node.created)
+
+  tokens_full = (estimate_tokens(
+    f"Self description: {agent.get_self_description()}\n==\n"
+    f"Other observations about the subject:\n\n") + sum(node_tokens))
+  description_stats.record(len(nodes), len(included), tokens_full, 
+                           token_budget - remaining)
+  return header + "".join(f"{node.content}\n" for node in included)
+
+
+def _main_desc_key(agent, anchor, token_budget=None): 
+  return (agent.id, "main", anchor, token_budget, agent.scratch_version, 
+          agent.memory_stream.version)
+
+
+def _main_agent_desc(agent, anchor, token_budget=None): 
+  return description_cache.get(
+    _main_desc_key(agent, anchor, token_budget), 
+    lambda: _render_agent_desc(agent, anchor, token_budget))
+
+
+def _utterance_agent_desc(agent, anchor, token_budget=None): 
+  key = (agent.id, "utterance", anchor, token_budget, agent.scratch_version, 
+         agent.memory_stream.version)
+  return description_cache.get(
+    key, lambda: _render_agent_desc(agent, anchor, token_budget))
+
+
+def prepare_agent_descs(agent, anchors, token_budget=None): 
+  """
+  Rendering and caching the agent descriptions of <agent> for all 
+  <anchors> at once: the anchors that are not cached yet are embedded and 
+  retrieved in one MemoryStream.retrieve call, and every description is 
+  rendered from the shared retrieval. Later interactions with these anchors
+  (categorical_resp, numerical_resp, ask, ...) then find their 
+  descriptions in the cache. 
+
+  Parameters:
+    agent: GenerativeAgent
+    anchors: list of str anchors
+    token_budget: token budget of the agent descriptions (None for no 
+      limit)
+  Returns: 
+    A dictionary from anchor to its agent description
+  """
+  missing = list(dict.fromkeys(
+    anchor for anchor in anchors 
+    if _main_desc_key(agent, anchor, token_budget) not in description_cache))
+  retrieved = dict()
+  if missing: 
+    retrieved = agent.memory_stream.retrieve(missing, 0, n_count=120, 
+                                             sort_by_created=False)
+  return {anchor: description_cache.get(
+            _main_desc_key(agent, anchor, token_budget), 
+            lambda: _render_agent_desc_from_nodes(
+              agent, retrieved.get(anchor, []), token_budget))
+          for anchor in anchors}
+
+
+def question_group_anchor(questions): 
+  """
+  Returns the retrieval anchor of a group of questions: the question texts
+  of a categorical or numerical survey (a dictionary) or of a questionnaire
+  (a list of question dictionaries, see ask), joined by spaces. 
+  """
+  if isinstance(questions, dict): 
+    return " ".join(list(questions.keys()))
+  return " ".join([question["question"] for question in questions])
+
+
+# The categorical and numerical response templates come in two versions: "1"
+# puts the agent description first, and "2" puts the shared instructions and 
+# questions first and the agent description last, so that the prompts of a 
+# survey share a long prefix that providers with prompt caching reuse.
+PREFIX_CACHE_PROMPT_VERSION = "2"
+
+
+def create_categorical_resp_prompt_input(agent_desc, questions):
+  str_questions = ""
+  for key, val in questions.items(): 
+    str_questions += f"Q: {key}\n"
+    str_questions += f"Option: {val}\n\n"
+  str_questions = str_questions.strip()
+  return [agent_desc, str_questions]
+
+
+def get_categorical_resp_prompt_lib_file(questions, prompt_version="1"): 
+  if len(questions) > 1: 
+    return f"{LLM_PROMPT_DIR}/generative_agent/interaction/categorical_resp/batch_v{prompt_version}.txt" 
+  return f"{LLM_PROMPT_DIR}/generative_agent/interaction/categorical_resp/singular_v{prompt_version}.txt" 
 
 
-def _main_agent_desc(agent, anchor): 
-  agent_desc = ""
-  agent_desc += f"Self description: {agent.get_self_description()}\n==\n"
-  agent_desc += f"Other observations about the subject:\n\n"
-
-  retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120)
-  if len(retrieved) == 0:
-    return agent_desc
-  nodes = list(retrieved.values())[0]
-  for node in nodes:
-    agent_desc += f"{node.content}\n"
-  return agent_desc
-
-
-def _utterance_agent_desc(agent, anchor): 
-  agent_desc = ""
-  agent_desc += f"Self description: {agent.get_self_description()}\n==\n"
-  agent_desc += f"Other observations about the subject:\n\n"
-
-  retrieved = agent.memory_stream.retrieve([anchor], 0, n_count=120)
-  if len(retrieved) == 0:
-    return agent_desc
-  
-  nodes = list(retrieved.values())[0]
-  for node in nodes:
-    agent_desc += f"{node.content}\n"
-  return agent_desc
+def parse_categorical_resp(gpt_response, prompt=""): 
+  responses, reasonings = extract_first_json_dict_categorical(gpt_response)
+  ret = {"responses": responses, "reasonings": reasonings}
+  return ret
 
 
 def run_gpt_generate_categorical_resp(
@@ -48,44 +259,121 @@ def run_gpt_generate_categorical_resp(
   questions,
   prompt_version="1",
   gpt_version="GPT4o",  
-  verbose=False):
-
-  def create_prompt_input(agent_desc, questions):
-    str_questions = ""
-    for key, val in questions.items(): 
-      str_questions += f"Q: {key}\n"
-      str_questions += f"Option: {val}\n\n"
-    str_questions = str_questions.strip()
-    return [agent_desc, str_questions]
-
-  def _func_clean_up(gpt_response, prompt=""): 
-    responses, reasonings = extract_first_json_dict_categorical(gpt_response)
-    ret = {"responses": responses, "reasonings": reasonings}
-    return ret
+  verbose=False,
+  stream=False,
+  structured=False):
 
   def _get_fail_safe():
     return None
 
-  if len(questions) > 1: 
-    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/categorical_resp/batch_v1.txt" 
-  else: 
-    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/categorical_resp/singular_v1.txt" 
-
-  prompt_input = create_prompt_input(agent_desc, questions) 
+  prompt_lib_file = get_categorical_resp_prompt_lib_file(questions, 
+                                                         prompt_version)
+  prompt_input = create_categorical_resp_prompt_input(agent_desc, questions) 
   fail_safe = _get_fail_safe() 
 
+  # With <structured>, the output is constrained to the JSON schema of the
+  # questions, so the answers are always among the options.
+  response_format = None
+  if structured: 
+    response_format = json_schema_response_format(
+      "categorical_resp", categorical_resp_schema(questions))
+
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
+    parse_categorical_resp, verbose, stream=stream, 
+    response_format=response_format)
+  response_stats.record_parse(
+    output is not None and len(output["responses"]) == len(questions))
 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def categorical_resp(agent, questions): 
-  anchor = " ".join(list(questions.keys()))
-  agent_desc = _main_agent_desc(agent, anchor)
+def categorical_resp(agent, questions, token_budget=None, prompt_version="1", 
+                     stream=False, structured=False): 
+  anchor = question_group_anchor(questions)
+  agent_desc = _main_agent_desc(agent, anchor, token_budget)
   return run_gpt_generate_categorical_resp(
-           agent_desc, questions, "1", LLM_VERS)[0]
+           agent_desc, questions, prompt_version, LLM_VERS, 
+           stream=stream, structured=structured)[0]
+
+
+def categorical_resp_prompt(agent, questions, token_budget=None, 
+                            prompt_version="1"): 
+  """
+  Rendering the prompt that categorical_resp would send for <agent>, for 
+  requests that are sent some other way (such as a batch job). The response
+  is parsed with parse_categorical_resp. 
+  """
+  anchor = question_group_anchor(questions)
+  agent_desc = _main_agent_desc(agent, anchor, token_budget)
+  return generate_prompt(
+    create_categorical_resp_prompt_input(agent_desc, questions), 
+    get_categorical_resp_prompt_lib_file(questions, prompt_version))
+
+
+def categorical_resp_samples(agent, questions, n, token_budget=None, 
+                             prompt_version="1", stream=False, 
+                             structured=False, retries=0): 
+  """
+  Sampling <n> responses of <agent> to the categorical <questions> from one
+  request (the agent description is rendered and sent once), for 
+  estimating the agent's within-person response distribution. Like 
+  categorical_resp, the samples can be constrained to the questions' JSON
+  schema, and the samples that do not validate are requested again. 
+  Samples cannot be streamed: the <n> choices of a streamed request arrive 
+  interleaved, so no sample could be cut off after its JSON. 
+
+  Parameters:
+    agent: GenerativeAgent
+    questions: dictionary from question to its list of options
+    n: the number of samples
+    token_budget: token budget of the agent description (None for no limit)
+    prompt_version: the categorical response template version
+    stream: must be False; a ValueError is raised otherwise
+    structured: whether the samples are constrained to the questions' JSON
+      schema
+    retries: the number of times the invalid samples are requested again
+      (in one request for all of them)
+  Returns:
+    A dictionary with the parsed "samples" ({"responses", "reasonings"} 
+    with the answers snapped to the options, or None for a sample that 
+    failed or could not be validated), and the 
+    "distribution" from each question to the share of the parsed samples 
+    that chose each option
+  """
+  if stream: 
+    raise ValueError("Sampled responses cannot be streamed.")
+  prompt = categorical_resp_prompt(agent, questions, token_budget, 
+                                   prompt_version)
+  response_format = None
+  if structured: 
+    response_format = json_schema_response_format(
+      "categorical_resp", categorical_resp_schema(questions))
+
+  samples = [None] * n
+  for attempt in range(1 + retries): 
+    failed = [count for count, sample in enumerate(samples) if not sample]
+    if not failed: 
+      break
+    if attempt: 
+      response_stats.record_retries(len(failed))
+    gpt_responses = gpt_request_samples(prompt, len(failed), LLM_VERS, 
+                                        response_format=response_format)
+    for count, gpt_response in zip(failed, gpt_responses): 
+      output = parse_categorical_resp(gpt_response)
+      response_stats.record_parse(len(output["responses"]) == len(questions))
+      samples[count] = validate_categorical_resp(questions, output)
+    
+  distribution = dict()
+  parsed = [sample for sample in samples if sample]
+  for count, (question, options) in enumerate(questions.items()): 
+    distribution[question] = {option: 0 for option in options}
+    for sample in parsed: 
+      response = sample["responses"][count]
+      distribution[question][response] += 1
+    for response in distribution[question]: 
+      distribution[question][response] /= max(len(parsed), 1)
+  return {"samples": samples, "distribution": distribution}
 
 
 def run_gpt_generate_numerical_resp(
@@ -94,7 +382,9 @@ def run_gpt_generate_numerical_resp(
   float_resp,
   prompt_version="1",
   gpt_version="GPT4o",  
-  verbose=False):
+  verbose=False,
+  stream=False,
+  structured=False):
 
   def create_prompt_input(agent_desc, questions, float_resp):
     str_questions = ""
@@ -118,30 +408,38 @@ def run_gpt_generate_numerical_resp(
     return None
 
   if len(questions) > 1: 
-    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/numerical_resp/batch_v1.txt" 
+    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/numerical_resp/batch_v{prompt_version}.txt" 
   else: 
-    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/numerical_resp/singular_v1.txt" 
+    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/numerical_resp/singular_v{prompt_version}.txt" 
 
   prompt_input = create_prompt_input(agent_desc, questions, float_resp) 
   fail_safe = _get_fail_safe() 
 
+  response_format = None
+  if structured: 
+    response_format = json_schema_response_format(
+      "numerical_resp", numerical_resp_schema(questions, float_resp))
+
   output, prompt, prompt_input, fail_safe = chat_safe_generate(
     prompt_input, prompt_lib_file, gpt_version, 1, fail_safe, 
-    _func_clean_up, verbose)
-
-  if float_resp: 
-    output["responses"] = [float(i) for i in output["responses"]]
-  else: 
-    output["responses"] = [int(i) for i in output["responses"]]
-
+    _func_clean_up, verbose, stream=stream, 
+    response_format=response_format)
+  response_stats.record_parse(
+    output is not None and len(output["responses"]) == len(questions))
+
+  # The answers are returned as parsed: validate_numerical_resp converts 
+  # them to numbers, and rejects non-integers (unless <float_resp>) and 
+  # answers out of range, instead of truncating them here. 
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def numerical_resp(agent, questions, float_resp): 
-  anchor = " ".join(list(questions.keys()))
-  agent_desc = _main_agent_desc(agent, anchor)
+def numerical_resp(agent, questions, float_resp, token_budget=None, 
+                   prompt_version="1", stream=False, structured=False): 
+  anchor = question_group_anchor(questions)
+  agent_desc = _main_agent_desc(agent, anchor, token_budget)
   return run_gpt_generate_numerical_resp(
-           agent_desc, questions, float_resp, "1", LLM_VERS)[0]
+           agent_desc, questions, float_resp, prompt_version, LLM_VERS, 
+           stream=stream, structured=structured)[0]
 
 
 def run_gpt_generate_utterance(
@@ -174,14 +472,14 @@ def run_gpt_generate_utterance(
   return output, [output, prompt, prompt_input, fail_safe]
 
 
-def utterance(agent, curr_dialogue, context): 
+def utterance(agent, curr_dialogue, context, token_budget=None): 
   str_dialogue = ""
   for row in curr_dialogue:
     str_dialogue += f"[{row[0]}]: {row[1]}\n"
   str_dialogue += f"[{agent.get_fullname()}]: [Fill in]\n"
 
   anchor = str_dialogue
-  agent_desc = _utterance_agent_desc(agent, anchor)
+  agent_desc = _utterance_agent_desc(agent, anchor, token_budget)
   return run_gpt_generate_utterance(
            agent_desc, str_dialogue, context, "1", LLM_VERS)[0]
 
@@ -191,7 +489,8 @@ def run_gpt_generate_ask(
     questions,
     prompt_version="1",
     gpt_version="GPT4o",
-    verbose=False):
+    verbose=False,
+    stream=False):
 
     def create_prompt_input(agent_desc, questions):
         str_questions = ""
@@ -217,39 +516,128 @@ def run_gpt_generate_ask(
     def _get_fail_safe():
         return None
 
-    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/ask/batch_v1.txt"
+    prompt_lib_file = f"{LLM_PROMPT_DIR}/generative_agent/interaction/ask/batch_v{prompt_version}.txt"
 
     prompt_input = create_prompt_input(agent_desc, questions)
     fail_safe = _get_fail_safe()
 
     output, prompt, prompt_input, fail_safe = chat_safe_generate(
         prompt_input, prompt_lib_file, gpt_version, 1, fail_safe,
-        _func_clean_up, verbose)
+        _func_clean_up, verbose, stream=stream)
 
     return output, [output, prompt, prompt_input, fail_safe]
 
 
-
-  
-
-
-
-
-
-  
-
-
-
-
-  
-
-
-
-
-
-  
-
-
-
-
-
+# Estimated completion tokens of an answer's reasoning and JSON fields, 
+# before the answer itself. 
+ASK_ANSWER_TOKENS = 60
+
+# The completion tokens that the answers of one chunk of questions may be 
+# estimated to need (gpt_request allows 1500). 
+ASK_CHUNK_TOKEN_BUDGET = 1200
+
+
+def estimate_answer_tokens(question): 
+  """
+  Returns the estimated completion tokens of the answer to a questionnaire 
+  question: its reasoning plus its longest option, a number, or its 
+  character limit for open questions. 
+  """
+  response_type = question["response-type"]
+  if response_type == "categorical": 
+    return ASK_ANSWER_TOKENS + max(
+      [estimate_tokens(str(option)) for option in question["response-options"]]
+      or [1])
+  if response_type == "open": 
+    return ASK_ANSWER_TOKENS + question.get("response-char-limit", 200) // 4
+  return ASK_ANSWER_TOKENS + 4
+
+
+def chunk_questions(questions, max_chunk_size=MAX_CHUNK_SIZE, 
+                    token_budget=ASK_CHUNK_TOKEN_BUDGET): 
+  """
+  Splitting a questionnaire into as few prompts as possible, in order: a 
+  chunk holds at most <max_chunk_size> questions whose answers are 
+  estimated to need at most <token_budget> completion tokens (a question 
+  that alone needs more gets its own chunk). 
+
+  Returns: 
+    The list of chunks, each a list of question indices
+  """
+  chunks = []
+  chunk_tokens = 0
+  for count, question in enumerate(questions): 
+    tokens = estimate_answer_tokens(question)
+    if (not chunks or len(chunks[-1]) >= max_chunk_size 
+        or chunk_tokens + tokens > token_budget): 
+      chunks += [[]]
+      chunk_tokens = 0
+    chunks[-1] += [count]
+    chunk_tokens += tokens
+  return chunks
+
+
+def ask(agent, questions, token_budget=None, prompt_version="1", 
+        stream=False, max_chunk_size=MAX_CHUNK_SIZE, 
+        chunk_token_budget=ASK_CHUNK_TOKEN_BUDGET, retries=1): 
+  """
+  Asking <agent> a mixed-type questionnaire in as few requests as 
+  possible. The questions are split by chunk_questions and the chunks are 
+  sent concurrently; all chunks share one agent description, retrieved for
+  the whole questionnaire. Every answer is validated by its type, and the 
+  questions without a valid answer are asked again, up to <retries> times.
+
+  Parameters:
+    agent: GenerativeAgent
+    questions: list of question dictionaries with "question", 
+      "response-type" ('categorical', 'int', 'float' or 'open') and, by 
+      type, "response-options", "response-scale" or "response-char-limit"
+    token_budget: token budget of the agent description (None for no limit)
+    prompt_version: the ask template version
+    stream: whether responses are streamed and cut off after their JSON
+    max_chunk_size: the maximum number of questions per request
+    chunk_token_budget: the estimated completion tokens per request
+    retries: the number of times unanswered questions are asked again
+  Returns: 
+    A list aligned with <questions> of {"response", "reasoning"} 
+    dictionaries; the response is None if no valid answer was given
+  """
+  anchor = question_group_anchor(questions)
+  agent_desc = _main_agent_desc(agent, anchor, token_budget)
+
+  def _ask_chunk(chunk): 
+    output = run_gpt_generate_ask(agent_desc, 
+                                  [questions[index] for index in chunk], 
+                                  prompt_version, LLM_VERS, 
+                                  stream=stream)[0]
+    response_stats.record_parse(isinstance(output, dict))
+    return output if isinstance(output, dict) else dict()
+
+  answers = [{"response": None, "reasoning": None} for _ in questions]
+  pending = list(range(len(questions)))
+  for attempt in range(1 + retries): 
+    if not pending: 
+      break
+    chunks = [[pending[count] for count in chunk] for chunk in 
+              chunk_questions([questions[index] for index in pending], 
+                              max_chunk_size, chunk_token_budget)]
+    if attempt: 
+      response_stats.record_retries(len(chunks))
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(chunks))
+                            ) as executor: 
+      outputs = list(executor.map(in_current_run(_ask_chunk), chunks))
+
+    for chunk, output in zip(chunks, outputs): 
+      for count, index in enumerate(chunk): 
+        # The template keys the answers "Q1", "Q2", ...; models sometimes 
+        # drop the Q. 
+        entry = output.get(f"Q{count + 1}", output.get(str(count + 1)))
+        if not isinstance(entry, dict): 
+          continue
+        response = validate_answer(questions[index], entry.get("Response"))
+        if response is not None: 
+          answers[index] = {"response": response, 
+                            "reasoning": entry.get("Reasoning")}
+    pending = [index for index in pending 
+               if answers[index]["response"] is None]
+  return answers
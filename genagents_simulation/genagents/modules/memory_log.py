@@ -0,0 +1,165 @@
+import json
+import os
+
+import numpy as np
+
+
+# ##############################################################################
+# ###                          HELPER FUNCTIONS                              ###
+# ##############################################################################
+
+# A memory log is compacted into the agent's full memory stream files once it
+# holds more nodes than the files (and at least this many).
+LOG_COMPACTION_MIN_NODES = 1024
+
+
+def atomic_write_json(file_name, data, indent=None):
+  """
+  Writing <data> to <file_name> through a temporary file that is renamed
+  over it, so readers never see a partly written file.
+  """
+  with open(f"{file_name}.tmp", "w") as json_file:
+    json.dump(data, json_file, indent=indent)
+    json_file.flush()
+    os.fsync(json_file.fileno())
+  os.replace(f"{file_name}.tmp", file_name)
+
+
+def atomic_savez(file_name, arrays):
+  """
+  np.savez counterpart of atomic_write_json.
+  """
+  with open(f"{file_name}.tmp", "wb") as npz_file:
+    np.savez(npz_file, **arrays)
+    npz_file.flush()
+    os.fsync(npz_file.fileno())
+  os.replace(f"{file_name}.tmp", file_name)
+
+
+def _append_bytes(file_name, data):
+  with open(file_name, "ab") as log_file:
+    log_file.write(data)
+    log_file.flush()
+    os.fsync(log_file.fileno())
+
+
+# ##############################################################################
+# ###                              MEMORY LOG                                ###
+# ##############################################################################
+
+def read_committed_log(memory_stream_folder):
+  """
+  Reading the committed entries of an agent's memory log.
+
+  Parameters:
+    memory_stream_folder: path to the agent's memory_stream folder
+  Returns:
+    (entries, log_bytes, vector_bytes) where entries is a list of
+    (entry, vectors) pairs, and log_bytes and vector_bytes are the
+    committed lengths of log.jsonl and log_vectors.f64
+  """
+  log_file_name = f"{memory_stream_folder}/log.jsonl"
+  vector_file_name = f"{memory_stream_folder}/log_vectors.f64"
+  if not os.path.exists(log_file_name):
+    return [], 0, 0
+
+  with open(log_file_name, "rb") as log_file:
+    lines = log_file.read().split(b"\n")
+  vector_size = (os.path.getsize(vector_file_name)
+                 if os.path.exists(vector_file_name) else 0)
+
+  # The last element is whatever follows the last newline: empty, or a line
+  # that a crashed save did not finish.
+  entries = []
+  log_bytes = 0
+  vector_bytes = 0
+  for line in lines[:-1]:
+    try:
+      entry = json.loads(line)
+    except ValueError:
+      break
+    n_bytes = len(entry["contents"]) * entry["dim"] * 8
+    if vector_bytes + n_bytes > vector_size:
+      break
+    vectors = np.zeros((0, entry["dim"]))
+    if n_bytes:
+      vectors = np.fromfile(vector_file_name, dtype=np.float64,
+                            count=n_bytes // 8, offset=vector_bytes
+                            ).reshape(len(entry["contents"]), entry["dim"])
+    entries += [(entry, vectors)]
+    log_bytes += len(line) + 1
+    vector_bytes += n_bytes
+  return entries, log_bytes, vector_bytes
+
+
+def read_memory_log(memory_stream_folder):
+  """
+  Reading an agent's memory log: the nodes, new embeddings and
+  last_retrieved updates that each incremental save appended since the
+  memory stream files were last written in full. An entry that a crashed
+  save only partly wrote is ignored.
+
+  Parameters:
+    memory_stream_folder: path to the agent's memory_stream folder
+  Returns:
+    A list of (entry, vectors) pairs in save order. entry is a dictionary
+    with "nodes" (packaged nodes), "contents" (the contents of the new
+    embeddings), "dim" and "last_retrieved" (node_id to time step), and
+    vectors is the 2-D numpy array of the new embeddings
+  """
+  return read_committed_log(memory_stream_folder)[0]
+
+
+def append_memory_log(memory_stream_folder, nodes, contents, vectors,
+                      last_retrieved, committed=None):
+  """
+  Appending one entry to an agent's memory log. The vectors are written
+  to memory_stream/log_vectors.f64 first, and the entry is committed by
+  writing its line to memory_stream/log.jsonl.
+
+  Parameters:
+    memory_stream_folder: path to the agent's memory_stream folder
+    nodes: list of packaged nodes
+    contents: list of the str contents of the new embeddings
+    vectors: 2-D numpy array of the new embeddings, aligned with <contents>
+    last_retrieved: dictionary from node_id to its new last_retrieved
+    committed: the (log_bytes, vector_bytes) committed lengths of the log
+      files if the caller knows them, so the log is not read again
+  Returns:
+    The committed (log_bytes, vector_bytes) lengths after the entry
+  """
+  log_file_name = f"{memory_stream_folder}/log.jsonl"
+  vector_file_name = f"{memory_stream_folder}/log_vectors.f64"
+
+  # Dropping anything a crashed save wrote after the last committed entry.
+  if committed is None:
+    committed = read_committed_log(memory_stream_folder)[1:]
+  log_bytes, vector_bytes = committed
+  for file_name, size in [(log_file_name, log_bytes),
+                          (vector_file_name, vector_bytes)]:
+    if os.path.exists(file_name) and os.path.getsize(file_name) != size:
+      os.truncate(file_name, size)
+
+  dim = 0
+  if contents:
+    vectors = np.asarray(vectors, dtype=np.float64)
+    dim = vectors.shape[1]
+    _append_bytes(vector_file_name, vectors.tobytes())
+    vector_bytes += vectors.nbytes
+  entry = {"nodes": nodes,
+           "contents": contents,
+           "dim": dim,
+           "last_retrieved": {str(node_id): time_step
+                              for node_id, time_step in last_retrieved.items()}}
+  line = (json.dumps(entry) + "\n").encode("utf-8")
+  _append_bytes(log_file_name, line)
+  return log_bytes + len(line), vector_bytes
+
+
+def remove_memory_log(memory_stream_folder):
+  """
+  Deleting an agent's memory log once it is compacted.
+  """
+  for file_name in ["log.jsonl", "log_vectors.f64"]:
+    if os.path.exists(f"{memory_stream_folder}/{file_name}"):
+      os.remove(f"{memory_stream_folder}/{file_name}")
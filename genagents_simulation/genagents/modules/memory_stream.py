@@ -5,6 +5,7 @@ import random
 import string
 import re
 
+import numpy as np
 from numpy import dot
 from numpy.linalg import norm
 
@@ -12,6 +13,10 @@ from genagents_simulation.simulation_engine.settings import *
 from genagents_simulation.simulation_engine.global_methods import *
 from genagents_simulation.simulation_engine.gpt_structure import *
 from genagents_simulation.simulation_engine.llm_json_parser import *
+from genagents_simulation.simulation_engine.embedding_providers import *
+from genagents_simulation.genagents.modules.ann_index import *
+from genagents_simulation.genagents.modules.embedding_matrix import *
+from genagents_simulation.genagents.modules.embedding_store import *
 
 
 def run_gpt_generate_importance(
@@ -206,86 +211,174 @@ def top_highest_x_values(d, x):
   return top_v
 
 
-def extract_recency(seq_nodes):
+def normalize_floats(values, target_min, target_max):
   """
-  Gets the current Persona object and a list of nodes that are in a 
-  chronological order, and outputs a dictionary that has the recency score
-  calculated.
+  Array counterpart of normalize_dict_floats. Scales a 1-D array of floats 
+  to the [target_min, target_max] range while keeping the relative 
+  proportions between the original values. 
 
   Parameters: 
-    nodes: A list of Node object in a chronological order. 
+    values: 1-D numpy array of floats. 
+    target_min: Integer or float. The minimum of the target range. 
+    target_max: Integer or float. The maximum of the target range. 
   Returns: 
-    recency_out: A dictionary whose keys are the node.node_id and whose values
-                 are the float that represents the recency score. 
+    A new 1-D numpy array with the normalized values. 
   """
-  
-  max_timestep = max([node.last_retrieved for node in seq_nodes])
-
-  recency_decay = 0.99
-  recency_out = dict()
-  for count, node in enumerate(seq_nodes): 
-    recency_out[node.node_id] = (recency_decay
-                                 ** (max_timestep - node.last_retrieved))
+  if len(values) == 0: 
+    return np.zeros(0)
+  min_val = values.min()
+  range_val = values.max() - min_val
 
-  return recency_out
+  if range_val == 0: 
+    return np.full(len(values), (target_max - target_min)/2)
+  return ((values - min_val) * (target_max - target_min) 
+          / range_val + target_min)
 
 
-def extract_importance(seq_nodes):
+def extract_recency(last_retrieved):
   """
-  Gets the current Persona object and a list of nodes that are in a 
-  chronological order, and outputs a dictionary that has the importance score
-  calculated.
+  Gets the last_retrieved time steps of a set of nodes and outputs the 
+  recency score of each node.
 
   Parameters: 
-    seq_nodes: A list of Node object in a chronological order. 
+    last_retrieved: 1-D numpy array of the nodes' last_retrieved time steps. 
   Returns: 
-    importance_out: A dictionary whose keys are the node.node_id and whose 
-                    values are the float that represents the importance score.
+    recency_out: 1-D numpy array of floats that represent the recency score,
+                 aligned with <last_retrieved>. 
   """
-  importance_out = dict()
-  for count, node in enumerate(seq_nodes): 
-    importance_out[node.node_id] = node.importance
-
-  return importance_out
+  recency_decay = 0.99
+  max_timestep = last_retrieved.max()
+  return recency_decay ** (max_timestep - last_retrieved)
 
 
-def extract_relevance(seq_nodes, embeddings, focal_pt): 
+def extract_importance(importance):
   """
-  Gets the current Persona object, a list of seq_nodes that are in a 
-  chronological order, and the focal_pt string and outputs a dictionary 
-  that has the relevance score calculated.
+  Gets the importance of a set of nodes and outputs the importance score of 
+  each node.
 
   Parameters: 
-    seq_nodes: A list of Node object in a chronological order. 
-    focal_pt: A string describing the current thought of revent of focus.  
+    importance: 1-D numpy array of the nodes' importance. 
   Returns: 
-    relevance_out: A dictionary whose keys are the node.node_id and whose 
-                   values are the float that represents the relevance score.
+    importance_out: 1-D numpy array of floats that represent the importance 
+                    score, aligned with <importance>.
+  """
+  return importance.astype(float)
+
+
+def extract_relevance(embedding_matrix, embedding_rows, focal_embedding): 
   """
-  focal_embedding = get_text_embedding(focal_pt)
+  Gets the embedding matrix of the memory stream, the embedding rows of a set
+  of nodes, and the embedding of the focal point and outputs the relevance 
+  score of each node. The cosine similarities are computed by the matrix 
+  directly on its (possibly quantized) rows. 
 
-  relevance_out = dict()
-  for count, node in enumerate(seq_nodes): 
-    node_embedding = embeddings[node.content]
-    relevance_out[node.node_id] = cos_sim(node_embedding, focal_embedding)
+  Parameters: 
+    embedding_matrix: the stream's DenseMatrix, Int8Matrix or PQMatrix.
+    embedding_rows: 1-D numpy array of the nodes' row index into 
+      <embedding_matrix>. Nodes without an embedding have the row -1. 
+    focal_embedding: 1-D numpy array, the embedding of the current thought
+      or event of focus. 
+  Returns: 
+    relevance_out: 1-D numpy array of floats that represent the relevance 
+                   score, aligned with <embedding_rows>.
+  """
+  relevance_out = np.zeros(len(embedding_rows))
+  has_embedding = embedding_rows >= 0
+  relevance_out[has_embedding] = embedding_matrix.cosine(
+    embedding_rows[has_embedding], focal_embedding)
 
   return relevance_out
 
 
+def _as_number(value): 
+  """
+  Converts a float64 array element back to the int or float it was stored 
+  from, so that packaged nodes serialize exactly as they were loaded. 
+  """
+  value = float(value)
+  if value.is_integer(): 
+    return int(value)
+  return value
+
+
+def _grow(array, capacity): 
+  """
+  Returns a copy of <array> whose first axis is extended to <capacity>. 
+  """
+  grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+  grown[:len(array)] = array
+  return grown
+
+
 # ##############################################################################
 # ###                              CONCEPT NODE                              ###
 # ##############################################################################
 
+NODE_TYPES = ["observation", "reflection"]
+NODE_TYPE_CODES = {node_type: code for code, node_type in enumerate(NODE_TYPES)}
+
+
+def get_node_type_code(node_type): 
+  """
+  Returns the int code of <node_type>, registering it if it is not one of 
+  the known node types. 
+  """
+  if node_type not in NODE_TYPE_CODES: 
+    NODE_TYPE_CODES[node_type] = len(NODE_TYPES)
+    NODE_TYPES.append(node_type)
+  return NODE_TYPE_CODES[node_type]
+
+
 class ConceptNode: 
-  def __init__(self, node_dict): 
-    # Loading the content of a memory node in the memory stream. 
-    self.node_id = node_dict["node_id"]
-    self.node_type = node_dict["node_type"]
-    self.content = node_dict["content"]
-    self.importance = node_dict["importance"]
-    self.created = node_dict["created"]
-    self.last_retrieved = node_dict["last_retrieved"]
-    self.pointer_id = node_dict["pointer_id"]
+  """
+  A lightweight view of one row of a MemoryStream. The node's fields live in
+  the stream's parallel arrays; the view only holds the stream and the row.
+  """
+  __slots__ = ("stream", "row")
+
+  def __init__(self, stream, row): 
+    self.stream = stream
+    self.row = row
+
+
+  @property
+  def node_id(self): 
+    return int(self.stream._node_id[self.row])
+
+
+  @property
+  def node_type(self): 
+    return NODE_TYPES[self.stream._type[self.row]]
+
+
+  @property
+  def content(self): 
+    return self.stream._content[self.row]
+
+
+  @property
+  def importance(self): 
+    return _as_number(self.stream._importance[self.row])
+
+
+  @property
+  def created(self): 
+    return _as_number(self.stream._created[self.row])
+
+
+  @property
+  def last_retrieved(self): 
+    return _as_number(self.stream._last_retrieved[self.row])
+
+
+  @last_retrieved.setter
+  def last_retrieved(self, time_step): 
+    self.stream._set_last_retrieved([self.row], time_step)
+
+
+  @property
+  def pointer_id(self): 
+    return self.stream._pointer_id[self.row]
 
 
   def package(self): 
@@ -314,16 +407,494 @@ class ConceptNode:
 # ##############################################################################
 
 class MemoryStream: 
-  def __init__(self, nodes, embeddings): 
-    # Loading the memory stream for the agent. 
-    self.seq_nodes = []
-    self.id_to_node = dict()
+  def __init__(self, nodes, embeddings, matrix=None, embedding_provider=None): 
+    # The memory stream is stored as parallel arrays, one row per node. 
+    # ConceptNode objects are only created as views when nodes are returned.
+    self._size = 0
+    self._node_id = np.zeros(0, dtype=np.int64)
+    self._type = np.zeros(0, dtype=np.int8)
+    self._importance = np.zeros(0)
+    self._created = np.zeros(0)
+    self._last_retrieved = np.zeros(0)
+    self._embedding_row = np.zeros(0, dtype=np.int64)
+    self._content = []
+    self._pointer_id = []
+    self._id_to_row = dict()
+
+    # Per-type partitions of the stream. Each node type code maps to the 
+    # array of rows of that type (in chronological order) and its size, so 
+    # filtered retrieval and counting do not rescan the whole stream. 
+    self._partition_rows = dict()
+    self._partition_size = dict()
+
+    # Normalized recency and importance scores do not depend on the query, so
+    # they are cached per retrieval filter. Both caches are dropped when a 
+    # node is added, and the recency cache when a last_retrieved changes. 
+    self._recency_cache = dict()
+    self._importance_cache = dict()
+
+    # Per retrieval filter, the partition's embedding rows in sorted order 
+    # and their positions in the partition, for mapping the candidate rows
+    # of the nearest neighbor index to partition positions. Nodes' 
+    # embedding rows never change, so it is only dropped when a node is 
+    # added. 
+    self._embedding_position_cache = dict()
+
+    # Incremented whenever a change may alter retrieval results, so that 
+    # anything derived from them (such as rendered agent descriptions) can 
+    # be cached per version. 
+    self.version = 0
+
+    # Rows whose last_retrieved changed since the last pop_retrieved_updates
+    # call, so that incremental saves only persist the changed values. 
+    self._retrieved_rows = set()
+
+    # Embeddings are rows of a single matrix. Each distinct (interned) 
+    # content string has one row, which is shared by all nodes with that 
+    # content. The matrix is full precision unless a quantized <matrix> is 
+    # given, in which case <embeddings> is the list of the contents of its 
+    # rows. 
+    self._matrix = DenseMatrix()
+    self._content_to_row = dict()
+
+    # The provider that embeds new contents and focal points. It has to be 
+    # the one that produced the stored embeddings. 
+    self.embedding_provider = embedding_provider or get_embedding_provider()
+
+    # Optional approximate nearest neighbor index over the embedding matrix 
+    # rows. When it is set, large partitions are prefiltered by the index 
+    # before the exact scoring. 
+    self.index = None
+
+    if matrix is None: 
+      for content, embedding in embeddings.items(): 
+        self._add_embedding(content, embedding)
+    else: 
+      self._matrix = matrix
+      for row, content in enumerate(embeddings): 
+        self._content_to_row[sys.intern(content)] = row
+    for node in nodes: 
+      self._append_row(node["node_id"], node["node_type"], node["content"], 
+                       node["importance"], node["created"], 
+                       node["last_retrieved"], node["pointer_id"])
+
+
+  @property
+  def seq_nodes(self): 
+    """
+    The list of all nodes in chronological order, as ConceptNode views. 
+    """
+    return [ConceptNode(self, row) for row in range(self._size)]
+
+
+  @property
+  def id_to_node(self): 
+    """
+    A dictionary from node_id to ConceptNode view. 
+    """
+    return {node_id: ConceptNode(self, row) 
+            for node_id, row in self._id_to_row.items()}
+
+
+  @property
+  def embeddings(self): 
+    """
+    The embeddings as a dictionary from content to its embedding list. This 
+    is the original on-disk layout of memory_stream/embeddings.json. 
+    """
+    return {content: self._matrix.get(row).tolist() 
+            for content, row in self._content_to_row.items()}
+
+
+  @property
+  def matrix(self): 
+    return self._matrix
+
+
+  def get_contents_by_row(self): 
+    """
+    Returns the list of contents in the order of the embedding matrix rows.
+    """
+    contents = [None] * len(self._matrix)
+    for content, row in self._content_to_row.items(): 
+      contents[row] = content
+    return contents
+
+
+  def quantize(self, kind="int8", **kwargs): 
+    """
+    Converting the stream's embedding matrix to the <kind> format. Relevance
+    is then scored directly on the compressed rows. 
+
+    Parameters:
+      kind: 'float', 'int8' or 'pq'
+      kwargs: PQMatrix.train keyword arguments 
+    Returns: 
+      None
+    """
+    self._matrix = quantize_matrix(self._matrix, kind, **kwargs)
+    self.version += 1
+
+
+  def share_embeddings(self, store): 
+    """
+    Moving the stream's embeddings into a population EmbeddingStore. The 
+    stream then only keeps references to the store's vectors, and new 
+    contents that the store already has are not embedded again. 
+
+    Parameters:
+      store: EmbeddingStore
+    Returns: 
+      None
+    """
+    if store.model is None: 
+      store.model = self.embedding_provider.name
+    elif store.model != self.embedding_provider.name: 
+      raise ValueError(f"Embedding store holds {store.model} vectors, not "
+                       f"{self.embedding_provider.name} vectors.")
+    matrix = SharedMatrix(store)
+    for content in self.get_contents_by_row(): 
+      matrix.append_key(content_hash(content), 
+                        self._matrix.get(self._content_to_row[content]))
+    self._matrix = matrix
+
+
+  def reembed(self, embedding_provider): 
+    """
+    Replacing every stored embedding with one from <embedding_provider>. 
+    The new embeddings are kept in full precision, and the approximate 
+    nearest neighbor index (if any) is rebuilt at its next use. 
+
+    Parameters:
+      embedding_provider: the new embedding provider
+    Returns: 
+      None
+    """
+    matrix = DenseMatrix()
+    for vector in embedding_provider.embed(self.get_contents_by_row()): 
+      matrix.append(vector)
+    self._matrix = matrix
+    self.embedding_provider = embedding_provider
+    self.version += 1
+    if self.index is not None: 
+      self.index.reset()
+
+
+  def fork(self, n_nodes=None, n_rows=None): 
+    """
+    Creating a copy-on-write branch of the memory stream from its first 
+    <n_nodes> nodes and <n_rows> embedding rows (all of them by default). 
+    The branch reads the embeddings of those rows from this stream's matrix
+    and only stores the embeddings it adds itself. The per-node arrays are 
+    small and copied, so the branch updates last_retrieved independently.
+
+    Parameters:
+      n_nodes: the number of nodes to branch from
+      n_rows: the number of embedding matrix rows to branch from
+    Returns: 
+      MemoryStream
+    """
+    n_nodes = self._size if n_nodes is None else n_nodes
+    n_rows = len(self._matrix) if n_rows is None else n_rows
+    branch = MemoryStream([], {}, embedding_provider=self.embedding_provider)
+
+    # References into an embedding store are already shared, so a branch of
+    # a shared matrix only copies the references. 
+    if self._matrix.kind == "shared": 
+      branch._matrix = SharedMatrix(self._matrix.store)
+      branch._matrix.store_rows = self._matrix.store_rows[:n_rows].copy()
+      branch._matrix.size = n_rows
+    else: 
+      branch._matrix = ForkedMatrix(self._matrix, n_rows)
+    branch._content_to_row = {content: row for content, row 
+                              in self._content_to_row.items() if row < n_rows}
+
+    for name in ["_node_id", "_type", "_importance", "_created", 
+                 "_last_retrieved", "_embedding_row"]: 
+      setattr(branch, name, _grow(getattr(self, name)[:n_nodes], n_nodes + 16))
+    branch._content = self._content[:n_nodes]
+    branch._pointer_id = self._pointer_id[:n_nodes]
+    branch._id_to_row = {node_id: row for node_id, row 
+                         in self._id_to_row.items() if row < n_nodes}
+    for code, rows in self._partition_rows.items(): 
+      size = int(np.searchsorted(rows[:self._partition_size[code]], n_nodes))
+      branch._partition_rows[code] = _grow(rows[:size], size + 16)
+      branch._partition_size[code] = size
+    branch._size = n_nodes
+    return branch
+
+
+  def get_embedding_refs(self): 
+    """
+    Returns a dictionary from content to the content hash of its vector in 
+    the stream's EmbeddingStore. 
+    """
+    return {content: self._matrix.get_key(row) 
+            for content, row in self._content_to_row.items()}
+
+
+  def get_node(self, node_id): 
+    return ConceptNode(self, self._id_to_row[node_id])
+
+
+  def _add_embedding(self, content, embedding): 
+    """
+    Appending an embedding row for <content> to the embedding matrix. 
+
+    Parameters:
+      content: the str content of the memory record
+      embedding: list of floats
+    Returns: 
+      The row index of the embedding
+    """
+    content = sys.intern(content)
+    if self._matrix.kind == "shared": 
+      row = self._matrix.append_key(content_hash(content), embedding)
+    else: 
+      row = self._matrix.append(embedding)
+    self._content_to_row[content] = row
+    if self.index is not None and not self.index.needs_rebuild(): 
+      self.index.add(row, self._matrix.get(row))
+    return row
+
+
+  def attach_index(self, index=None): 
+    """
+    Attaching an approximate nearest neighbor index to the memory stream. 
+    The index is (re)built lazily at the first retrieval that uses it. 
+
+    Parameters:
+      index: an IVFIndex, or None for an IVFIndex with default settings
+    Returns: 
+      The attached index
+    """
+    if index is None: 
+      index = IVFIndex()
+    if len(index) != len(self._matrix): 
+      index.reset()
+    self.index = index
+    self.version += 1
+    return index
+
+
+  def detach_index(self): 
+    self.index = None
+    self.version += 1
+
+
+  def _candidate_positions(self, curr_filter, curr_rows, static_out, 
+                           focal_embedding, n_count): 
+    """
+    Prefiltering the <curr_rows> partition with the approximate nearest 
+    neighbor index. The candidates are the nodes whose embeddings are in the
+    probed clusters, plus the <n_count> nodes with the highest 
+    query-independent (recency and importance) score, so that nodes that 
+    rank high without relevance are never dropped. 
+
+    Parameters:
+      curr_filter: the node type filter of the partition
+      curr_rows: 1-D numpy array of the partition's rows
+      static_out: 1-D numpy array of the weighted recency and importance 
+        scores, aligned with <curr_rows>
+      focal_embedding: 1-D numpy array 
+      n_count: The number of nodes that we want to retrieve. 
+    Returns: 
+      1-D numpy array of sorted positions into <curr_rows>
+    """
+    if self.index.needs_rebuild(): 
+      self.index.build(self._matrix.to_dense())
+
+    # The candidate embedding rows are looked up in the partition's sorted 
+    # embedding rows, so the cost grows with the number of candidates 
+    # rather than with the partition. 
+    sorted_rows, order = self._embedding_positions(curr_filter, curr_rows)
+    candidate_rows = self.index.search(focal_embedding)
+    starts = np.searchsorted(sorted_rows, candidate_rows, side="left")
+    ends = np.searchsorted(sorted_rows, candidate_rows, side="right")
+    lengths = ends - starts
+    offsets = (np.repeat(ends - np.cumsum(lengths), lengths) 
+               + np.arange(lengths.sum()))
+
+    k = min(n_count, len(curr_rows))
+    return np.union1d(order[offsets], 
+                      np.argpartition(-static_out, k - 1)[:k])
+
+
+  def _embedding_positions(self, curr_filter, curr_rows): 
+    """
+    Returns the embedding rows of the <curr_filter> partition's nodes 
+    (<curr_rows>) in sorted order, and the positions of these nodes in 
+    <curr_rows>. 
+    """
+    if curr_filter not in self._embedding_position_cache: 
+      embedding_rows = self._embedding_row[curr_rows]
+      order = np.argsort(embedding_rows, kind="stable")
+      self._embedding_position_cache[curr_filter] = (embedding_rows[order], 
+                                                     order)
+    return self._embedding_position_cache[curr_filter]
+
+
+  def _append_row(self, node_id, node_type, content, importance, created, 
+                  last_retrieved, pointer_id): 
+    """
+    Appending one node to the parallel arrays. 
+    """
+    if self._size == len(self._node_id): 
+      capacity = max(16, 2 * len(self._node_id))
+      self._node_id = _grow(self._node_id, capacity)
+      self._type = _grow(self._type, capacity)
+      self._importance = _grow(self._importance, capacity)
+      self._created = _grow(self._created, capacity)
+      self._last_retrieved = _grow(self._last_retrieved, capacity)
+      self._embedding_row = _grow(self._embedding_row, capacity)
+
+    content = sys.intern(content)
+    row = self._size
+    code = get_node_type_code(node_type)
+    self._node_id[row] = node_id
+    self._type[row] = code
+    self._importance[row] = importance
+    self._created[row] = created
+    self._last_retrieved[row] = last_retrieved
+    self._embedding_row[row] = self._content_to_row.get(content, -1)
+    self._content += [content]
+    self._pointer_id += [pointer_id]
+    self._id_to_row[node_id] = row
+    self._add_to_partition(code, row)
+    self._size += 1
+    self.version += 1
+    self._recency_cache.clear()
+    self._importance_cache.clear()
+    self._embedding_position_cache.clear()
+
+
+  def _set_last_retrieved(self, rows, time_step): 
+    """
+    Setting the last_retrieved time step of the nodes in <rows>. 
+    """
+    self._last_retrieved[rows] = time_step
+    self._retrieved_rows.update(np.atleast_1d(rows).tolist())
+    self.version += 1
+    self._recency_cache.clear()
+
+
+  def pop_retrieved_updates(self, n_rows): 
+    """
+    Returns a dictionary from node_id to last_retrieved for the first 
+    <n_rows> nodes whose last_retrieved changed since the previous call, and
+    starts tracking changes anew. 
+    """
+    updates = {int(self._node_id[row]): _as_number(self._last_retrieved[row])
+               for row in sorted(self._retrieved_rows) if row < n_rows}
+    self._retrieved_rows = set()
+    return updates
+
+
+  def package_nodes(self, start=0): 
+    """
+    Returns the packaged nodes from row <start> on, in chronological order.
+    """
+    return [ConceptNode(self, row).package() for row in range(start, self._size)]
+
+
+  def extend(self, nodes, contents, vectors, last_retrieved=dict()): 
+    """
+    Appending packaged nodes and the embeddings of their new contents, e.g. 
+    when replaying an agent's memory log. Nodes and contents the stream 
+    already has are skipped, so an entry can be replayed twice. 
+
+    Parameters:
+      nodes: list of packaged nodes
+      contents: list of the str contents of <vectors>
+      vectors: 2-D numpy array of embeddings, aligned with <contents>
+      last_retrieved: dictionary from node_id (int or str) to its new 
+        last_retrieved time step
+    Returns: 
+      None
+    """
+    for content, vector in zip(contents, vectors): 
+      if content not in self._content_to_row: 
+        self._add_embedding(content, vector)
     for node in nodes: 
-      new_node = ConceptNode(node)
-      self.seq_nodes += [new_node]
-      self.id_to_node[new_node.node_id] = new_node
+      if node["node_id"] not in self._id_to_row: 
+        self._append_row(node["node_id"], node["node_type"], node["content"], 
+                         node["importance"], node["created"], 
+                         node["last_retrieved"], node["pointer_id"])
+    for node_id, time_step in last_retrieved.items(): 
+      if int(node_id) in self._id_to_row: 
+        self._last_retrieved[self._id_to_row[int(node_id)]] = time_step
+    self.version += 1
+    self._recency_cache.clear()
+
+
+  def get_recency_scores(self, curr_filter="all"): 
+    """
+    Returns the normalized recency scores of the nodes in the <curr_filter> 
+    partition, aligned with get_partition(curr_filter). The array is cached 
+    and must not be modified by the caller. 
+    """
+    if curr_filter not in self._recency_cache: 
+      curr_rows = self.get_partition(curr_filter)
+      x = extract_recency(self._last_retrieved[curr_rows])
+      self._recency_cache[curr_filter] = normalize_floats(x, 0, 1)
+    return self._recency_cache[curr_filter]
+
+
+  def get_importance_scores(self, curr_filter="all"): 
+    """
+    Returns the normalized importance scores of the nodes in the <curr_filter>
+    partition, aligned with get_partition(curr_filter). The array is cached 
+    and must not be modified by the caller. 
+    """
+    if curr_filter not in self._importance_cache: 
+      curr_rows = self.get_partition(curr_filter)
+      x = extract_importance(self._importance[curr_rows])
+      self._importance_cache[curr_filter] = normalize_floats(x, 0, 1)
+    return self._importance_cache[curr_filter]
+
+
+  def _add_to_partition(self, code, row): 
+    """
+    Appending <row> to the partition of the node type <code>. 
+    """
+    rows = self._partition_rows.get(code, np.zeros(0, dtype=np.int64))
+    size = self._partition_size.get(code, 0)
+    if size == len(rows): 
+      rows = _grow(rows, max(16, 2 * len(rows)))
+    rows[size] = row
+    self._partition_rows[code] = rows
+    self._partition_size[code] = size + 1
+
+
+  def get_partition(self, node_type): 
+    """
+    Returns the rows of all nodes of <node_type> in chronological order. 
+
+    Parameters:
+      node_type: 'all', 'reflection' or 'observation'
+    Returns: 
+      1-D numpy array of row indices
+    """
+    if node_type == "all": 
+      return np.arange(self._size)
+    code = NODE_TYPE_CODES.get(node_type, -1)
+    if code not in self._partition_rows: 
+      return np.zeros(0, dtype=np.int64)
+    return self._partition_rows[code][:self._partition_size[code]]
+
+
+  def count_nodes(self, node_type="all"): 
+    """
+    Counting the number of nodes of <node_type> in the memory stream. 
 
-    self.embeddings = embeddings
+    Parameters:
+      node_type: 'all', 'reflection' or 'observation'
+    Returns: 
+      Count
+    """
+    if node_type == "all": 
+      return self._size
+    return self._partition_size.get(NODE_TYPE_CODES.get(node_type, -1), 0)
 
 
   def count_observations(self): 
@@ -336,15 +907,24 @@ class MemoryStream:
     Returns: 
       Count
     """
-    count = 0
-    for i in self.seq_nodes: 
-      if i.node_type == "observation": 
-        count += 1
-    return count
+    return self.count_nodes("observation")
+
+
+  def count_reflections(self): 
+    """
+    Counting the number of reflections in the memory stream. 
+
+    Parameters:
+      None
+    Returns: 
+      Count
+    """
+    return self.count_nodes("reflection")
 
 
   def retrieve(self, focal_points, time_step, n_count=120, curr_filter="all",
-               hp=[0, 1, 0.5], stateless=True, verbose=False): 
+               hp=[0, 1, 0.5], stateless=True, verbose=False, 
+               sort_by_created=True): 
     """
     Retrieve elements from the memory stream. 
 
@@ -357,76 +937,109 @@ class MemoryStream:
         Acceptable values are 'all', 'reflection', 'observation' 
       hp: Hyperparameter for [recency_w, relevance_w, importance_w]
       verbose: verbose
+      sort_by_created: if False, the nodes are returned from the highest to
+        the lowest retrieval score instead of chronologically
     Returns: 
       retrieved: A dictionary whose keys are a focal_pt query str, and whose
         values are a list of nodes that are retrieved for that query str. 
     """
-    curr_nodes = []
-
     # If the memory stream is empty, we return an empty dictionary.
-    if len(self.seq_nodes) == 0:
+    if self._size == 0:
       return dict()
 
-    # Filtering for the desired node type. curr_filter can be one of the three
-    # elements: 'all', 'reflection', 'observation' 
-    if curr_filter == "all": 
-      curr_nodes = self.seq_nodes
-    else: 
-      for curr_node in self.seq_nodes: 
-        if curr_node.node_type == curr_filter: 
-          curr_nodes += [curr_node]
-
-    # <retrieved> is the main dictionary that we are returning
+    # <retrieved> is the main dictionary that we are returning. All focal 
+    # points are embedded in one request. 
     retrieved = dict() 
-    for focal_pt in focal_points: 
-      # Calculating the component dictionaries and normalizing them.
-      x = extract_recency(curr_nodes)
-      recency_out = normalize_dict_floats(x, 0, 1)
-      x = extract_importance(curr_nodes)
-      importance_out = normalize_dict_floats(x, 0, 1)  
-      x = extract_relevance(curr_nodes, self.embeddings, focal_pt)
-      relevance_out = normalize_dict_floats(x, 0, 1)
-      
-      # Computing the final scores that combines the component values. 
-      master_out = dict()
-      for key in recency_out.keys(): 
-        recency_w = hp[0]
-        relevance_w = hp[1]
-        importance_w = hp[2]
-        master_out[key] = (recency_w * recency_out[key]
-                         + relevance_w * relevance_out[key] 
-                         + importance_w * importance_out[key])
-
-      if verbose: 
-        master_out = top_highest_x_values(master_out, len(master_out.keys()))
-        for key, val in master_out.items(): 
-          print (self.id_to_node[key].content, val)
-          print (recency_w*recency_out[key]*1, 
-                 relevance_w*relevance_out[key]*1, 
-                 importance_w*importance_out[key]*1)
-
-      # Extracting the highest x values.
-      # <master_out> has the key of node.id and value of float. Once we get  
-      # the highest x values, we want to translate the node.id into nodes 
-      # and return the list of nodes.
-      master_out = top_highest_x_values(master_out, n_count)
-      master_nodes = [self.id_to_node[key] for key in list(master_out.keys())]
-
-      # **Sort the master_nodes list by last_retrieved in descending order**
-      master_nodes = sorted(master_nodes, 
-                            key=lambda node: node.created, reverse=False)
+    focal_points = list(focal_points)
+    focal_embeddings = self.embedding_provider.embed(focal_points)
+    for focal_pt, focal_embedding in zip(focal_points, focal_embeddings): 
+      focal_embedding = np.asarray(focal_embedding, dtype=float)
+      top_rows = self.retrieve_rows(focal_embedding, n_count, curr_filter, hp,
+                                    verbose, sort_by_created)
 
       # We do not want to update the last retrieved time_step for these nodes
       # if we are in a stateless mode. 
       if not stateless: 
-        for n in master_nodes: 
-          n.retrieved_time_step = time_step
+        self._set_last_retrieved(top_rows, time_step)
         
-      retrieved[focal_pt] = master_nodes
+      retrieved[focal_pt] = [ConceptNode(self, row) for row in top_rows]
     
     return retrieved 
 
 
+  def retrieve_rows(self, focal_embedding, n_count=120, curr_filter="all", 
+                    hp=[0, 1, 0.5], verbose=False, sort_by_created=True): 
+    """
+    Scoring the memory stream against an already embedded focal point. 
+
+    Parameters:
+      focal_embedding: 1-D numpy array, the embedding of the query sentence
+      n_count: The number of nodes that we want to retrieve. 
+      curr_filter: Filtering the node.type that we want to retrieve. 
+        Acceptable values are 'all', 'reflection', 'observation' 
+      hp: Hyperparameter for [recency_w, relevance_w, importance_w]
+      verbose: verbose
+      sort_by_created: if False, the rows are returned from the highest to 
+        the lowest score
+    Returns: 
+      top_rows: 1-D numpy array of the retrieved rows, sorted by created.
+    """
+    # Filtering for the desired node type. curr_filter can be one of the three
+    # elements: 'all', 'reflection', 'observation' 
+    curr_rows = self.get_partition(curr_filter)
+    if len(curr_rows) == 0: 
+      return curr_rows
+
+    recency_w = hp[0]
+    relevance_w = hp[1]
+    importance_w = hp[2]
+
+    # Calculating the component arrays and normalizing them. Only relevance 
+    # depends on the focal point; recency and importance come from the 
+    # stream's cache. 
+    recency_out = self.get_recency_scores(curr_filter)
+    importance_out = self.get_importance_scores(curr_filter)
+
+    # Large partitions are prefiltered by the approximate nearest neighbor
+    # index (if there is one). <positions> index into <curr_rows>, and all
+    # arrays below are aligned with <rows>. 
+    if self.index is not None and len(curr_rows) >= self.index.min_size: 
+      positions = self._candidate_positions(
+        curr_filter, curr_rows, 
+        recency_w * recency_out + importance_w * importance_out,
+        focal_embedding, n_count)
+      rows = curr_rows[positions]
+      recency_out = recency_out[positions]
+      importance_out = importance_out[positions]
+    else: 
+      rows = curr_rows
+
+    x = extract_relevance(self._matrix, self._embedding_row[rows], 
+                          focal_embedding)
+    relevance_out = normalize_floats(x, 0, 1)
+    
+    # Computing the final scores that combines the component values. 
+    master_out = (recency_w * recency_out
+                  + relevance_w * relevance_out 
+                  + importance_w * importance_out)
+
+    if verbose: 
+      for idx in np.argsort(-master_out, kind="stable"): 
+        print (self._content[rows[idx]], master_out[idx])
+        print (recency_w*recency_out[idx]*1, 
+               relevance_w*relevance_out[idx]*1, 
+               importance_w*importance_out[idx]*1)
+
+    # Extracting the highest x values. The stable sort keeps ties in 
+    # chronological order. 
+    top_rows = rows[np.argsort(-master_out, kind="stable")[:n_count]]
+    if not sort_by_created: 
+      return top_rows
+
+    # **Sort the retrieved rows by created in ascending order**
+    return top_rows[np.argsort(self._created[top_rows], kind="stable")]
+
+
   def _add_node(self, time_step, node_type, content, importance, pointer_id):
     """
     Adding a new node to the memory stream. 
@@ -438,22 +1051,46 @@ class MemoryStream:
       importance: int score of the importance score
       pointer_id: the str of the parent node 
     Returns: 
-      retrieved: A dictionary whose keys are a focal_pt query str, and whose
-        values are a list of nodes that are retrieved for that query str. 
+      None
     """
-    node_dict = dict()
-    node_dict["node_id"] = len(self.seq_nodes)
-    node_dict["node_type"] = node_type
-    node_dict["content"] = content
-    node_dict["importance"] = importance
-    node_dict["created"] = time_step
-    node_dict["last_retrieved"] = time_step
-    node_dict["pointer_id"] = pointer_id
-    new_node = ConceptNode(node_dict)
+    self._add_nodes(time_step, node_type, [content], [importance], pointer_id)
+
 
-    self.seq_nodes += [new_node]
-    self.id_to_node[new_node.node_id] = new_node
-    self.embeddings[content] = get_text_embedding(content)
+  def _add_nodes(self, time_step, node_type, contents, importances, 
+                 pointer_id):
+    """
+    Adding a batch of new nodes to the memory stream. All contents that do 
+    not have an embedding yet are embedded with a single embedding request 
+    before the nodes are appended together. 
+
+    Parameters:
+      time_step: Current time_step 
+      node_type: type of node -- it's either reflection, observation
+      contents: list of str contents of the memory records
+      importances: list of int importance scores, one per content
+      pointer_id: the str of the parent node 
+    Returns: 
+      None
+    """
+    missing = []
+    for content in contents: 
+      if content not in self._content_to_row and content not in missing: 
+        missing += [content]
+
+    # Contents that are already in the population's embedding store are 
+    # referenced instead of embedded again. 
+    if self._matrix.kind == "shared": 
+      for content in list(missing): 
+        if self._matrix.store.has(content_hash(content)): 
+          self._add_embedding(content, None)
+          missing.remove(content)
+    new_embeddings = self.embedding_provider.embed(missing)
+
+    for content, embedding in zip(missing, new_embeddings): 
+      self._add_embedding(content, embedding)
+    for count, content in enumerate(contents): 
+      self._append_row(self._size, node_type, content, importances[count], 
+                       time_step, time_step, pointer_id)
 
 
   def remember(self, content, time_step=0):
@@ -463,14 +1100,13 @@ class MemoryStream:
 
   def reflect(self, anchor, reflection_count=5, 
               retrieval_count=120, time_step=0): 
-    records = self.retrieve([anchor], time_step, retrieval_count)[anchor]
+    records = self.retrieve([anchor], time_step, retrieval_count).get(anchor, [])
     record_ids = [i.node_id for i in records]
     reflections = generate_reflection(records, anchor, reflection_count)
     scores = generate_importance_score(reflections)
 
-    for count, reflection in enumerate(reflections): 
-      self._add_node(time_step, "reflection", reflections[count], 
-                     scores[count], record_ids)
+    self._add_nodes(time_step, "reflection", reflections, scores, record_ids)
+    return reflections
 
 
 
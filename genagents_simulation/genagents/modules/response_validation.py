@@ -0,0 +1,337 @@
+import difflib
+import math
+import re
+import threading
+from collections import OrderedDict
+
+from genagents_simulation.simulation_engine.gpt_structure import RunStats
+
+
+# ##############################################################################
+# ###                           OPTION SNAPPING                              ###
+# ##############################################################################
+
+# Responses whose closest option is less similar than this (difflib ratio of
+# the normalized strings) are not snapped to it.
+FUZZY_MATCH_CUTOFF = 0.8
+
+# The number of option lists whose snappers are kept.
+SNAPPER_CACHE_SIZE = 1024
+
+
+def normalize_option(text):
+  """
+  Normalizing an option or response for matching: case folded, with runs of
+  whitespace collapsed and surrounding whitespace, quotes and punctuation
+  removed.
+  """
+  text = re.sub(r"\s+", " ", str(text)).strip()
+  return text.strip(" \"'“”‘’.,;:!?`*").casefold()
+
+
+class OptionSnapper:
+  """
+  Maps the free-text responses of a model to one of a question's declared
+  options. A lookup table from normalized (and punctuation-free) option to
+  option is built once per option list, and the result of every fuzzy
+  lookup is added to it, so a population's repeated paraphrases are only
+  matched once.
+  """
+  def __init__(self, options):
+    self.options = list(options)
+    self.table = dict()
+    for option in self.options:
+      for key in [str(option), normalize_option(option),
+                  re.sub(r"[^\w ]", "", normalize_option(option))]:
+        self.table.setdefault(key, option)
+    self.keys = list(self.table)
+    self.lock = threading.Lock()
+
+
+  def _fuzzy_match(self, key):
+    # A response that contains one option (e.g. "Yes, definitely"), or
+    # options that are all part of the longest one ("I strongly agree"
+    # contains both "strongly agree" and "agree").
+    contained = [option_key for option_key in self.keys
+                 if option_key and re.search(rf"\b{re.escape(option_key)}\b",
+                                             key)]
+    if contained:
+      longest = max(contained, key=len)
+      if all(option_key in longest for option_key in contained):
+        return self.table[longest]
+    matches = difflib.get_close_matches(key, self.keys, n=2,
+                                        cutoff=FUZZY_MATCH_CUTOFF)
+    if matches and (len(matches) == 1
+                    or self.table[matches[0]] == self.table[matches[1]]):
+      return self.table[matches[0]]
+    return None
+
+
+  def snap(self, response):
+    """
+    Returns the option <response> stands for, or None if it matches no
+    option (or more than one equally).
+    """
+    # Malformed answers (such as a list or an object) match no option.
+    if not isinstance(response, (str, int, float)):
+      return None
+    if response in self.table:
+      return self.table[response]
+    key = normalize_option(response)
+    with self.lock:
+      if key not in self.table:
+        self.table[key] = self._fuzzy_match(key)
+      return self.table[key]
+
+
+_snappers = OrderedDict()
+_snappers_lock = threading.Lock()
+
+
+def get_option_snapper(options):
+  """
+  Returns the (cached) OptionSnapper of an option list.
+  """
+  key = tuple(str(option) for option in options)
+  with _snappers_lock:
+    if key not in _snappers:
+      _snappers[key] = OptionSnapper(options)
+      if len(_snappers) > SNAPPER_CACHE_SIZE:
+        _snappers.popitem(last=False)
+    _snappers.move_to_end(key)
+    return _snappers[key]
+
+
+# ##############################################################################
+# ###                         RESPONSE VALIDATION                            ###
+# ##############################################################################
+
+def validate_categorical_resp(questions, response):
+  """
+  Validating a categorical response against its questions. Every answer is
+  snapped to one of its question's options.
+
+  Parameters:
+    questions: dictionary from question to its list of options
+    response: {"responses", "reasonings"} dictionary, or None
+  Returns:
+    A copy of <response> with the snapped answers, or None if the response
+    does not answer every question with one of its options
+  """
+  if not response or len(response["responses"]) != len(questions):
+    return None
+  responses = []
+  for answer, options in zip(response["responses"], questions.values()):
+    option = get_option_snapper(options).snap(answer)
+    if option is None:
+      return None
+    responses += [option]
+  return {"responses": responses, "reasonings": response["reasonings"]}
+
+
+def parse_numerical_range(range_spec):
+  """
+  Returns the (low, high) bounds of a numerical question's range, given as
+  a pair of numbers or as text such as "0-10" or "1 to 5", or None if the
+  range is not understood.
+  """
+  if isinstance(range_spec, (list, tuple)) and len(range_spec) == 2:
+    try:
+      low, high = float(range_spec[0]), float(range_spec[1])
+    except (TypeError, ValueError):
+      return None
+  else:
+    # A '-' right after a number separates the bounds ("1-5").
+    numbers = re.findall(r"(?<![\d.])-?\d+(?:\.\d+)?", str(range_spec))
+    if len(numbers) != 2:
+      return None
+    low, high = float(numbers[0]), float(numbers[1])
+  return min(low, high), max(low, high)
+
+
+def validate_numerical_resp(questions, response, float_resp=False):
+  """
+  Validating a numerical response against its questions. Every answer must
+  be a number (an integer unless <float_resp>) within its question's range,
+  when the range is understood.
+
+  Parameters:
+    questions: dictionary from question to its range
+    response: {"responses", "reasonings"} dictionary, or None
+    float_resp: whether the answers may be floats
+  Returns:
+    A copy of <response> with the answers as numbers, or None if an answer
+    is missing, not a number or out of range
+  """
+  if not response or len(response["responses"]) != len(questions):
+    return None
+  responses = []
+  for answer, range_spec in zip(response["responses"], questions.values()):
+    try:
+      value = float(answer)
+    except (TypeError, ValueError):
+      return None
+    if not math.isfinite(value):
+      return None
+    if not float_resp:
+      if value != int(value):
+        return None
+      value = int(value)
+    bounds = parse_numerical_range(range_spec)
+    if bounds and not bounds[0] <= value <= bounds[1]:
+      return None
+    responses += [value]
+  return {"responses": responses, "reasonings": response["reasonings"]}
+
+
+def validate_answer(question, answer):
+  """
+  Validating one answer to a questionnaire question (see interaction.ask)
+  by its "response-type": categorical answers are snapped to the
+  "response-options", int and float answers must be numbers within the
+  "response-scale", and open answers are cut to the
+  "response-char-limit".
+
+  Returns:
+    The validated answer, or None if it is not valid
+  """
+  response_type = question["response-type"]
+  if answer is None:
+    return None
+  if response_type == "categorical":
+    return get_option_snapper(question["response-options"]).snap(answer)
+  if response_type in ["int", "float"]:
+    response = validate_numerical_resp(
+      {question["question"]: question.get("response-scale")},
+      {"responses": [answer], "reasonings": [""]},
+      response_type == "float")
+    return response["responses"][0] if response else None
+  if response_type == "open":
+    answer = str(answer).strip()
+    return answer[:question.get("response-char-limit", 200)] or None
+  raise ValueError(f"Unknown response type '{response_type}'.")
+
+
+# ##############################################################################
+# ###                          RESPONSE SCHEMAS                              ###
+# ##############################################################################
+
+def _object_schema(properties):
+  # Structured outputs require every property and no others.
+  return {"type": "object",
+          "properties": properties,
+          "required": list(properties),
+          "additionalProperties": False}
+
+
+def _resp_schema(entries):
+  """
+  Returns the JSON schema of a response object with one entry per question
+  ("1", "2", ...), given the schema of each entry.
+  """
+  return _object_schema({str(count + 1): entry
+                         for count, entry in enumerate(entries)})
+
+
+def categorical_resp_schema(questions):
+  """
+  Returns the JSON schema of the categorical response templates' output for
+  <questions>: one entry per question, whose "Response" must be one of the
+  question's options.
+  """
+  entries = []
+  for question, options in questions.items():
+    options = [str(option) for option in options]
+    per_option = _object_schema({option: {"type": "string"}
+                                 for option in options})
+    entries += [_object_schema({"Q": {"type": "string"},
+                                "Option Interpretation": per_option,
+                                "Option Choice": per_option,
+                                "Reasoning": {"type": "string"},
+                                "Response": {"type": "string",
+                                             "enum": options}})]
+  return _resp_schema(entries)
+
+
+def numerical_resp_schema(questions, float_resp=False):
+  """
+  Returns the JSON schema of the numerical response templates' output for
+  <questions>: one entry per question, whose "Response" must be a number
+  (an integer unless <float_resp>) within the question's range.
+  """
+  entries = []
+  for question, range_spec in questions.items():
+    response = {"type": "number" if float_resp else "integer"}
+    bounds = parse_numerical_range(range_spec)
+    if bounds and not float_resp:
+      bounds = math.ceil(bounds[0]), math.floor(bounds[1])
+    if bounds:
+      response["minimum"], response["maximum"] = bounds
+    entries += [_object_schema({"Q": {"type": "string"},
+                                "Range Interpretation": {"type": "string"},
+                                "Reasoning": {"type": "string"},
+                                "Response": response})]
+  return _resp_schema(entries)
+
+
+def json_schema_response_format(name, schema):
+  """
+  Returns the chat completion response_format that constrains the output to
+  <schema> (structured outputs).
+  """
+  return {"type": "json_schema",
+          "json_schema": {"name": name, "schema": schema, "strict": True}}
+
+
+# ##############################################################################
+# ###                           RESPONSE STATS                               ###
+# ##############################################################################
+
+class ResponseStats(RunStats):
+  """
+  Per-run counts of the parsed interaction responses, the responses that
+  could not be parsed into one answer per question, the requests that
+  were sent again for agents without a valid answer, and the retrievals
+  and requests that raised an error.
+  """
+  def new_counters(self):
+    return {"responses": 0, "parse_failures": 0, "retries": 0,
+            "retrieval_errors": 0, "request_errors": 0}
+
+
+  def record_parse(self, parsed):
+    with self.lock:
+      counters = self.counters()
+      counters["responses"] += 1
+      counters["parse_failures"] += 0 if parsed else 1
+
+
+  def record_retries(self, count):
+    with self.lock:
+      self.counters()["retries"] += count
+
+
+  def record_error(self, kind):
+    """
+    Counting an exception raised by a "retrieval" or a "request".
+    """
+    with self.lock:
+      self.counters()[f"{kind}_errors"] += 1
+
+
+  def package(self):
+    with self.lock:
+      counters = dict(self.counters())
+    responses = counters["responses"]
+    return {
+      "responses": responses,
+      "parse_failures": counters["parse_failures"],
+      "parse_failure_rate": (counters["parse_failures"] / responses
+                             if responses else None),
+      "retries": counters["retries"],
+      "retry_rate": counters["retries"] / responses if responses else None,
+      "retrieval_errors": counters["retrieval_errors"],
+      "request_errors": counters["request_errors"]}
+
+
+response_stats = ResponseStats()
@@ -0,0 +1,230 @@
+import random
+
+from genagents_simulation.genagents.genagents import *
+
+
+# ############################################################################
+# ###                          POPULATION FOLDERS                          ###
+# ############################################################################
+
+def get_agent_folders(population_folder):
+  """
+  Finding all agent folders of a population. An agent folder is a folder
+  that has both a scratch.json and a meta.json. Hidden folders (such as the
+  population's .snapshots) are skipped.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+  Returns:
+    The sorted list of agent folder paths
+  """
+  agent_folders = []
+  for root, dirs, files in os.walk(population_folder):
+    dirs[:] = [d for d in dirs if not d.startswith(".")]
+    if "scratch.json" in files and "meta.json" in files:
+      agent_folders += [root]
+  return sorted(agent_folders)
+
+
+# ############################################################################
+# ###                      UNIT-NORMALIZED EMBEDDINGS                      ###
+# ############################################################################
+
+def normalize_population_embeddings(population_folder, keep_json=False): 
+  """
+  One-shot upgrade of a population saved in the original embeddings.json 
+  format. Every agent that only has an embeddings.json is loaded and saved
+  again, which writes its embeddings as unit-normalized vectors with their
+  norms (embeddings_unit.npz), so they load without parsing or 
+  normalization.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    keep_json: if True, the agents' embeddings.json is kept
+  Returns: 
+    The number of upgraded agents
+  """
+  count = 0
+  for agent_folder in get_agent_folders(population_folder): 
+    memory_stream_folder = f"{agent_folder}/memory_stream"
+    if (not check_if_file_exists(f"{memory_stream_folder}/embeddings.json")
+        or check_if_file_exists(f"{memory_stream_folder}/embeddings_unit.npz")
+        or check_if_file_exists(f"{memory_stream_folder}/embeddings_q.npz")
+        or check_if_file_exists(
+          f"{memory_stream_folder}/embedding_refs.json")): 
+      continue
+    agent = GenerativeAgent(agent_folder)
+    agent.save(agent_folder, compact=True)
+    if not keep_json: 
+      os.remove(f"{memory_stream_folder}/embeddings.json")
+    count += 1
+  return count
+
+
+# ############################################################################
+# ###                        EMBEDDING QUANTIZATION                        ###
+# ############################################################################
+
+def quantize_population(population_folder, kind="int8",
+                        keep_full_precision=True, **kwargs):
+  """
+  Converting the stored embeddings of every agent in a population to the
+  <kind> format.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    kind: 'float', 'int8' or 'pq'
+    keep_full_precision: if False, the agents' full precision embeddings
+      (embeddings_unit.npz or embeddings.json) are deleted once the 
+      quantized embeddings are saved
+    kwargs: PQMatrix.train keyword arguments
+  Returns:
+    The number of converted agents
+  """
+  count = 0
+  for agent_folder in get_agent_folders(population_folder):
+    agent = GenerativeAgent(agent_folder)
+    if len(agent.memory_stream.matrix) == 0:
+      continue
+    agent.memory_stream.quantize(kind, **kwargs)
+    agent.save(agent_folder)
+
+    if kind != "float" and not keep_full_precision: 
+      remove_agent_files(agent_folder, FULL_PRECISION_FILES)
+    count += 1
+  return count
+
+
+def quantization_report(population_folder, kinds=["int8", "pq"], k=120,
+                        n_queries=20, n_agents=50, seed=0, **kwargs):
+  """
+  Comparing retrieval on quantized embeddings with full precision retrieval
+  for a sample of a population's agents. The queries are stored memory
+  embeddings, and each query's top-<k> retrieved nodes (with the default
+  recency/relevance/importance weights) are compared with the full
+  precision top-<k>.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    kinds: the quantized formats to evaluate
+    k: the number of retrieved nodes to compare
+    n_queries: the number of queries per agent
+    n_agents: the number of sampled agents
+    seed: random seed for the agent and query samples
+    kwargs: PQMatrix.train keyword arguments
+  Returns:
+    A dictionary from format to its mean and minimum top-k overlap, its
+    stored bytes, and its compression ratio against full precision
+  """
+  rng = random.Random(seed)
+  agent_folders = get_agent_folders(population_folder)
+  agent_folders = rng.sample(agent_folders, min(n_agents, len(agent_folders)))
+
+  overlaps = {kind: [] for kind in kinds}
+  nbytes = {kind: 0 for kind in ["float"] + kinds}
+  for agent_folder in agent_folders:
+    stream = GenerativeAgent(agent_folder).memory_stream
+    if len(stream.matrix) == 0:
+      continue
+    full_precision = quantize_matrix(stream.matrix, "float")
+    nbytes["float"] += full_precision.nbytes()
+    nodes = [node.package() for node in stream.seq_nodes]
+    contents = stream.get_contents_by_row()
+    query_rows = rng.sample(range(len(full_precision)),
+                            min(n_queries, len(full_precision)))
+
+    exact_stream = MemoryStream(nodes, contents, full_precision)
+    for kind in kinds:
+      quantized = quantize_matrix(full_precision, kind, **kwargs)
+      nbytes[kind] += quantized.nbytes()
+      quantized_stream = MemoryStream(nodes, contents, quantized)
+      for row in query_rows:
+        query = full_precision.get(row)
+        exact = set(exact_stream.retrieve_rows(query, k).tolist())
+        approx = set(quantized_stream.retrieve_rows(query, k).tolist())
+        overlaps[kind] += [len(exact & approx) / len(exact)]
+
+  report = dict()
+  for kind in ["float"] + kinds:
+    kind_overlaps = overlaps.get(kind, [1.0])
+    report[kind] = {
+      "mean_overlap": average(kind_overlaps) if kind_overlaps else None,
+      "min_overlap": min(kind_overlaps) if kind_overlaps else None,
+      "bytes": nbytes[kind],
+      "compression": (nbytes["float"] / nbytes[kind]
+                      if nbytes[kind] else None)}
+  return report
+
+
+# ############################################################################
+# ###                       SHARED EMBEDDING STORE                         ###
+# ############################################################################
+
+def migrate_to_embedding_store(population_folder, store_folder=None): 
+  """
+  Moving the embeddings of every agent in a population into one 
+  content-addressed EmbeddingStore. Each agent's full precision (and 
+  quantized, if any) embeddings is replaced by a memory_stream/
+  embedding_refs.json that references the store by content hash. 
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    store_folder: path to the store, <population_folder>/embedding_store by
+      default
+  Returns: 
+    A dictionary with the number of migrated agents, the number of 
+    referenced vectors and the number of distinct vectors in the store
+  """
+  store_folder = store_folder or f"{population_folder}/embedding_store"
+  store = get_embedding_store(store_folder)
+
+  agent_count = 0
+  ref_count = 0
+  for agent_folder in get_agent_folders(population_folder): 
+    agent = GenerativeAgent(agent_folder)
+    if agent.memory_stream.matrix.kind != "shared": 
+      agent.memory_stream.share_embeddings(store)
+    agent.save(agent_folder)
+
+    remove_agent_files(agent_folder, 
+                       FULL_PRECISION_FILES + QUANTIZED_FILES)
+    agent_count += 1
+    ref_count += len(agent.memory_stream.matrix)
+
+  store.save()
+  return {"agents": agent_count, 
+          "references": ref_count, 
+          "vectors": len(store)}
+
+
+# ############################################################################
+# ###                          EMBEDDING PROVIDERS                         ###
+# ############################################################################
+
+def reembed_population(population_folder, embedding_model): 
+  """
+  Converting a population to another embedding provider. Every agent's 
+  memories are embedded again with <embedding_model> and saved in full 
+  precision (quantize or migrate to a shared store again afterwards if 
+  needed), and the population records the new model in population.json. 
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    embedding_model: e.g. 'openai/text-embedding-3-small' or 
+      'local/hashing-1024'
+  Returns: 
+    The number of converted agents
+  """
+  embedding_provider = get_embedding_provider(embedding_model)
+  count = 0
+  for agent_folder in get_agent_folders(population_folder): 
+    agent = GenerativeAgent(agent_folder)
+    if agent.memory_stream.embedding_provider.name != embedding_provider.name: 
+      agent.memory_stream.reembed(embedding_provider)
+      agent.save(agent_folder)
+      count += 1
+
+  meta = read_population_meta(population_folder)
+  meta["embedding_model"] = embedding_provider.name
+  write_population_meta(population_folder, meta)
+  return count
@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from genagents_simulation.genagents.genagents import *
+
+
+# ############################################################################
+# ###                           QUESTION GROUPS                            ###
+# ############################################################################
+
+# The kinds of question groups, with the shape of their "questions": a
+# dictionary from question to its options (categorical) or range
+# (numerical), or a list of question dictionaries (questionnaire, see ask).
+QUESTION_GROUP_TYPES = ["categorical", "numerical", "questionnaire"]
+
+
+def validate_question_group(group):
+  """
+  Raises a ValueError if <group> is not a {"type", "questions"} dictionary
+  whose questions match its type.
+  """
+  if not isinstance(group, dict) or group.get("type") not in \
+     QUESTION_GROUP_TYPES:
+    raise ValueError(f"A question group needs a 'type' in "
+                     f"{QUESTION_GROUP_TYPES}.")
+  questions = group.get("questions")
+  if group["type"] == "questionnaire":
+    if not isinstance(questions, list) or not questions:
+      raise ValueError("A questionnaire group needs a non-empty "
+                       "'questions' list.")
+  elif not isinstance(questions, dict) or not questions:
+    raise ValueError(f"A {group['type']} group needs a non-empty "
+                     f"'questions' dictionary.")
+
+
+def _ask_group(agent, group, token_budget, prompt_version, stream,
+               structured, retries):
+  """
+  Asking <agent> one question group, sending the request again up to
+  <retries> times while the response does not validate.
+
+  Returns:
+    The validated response (see run_question_groups), or None
+  """
+  questions = group["questions"]
+  if group["type"] == "questionnaire":
+    return ask(agent, questions, token_budget, prompt_version, stream,
+               retries=retries)
+
+  for attempt in range(1 + retries):
+    if attempt:
+      response_stats.record_retries(1)
+    if group["type"] == "categorical":
+      response = validate_categorical_resp(
+        questions, categorical_resp(agent, questions, token_budget,
+                                    prompt_version, stream, structured))
+    else:
+      float_resp = group.get("float_resp", False)
+      response = validate_numerical_resp(
+        questions, numerical_resp(agent, questions, float_resp,
+                                  token_budget, prompt_version, stream,
+                                  structured),
+        float_resp)
+    if response is not None:
+      return response
+  return None
+
+
+def run_question_groups(agents, groups, token_budget=None,
+                        prompt_version="1", stream=False, structured=False,
+                        retries=2, max_workers=MAX_WORKERS, on_response=None):
+  """
+  Asking every agent of a sample many question groups in one job. For each
+  agent, the memories of all the groups' anchors are retrieved in one
+  batched MemoryStream.retrieve call (see prepare_agent_descs), and every
+  group's prompt is rendered from these shared descriptions. All requests
+  of the job go through one thread pool: an agent's groups are submitted as
+  soon as its descriptions are ready, so the sample is prepared once while
+  the requests of other agents keep the pool at full concurrency.
+
+  Parameters:
+    agents: list of GenerativeAgent
+    groups: list of {"type", "questions"} question groups, where "type" is
+      one of QUESTION_GROUP_TYPES; numerical groups may set "float_resp"
+    token_budget: token budget of the agent descriptions (None for no
+      limit)
+    prompt_version: the template version of the requests
+    stream: whether responses are streamed and cut off after their JSON
+    structured: whether categorical and numerical responses are constrained
+      to the questions' JSON schema
+    retries: the number of times an invalid response is asked again
+    max_workers: the maximum number of requests in flight
+    on_response: optional function called with (group index, agent index,
+      response) for every valid response, as it arrives
+  Returns:
+    A list aligned with <groups> of lists aligned with <agents>: the
+    validated {"responses", "reasonings"} of categorical and numerical
+    groups (None if no valid response was given), and the answers of ask
+    for questionnaire groups. A cell whose request raised an error is None;
+    the errors are counted in response_stats.
+  """
+  for group in groups:
+    validate_question_group(group)
+  anchors = [question_group_anchor(group["questions"]) for group in groups]
+  results = [[None] * len(agents) for _ in groups]
+
+  def _run(group_idx, agent_idx):
+    # An error is confined to its own cell, which stays None, so that the
+    # other requests of the job keep their results.
+    try:
+      response = _ask_group(agents[agent_idx], groups[group_idx],
+                            token_budget, prompt_version, stream, structured,
+                            retries)
+    except Exception:
+      response_stats.record_error("request")
+      return
+    results[group_idx][agent_idx] = response
+    if response is not None and on_response:
+      on_response(group_idx, agent_idx, response)
+
+  if not agents or not groups:
+    return results
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # The workers make their requests in the caller's scheduler run.
+    prepared = {executor.submit(in_current_run(prepare_agent_descs), agent,
+                                anchors, token_budget): agent_idx
+                for agent_idx, agent in enumerate(agents)}
+    requests = []
+    for future in as_completed(prepared):
+      # A failed retrieval is left to the requests, which render their
+      # descriptions themselves.
+      if future.exception() is not None:
+        response_stats.record_error("retrieval")
+      requests += [executor.submit(in_current_run(_run), group_idx,
+                                   prepared[future])
+                   for group_idx in range(len(groups))]
+    for future in requests:
+      future.result()
+  return results
@@ -0,0 +1,333 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from genagents_simulation.genagents.population import *
+
+
+# ############################################################################
+# ###                            CHUNK STORAGE                             ###
+# ############################################################################
+
+# Files are stored as content-addressed chunks of at most this many bytes, so
+# that a file that only grew (such as an agent's memory log) shares all but
+# its last chunks with its earlier versions.
+SNAPSHOT_CHUNK_SIZE = 1 << 20
+
+# Files modified this recently (in seconds) before a snapshot are hashed
+# again even if their size and modification time did not change, since a
+# write in the same clock tick would not change the modification time.
+RACY_MTIME_WINDOW = 2
+
+
+def get_snapshot_folder(population_folder):
+  return f"{population_folder}/.snapshots"
+
+
+def _chunk_file_name(snapshot_folder, chunk_hash):
+  return f"{snapshot_folder}/chunks/{chunk_hash[:2]}/{chunk_hash}"
+
+
+def write_chunk(snapshot_folder, data):
+  """
+  Storing <data> as a compressed chunk named by its hash, unless the store
+  already has it.
+
+  Parameters:
+    snapshot_folder: path to the population's snapshot folder
+    data: bytes
+  Returns:
+    The chunk's hash
+  """
+  chunk_hash = hashlib.sha256(data).hexdigest()
+  chunk_file_name = _chunk_file_name(snapshot_folder, chunk_hash)
+  if not os.path.exists(chunk_file_name):
+    os.makedirs(os.path.dirname(chunk_file_name), exist_ok=True)
+    with open(f"{chunk_file_name}.tmp", "wb") as chunk_file:
+      chunk_file.write(zlib.compress(data))
+    os.replace(f"{chunk_file_name}.tmp", chunk_file_name)
+  return chunk_hash
+
+
+def read_chunk(snapshot_folder, chunk_hash):
+  with open(_chunk_file_name(snapshot_folder, chunk_hash), "rb") as chunk_file:
+    return zlib.decompress(chunk_file.read())
+
+
+def _write_json_chunk(snapshot_folder, data):
+  return write_chunk(snapshot_folder,
+                     json.dumps(data, sort_keys=True).encode("utf-8"))
+
+
+def _read_json_chunk(snapshot_folder, chunk_hash):
+  return json.loads(read_chunk(snapshot_folder, chunk_hash))
+
+
+# ############################################################################
+# ###                           POPULATION TREE                            ###
+# ############################################################################
+
+def _list_files(population_folder):
+  """
+  Returns the sorted paths (relative to <population_folder>) of the files of
+  a population, leaving out hidden folders such as the snapshot folder and
+  temporary files of interrupted writes.
+  """
+  file_names = []
+  for root, dirs, files in os.walk(population_folder):
+    dirs[:] = [d for d in dirs if not d.startswith(".")]
+    for file_name in files:
+      if not file_name.endswith(".tmp"):
+        file_names += [os.path.relpath(os.path.join(root, file_name),
+                                       population_folder)]
+  return sorted(file_names)
+
+
+def _read_stat_cache(snapshot_folder):
+  if not os.path.exists(f"{snapshot_folder}/stat_cache.json"):
+    return dict()
+  with open(f"{snapshot_folder}/stat_cache.json") as json_file:
+    return json.load(json_file)
+
+
+def _write_stat_cache(snapshot_folder, stat_cache):
+  with open(f"{snapshot_folder}/stat_cache.json.tmp", "w") as json_file:
+    json.dump(stat_cache, json_file)
+  os.replace(f"{snapshot_folder}/stat_cache.json.tmp",
+             f"{snapshot_folder}/stat_cache.json")
+
+
+def _hash_tree(population_folder, store_chunks):
+  """
+  Computing the chunk hashes of every file of a population. Files whose size
+  and modification time match the stat cache are not read.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    store_chunks: if True, the chunks of changed files are stored
+  Returns:
+    A dictionary from relative file path to its list of chunk hashes
+  """
+  snapshot_folder = get_snapshot_folder(population_folder)
+  stat_cache = _read_stat_cache(snapshot_folder)
+  racy_before = time.time_ns() - RACY_MTIME_WINDOW * 10**9
+
+  tree = dict()
+  new_stat_cache = dict()
+  for rel_path in _list_files(population_folder):
+    stat = os.stat(os.path.join(population_folder, rel_path))
+    cached = stat_cache.get(rel_path)
+    if (cached is not None and cached[0] == stat.st_size
+        and cached[1] == stat.st_mtime_ns and stat.st_mtime_ns < racy_before
+        and (not store_chunks or cached[3])):
+      chunks = cached[2]
+    else:
+      chunks = []
+      with open(os.path.join(population_folder, rel_path), "rb") as data_file:
+        while True:
+          data = data_file.read(SNAPSHOT_CHUNK_SIZE)
+          if not data and chunks:
+            break
+          if store_chunks:
+            chunks += [write_chunk(snapshot_folder, data)]
+          else:
+            chunks += [hashlib.sha256(data).hexdigest()]
+          if not data:
+            break
+    tree[rel_path] = chunks
+    new_stat_cache[rel_path] = [stat.st_size, stat.st_mtime_ns, chunks,
+                                store_chunks or bool(cached and cached[3])]
+
+  os.makedirs(snapshot_folder, exist_ok=True)
+  _write_stat_cache(snapshot_folder, new_stat_cache)
+  return tree
+
+
+def _split_tree(population_folder, tree):
+  """
+  Grouping a population's files by agent folder.
+
+  Returns:
+    (agents, files) where agents is a dictionary from relative agent folder
+    to a dictionary of its files (relative to the agent folder) and their
+    chunk hashes, and files holds the files outside of agent folders
+  """
+  agents = {os.path.relpath(agent_folder, population_folder): dict()
+            for agent_folder in get_agent_folders(population_folder)}
+  files = dict()
+  for rel_path, chunks in tree.items():
+    # The file belongs to the innermost agent folder among its parents.
+    parts = rel_path.split("/")
+    for depth in range(len(parts) - 1, 0, -1):
+      agent_folder = "/".join(parts[:depth])
+      if agent_folder in agents:
+        agents[agent_folder]["/".join(parts[depth:])] = chunks
+        break
+    else:
+      files[rel_path] = chunks
+  return agents, files
+
+
+# ############################################################################
+# ###                              SNAPSHOTS                               ###
+# ############################################################################
+
+def snapshot_population(population_folder, message=""):
+  """
+  Taking a snapshot of a population. File contents are stored as
+  content-addressed chunks in <population_folder>/.snapshots, so a snapshot
+  only adds the chunks of files that changed since an earlier snapshot
+  (plus one small listing per changed agent), and unchanged files are not
+  read again.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    message: a description of the snapshot
+  Returns:
+    The snapshot id
+  """
+  snapshot_folder = get_snapshot_folder(population_folder)
+  agents, files = _split_tree(population_folder,
+                              _hash_tree(population_folder, True))
+
+  created = datetime.datetime.now().isoformat(timespec="seconds")
+  manifest = {"created": created,
+              "message": message,
+              "agents": {agent_folder: _write_json_chunk(snapshot_folder,
+                                                         agent_files)
+                         for agent_folder, agent_files in agents.items()},
+              "files": files}
+  snapshot_id = hashlib.sha256(
+    json.dumps(manifest, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+  manifest["id"] = snapshot_id
+
+  os.makedirs(f"{snapshot_folder}/manifests", exist_ok=True)
+  with open(f"{snapshot_folder}/manifests/{snapshot_id}.json.tmp",
+            "w") as json_file:
+    json.dump(manifest, json_file)
+  os.replace(f"{snapshot_folder}/manifests/{snapshot_id}.json.tmp",
+             f"{snapshot_folder}/manifests/{snapshot_id}.json")
+  return snapshot_id
+
+
+def read_snapshot_manifest(population_folder, snapshot_id):
+  manifest_file = (f"{get_snapshot_folder(population_folder)}/manifests/"
+                   f"{snapshot_id}.json")
+  if not os.path.exists(manifest_file):
+    raise ValueError(f"Population has no snapshot '{snapshot_id}'.")
+  with open(manifest_file) as json_file:
+    return json.load(json_file)
+
+
+def list_snapshots(population_folder):
+  """
+  Returns the id, creation time, message and agent count of every snapshot
+  of a population, oldest first.
+  """
+  manifest_folder = f"{get_snapshot_folder(population_folder)}/manifests"
+  if not os.path.exists(manifest_folder):
+    return []
+  snapshots = []
+  for file_name in os.listdir(manifest_folder):
+    if file_name.endswith(".json"):
+      manifest = read_snapshot_manifest(population_folder, file_name[:-5])
+      snapshots += [{"id": manifest["id"],
+                     "created": manifest["created"],
+                     "message": manifest["message"],
+                     "agents": len(manifest["agents"])}]
+  return sorted(snapshots, key=lambda snapshot: snapshot["created"])
+
+
+def _diff_dicts(old, new):
+  return {"added": sorted(set(new) - set(old)),
+          "removed": sorted(set(old) - set(new)),
+          "changed": sorted(key for key in set(old) & set(new)
+                            if old[key] != new[key])}
+
+
+def diff_snapshots(population_folder, old_snapshot_id, new_snapshot_id=None):
+  """
+  Comparing two snapshots of a population by their manifests. Agents are
+  compared by the hash of their file listing, so no agent is loaded.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    old_snapshot_id: the snapshot to compare from
+    new_snapshot_id: the snapshot to compare to, or None for the current
+      state of the population folder
+  Returns:
+    A dictionary with the "added", "removed" and "changed" relative agent
+    folders under "agents", and the same for the other files under "files"
+  """
+  old = read_snapshot_manifest(population_folder, old_snapshot_id)
+  if new_snapshot_id is None:
+    snapshot_folder = get_snapshot_folder(population_folder)
+    agents, files = _split_tree(population_folder,
+                                _hash_tree(population_folder, False))
+    new = {"agents": {agent_folder: hashlib.sha256(json.dumps(
+                        agent_files, sort_keys=True).encode("utf-8")
+                        ).hexdigest()
+                      for agent_folder, agent_files in agents.items()},
+           "files": files}
+  else:
+    new = read_snapshot_manifest(population_folder, new_snapshot_id)
+  return {"agents": _diff_dicts(old["agents"], new["agents"]),
+          "files": _diff_dicts(old["files"], new["files"])}
+
+
+def restore_snapshot(population_folder, snapshot_id):
+  """
+  Restoring a population folder to a snapshot. Only the files that differ
+  from the snapshot are written or deleted; unchanged files are recognized
+  by their cached size and modification time and not read. Agents loaded
+  in this process before the restore are not updated.
+
+  Parameters:
+    population_folder: path to agent_bank/populations/<name>
+    snapshot_id: the id of the snapshot to restore
+  Returns:
+    A dictionary with the number of "written" and "deleted" files
+  """
+  snapshot_folder = get_snapshot_folder(population_folder)
+  manifest = read_snapshot_manifest(population_folder, snapshot_id)
+  current = _hash_tree(population_folder, False)
+
+  target = dict(manifest["files"])
+  for agent_folder, tree_hash in manifest["agents"].items():
+    for rel_path, chunks in _read_json_chunk(snapshot_folder,
+                                             tree_hash).items():
+      target[f"{agent_folder}/{rel_path}"] = chunks
+
+  written = 0
+  for rel_path, chunks in target.items():
+    if current.get(rel_path) == chunks:
+      continue
+    file_name = os.path.join(population_folder, rel_path)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(f"{file_name}.tmp", "wb") as data_file:
+      for chunk_hash in chunks:
+        data_file.write(read_chunk(snapshot_folder, chunk_hash))
+    os.replace(f"{file_name}.tmp", file_name)
+    written += 1
+
+  deleted = 0
+  for rel_path in set(current) - set(target):
+    os.remove(os.path.join(population_folder, rel_path))
+    deleted += 1
+    # Removing the folders that the deletion left empty.
+    folder = os.path.dirname(os.path.join(population_folder, rel_path))
+    while (os.path.abspath(folder) != os.path.abspath(population_folder)
+           and not os.listdir(folder)):
+      os.rmdir(folder)
+      folder = os.path.dirname(folder)
+
+  # Restored files are recorded as stored, so the next snapshot reuses them.
+  stat_cache = _read_stat_cache(snapshot_folder)
+  for rel_path in target:
+    if rel_path in stat_cache and stat_cache[rel_path][2] == target[rel_path]:
+      stat_cache[rel_path][3] = True
+  _write_stat_cache(snapshot_folder, stat_cache)
+  return {"written": written, "deleted": deleted}
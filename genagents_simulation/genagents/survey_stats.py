@@ -0,0 +1,345 @@
+import math
+
+from genagents_simulation.genagents.modules.response_validation import *
+
+
+# ############################################################################
+# ###                           RUNNING MOMENTS                            ###
+# ############################################################################
+
+class RunningStats:
+  """
+  Count, mean, variance, minimum and maximum of a stream of values, updated
+  with Welford's algorithm and merged with Chan et al.'s parallel formula,
+  so shards of a population can be summarized separately and combined.
+  """
+  def __init__(self):
+    self.count = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+    self.min = None
+    self.max = None
+
+
+  def add(self, value):
+    self.count += 1
+    delta = value - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (value - self.mean)
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+
+  def merge(self, other):
+    if not other.count:
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.mean += delta * other.count / count
+    self.m2 += other.m2 + delta * delta * self.count * other.count / count
+    self.count = count
+    self.min = other.min if self.min is None else min(self.min, other.min)
+    self.max = other.max if self.max is None else max(self.max, other.max)
+
+
+  def variance(self):
+    """
+    Returns the sample variance, or None for fewer than two values.
+    """
+    return self.m2 / (self.count - 1) if self.count > 1 else None
+
+
+  def package(self):
+    return {"count": self.count, "mean": self.mean, "m2": self.m2,
+            "min": self.min, "max": self.max}
+
+
+  @classmethod
+  def from_package(cls, package):
+    stats = cls()
+    for key in ["count", "mean", "m2", "min", "max"]:
+      setattr(stats, key, package[key])
+    return stats
+
+
+# ############################################################################
+# ###                              HISTOGRAM                               ###
+# ############################################################################
+
+# Ranges with more integer values than this are binned more coarsely.
+MAX_HISTOGRAM_BINS = 20
+
+
+class Histogram:
+  """
+  Fixed-bin histogram over a question's range. Integer ranges get one bin
+  per value when they have at most <max_bins> values. Values outside the
+  range are counted in the first or last bin.
+  """
+  def __init__(self, low, high, integer=True, max_bins=MAX_HISTOGRAM_BINS):
+    self.low = low
+    self.high = high
+    self.integer = integer
+    if integer and high - low + 1 <= max_bins:
+      self.n_bins = int(high - low + 1)
+      self.width = 1
+    else:
+      self.n_bins = max_bins
+      self.width = (high - low) / max_bins or 1
+    self.counts = [0] * self.n_bins
+
+
+  def add(self, value):
+    if self.integer and self.width == 1:
+      index = int(round(value - self.low))
+    else:
+      index = int((value - self.low) // self.width)
+    self.counts[min(max(index, 0), self.n_bins - 1)] += 1
+
+
+  def merge(self, other):
+    if (other.low, other.high, other.n_bins) != (self.low, self.high,
+                                                 self.n_bins):
+      raise ValueError("Histograms with different bins cannot be merged.")
+    self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+
+
+  def bins(self):
+    """
+    Returns the label of every bin: its value for integer bins of width
+    one, and its "[start, end)" interval otherwise.
+    """
+    if self.integer and self.width == 1:
+      return [str(int(self.low) + index) for index in range(self.n_bins)]
+    return [f"[{self.low + index * self.width:g}, "
+            f"{self.low + (index + 1) * self.width:g})"
+            for index in range(self.n_bins)]
+
+
+  def package(self):
+    return {"low": self.low, "high": self.high, "integer": self.integer,
+            "n_bins": self.n_bins, "width": self.width,
+            "counts": self.counts}
+
+
+  @classmethod
+  def from_package(cls, package):
+    histogram = cls(package["low"], package["high"], package["integer"])
+    histogram.n_bins = package["n_bins"]
+    histogram.width = package["width"]
+    histogram.counts = list(package["counts"])
+    return histogram
+
+
+# ############################################################################
+# ###                           QUANTILE SKETCH                            ###
+# ############################################################################
+
+class QuantileSketch:
+  """
+  Mergeable quantile sketch with relative accuracy guarantees (DDSketch):
+  a value x > 0 is counted in bucket ceil(log_gamma(x)), with gamma =
+  (1 + alpha) / (1 - alpha), so every returned quantile is within a factor
+  of alpha of the true one. Negative values are kept in a mirrored store
+  and zeros apart. Memory is bounded by <max_buckets> per store (the
+  lowest buckets are collapsed when it is exceeded), and two sketches with
+  the same alpha merge exactly by adding their bucket counts.
+  """
+  def __init__(self, alpha=0.01, max_buckets=2048):
+    self.alpha = alpha
+    self.max_buckets = max_buckets
+    self.gamma = (1 + alpha) / (1 - alpha)
+    self.log_gamma = math.log(self.gamma)
+    self.positive = dict()
+    self.negative = dict()
+    self.zeros = 0
+    self.count = 0
+
+
+  def _key(self, value):
+    return math.ceil(math.log(value) / self.log_gamma)
+
+
+  def _value(self, key):
+    # The bucket's midpoint in relative terms.
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+
+  def _collapse(self, store):
+    while len(store) > self.max_buckets:
+      lowest, second = sorted(store)[:2]
+      store[second] += store.pop(lowest)
+
+
+  def add(self, value):
+    self.count += 1
+    if value > 0:
+      key = self._key(value)
+      self.positive[key] = self.positive.get(key, 0) + 1
+      self._collapse(self.positive)
+    elif value < 0:
+      key = self._key(-value)
+      self.negative[key] = self.negative.get(key, 0) + 1
+      self._collapse(self.negative)
+    else:
+      self.zeros += 1
+
+
+  def merge(self, other):
+    if other.alpha != self.alpha:
+      raise ValueError("Sketches with different accuracies cannot be merged.")
+    for store, other_store in [(self.positive, other.positive),
+                               (self.negative, other.negative)]:
+      for key, count in other_store.items():
+        store[key] = store.get(key, 0) + count
+      self._collapse(store)
+    self.zeros += other.zeros
+    self.count += other.count
+
+
+  def quantile(self, q):
+    """
+    Returns the <q>-quantile (0 <= q <= 1) of the added values, or None if
+    there are none.
+    """
+    if not self.count:
+      return None
+    rank = q * (self.count - 1)
+    seen = 0
+    for key in sorted(self.negative, reverse=True):
+      seen += self.negative[key]
+      if seen > rank:
+        return -self._value(key)
+    seen += self.zeros
+    if seen > rank:
+      return 0.0
+    for key in sorted(self.positive):
+      seen += self.positive[key]
+      if seen > rank:
+        return self._value(key)
+    return self._value(max(self.positive))
+
+
+  def package(self):
+    # JSON object keys are strings, so the stores are kept as pairs.
+    return {"alpha": self.alpha, "max_buckets": self.max_buckets,
+            "positive": sorted(self.positive.items()),
+            "negative": sorted(self.negative.items()),
+            "zeros": self.zeros, "count": self.count}
+
+
+  @classmethod
+  def from_package(cls, package):
+    sketch = cls(package["alpha"], package["max_buckets"])
+    sketch.positive = {key: count for key, count in package["positive"]}
+    sketch.negative = {key: count for key, count in package["negative"]}
+    sketch.zeros = package["zeros"]
+    sketch.count = package["count"]
+    return sketch
+
+
+# ############################################################################
+# ###                         NUMERICAL QUESTIONS                          ###
+# ############################################################################
+
+# The quantiles reported for every numerical question.
+SUMMARY_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class NumericalQuestionStats:
+  """
+  Constant-memory summary of the answers to one numerical question: running
+  moments, a histogram over the question's range and a quantile sketch. It
+  is packaged to JSON and merged with the summaries of other shards.
+  """
+  def __init__(self, range_spec, float_resp=False):
+    self.range_spec = range_spec
+    self.float_resp = float_resp
+    low, high = parse_numerical_range(range_spec) or (0, 1)
+    self.moments = RunningStats()
+    self.histogram = Histogram(low, high, integer=not float_resp)
+    self.sketch = QuantileSketch()
+
+
+  def add(self, value):
+    self.moments.add(value)
+    self.histogram.add(value)
+    self.sketch.add(value)
+
+
+  def merge(self, other):
+    self.moments.merge(other.moments)
+    self.histogram.merge(other.histogram)
+    self.sketch.merge(other.sketch)
+
+
+  def quantile(self, q):
+    """
+    Returns the sketch's <q>-quantile, clamped to the observed minimum and
+    maximum, and rounded for integer questions.
+    """
+    value = self.sketch.quantile(q)
+    if value is None:
+      return None
+    value = min(max(value, self.moments.min), self.moments.max)
+    return value if self.float_resp else int(round(value))
+
+
+  def summary(self):
+    """
+    Returns the distribution statistics of the answers.
+    """
+    variance = self.moments.variance()
+    total = sum(self.histogram.counts)
+    return {
+      "count": self.moments.count,
+      "mean": self.moments.mean if self.moments.count else None,
+      "variance": variance,
+      "std": math.sqrt(variance) if variance is not None else None,
+      "min": self.moments.min,
+      "max": self.moments.max,
+      "quantiles": {f"p{round(q * 100)}": self.quantile(q)
+                    for q in SUMMARY_QUANTILES},
+      "histogram": dict(zip(self.histogram.bins(), self.histogram.counts)),
+      "visual": {label: f"{'█' * int(count / total * 20)} {count}/{total}"
+                 for label, count in zip(self.histogram.bins(),
+                                         self.histogram.counts)}
+                if total else {}}
+
+
+  def package(self):
+    return {"range": self.range_spec, "float_resp": self.float_resp,
+            "moments": self.moments.package(),
+            "histogram": self.histogram.package(),
+            "sketch": self.sketch.package()}
+
+
+  @classmethod
+  def from_package(cls, package):
+    stats = cls(package["range"], package["float_resp"])
+    stats.moments = RunningStats.from_package(package["moments"])
+    stats.histogram = Histogram.from_package(package["histogram"])
+    stats.sketch = QuantileSketch.from_package(package["sketch"])
+    return stats
+
+
+def merge_numerical_summaries(packages):
+  """
+  Merging the packaged per-question statistics of several shards of a
+  numerical survey.
+
+  Parameters:
+    packages: list of dictionaries from question to its packaged
+      NumericalQuestionStats
+  Returns:
+    A dictionary from question to its merged NumericalQuestionStats
+  """
+  merged = dict()
+  for package in packages:
+    for question, question_package in package.items():
+      stats = NumericalQuestionStats.from_package(question_package)
+      if question in merged:
+        merged[question].merge(stats)
+      else:
+        merged[question] = stats
+  return merged
@@ -3,14 +3,24 @@ import argparse
 import os
 import json
 import random
-from typing import List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, List, Dict, Union
 
 from dotenv import load_dotenv
 from naptha_sdk.schemas import AgentRunInput, AgentDeployment
 from naptha_sdk.utils import get_logger
 from genagents_simulation.schemas import InputSchema
 from naptha_sdk.client.naptha import Naptha
-from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.genagents.genagents import GenerativeAgent, reflect_all
+from genagents_simulation.genagents.batch_jobs import submit_survey_job, collect_survey_job
+from genagents_simulation.genagents.question_groups import run_question_groups, validate_question_group
+from genagents_simulation.genagents.modules.response_validation import (
+    parse_numerical_range, response_stats, validate_categorical_resp, validate_numerical_resp)
+from genagents_simulation.genagents.survey_stats import NumericalQuestionStats
+from genagents_simulation.genagents.modules.interaction import description_stats
+from genagents_simulation.simulation_engine.gpt_structure import in_current_run, request_scheduler, scheduler_run, usage_stats
+from genagents_simulation.simulation_engine.settings import MAX_WORKERS
 
 load_dotenv()
 
@@ -18,6 +28,9 @@ logger = get_logger(__name__)
 
 LLM_CONFIG_PATH = "genagents_simulation/configs/llm_configs.json"
 
+# Number of open answers kept per question in a questionnaire summary
+OPEN_ANSWER_EXAMPLES = 20
+
 def load_llm_configs(config_path=LLM_CONFIG_PATH):
     try:
         with open(config_path, 'r') as f:
@@ -43,6 +56,21 @@ class BasicModule:
             raise ValueError(f"LLM config '{llm_config_name}' not found in {LLM_CONFIG_PATH}")
         self.llm_config = self.llm_configs[llm_config_name]
 
+        # Token budget of the agent descriptions in prompts (None for no limit)
+        self.token_budget = self.llm_config.get("description_token_budget")
+        # Prompt template version ("2" puts the shared instructions and questions
+        # before the agent description, so prompts share a cacheable prefix)
+        self.prompt_version = self.llm_config.get("prompt_version", "1")
+        # Stream responses and stop reading once the answer's JSON is complete
+        self.stream = self.llm_config.get("stream", False)
+        # Number of times the agents whose answers match no option are asked again
+        self.validation_retries = self.llm_config.get("validation_retries", 2)
+        # Constrain the responses to a JSON schema derived from the questions
+        self.structured_output = self.llm_config.get("structured_output", False)
+
+        # Number of sampled responses per agent (from one request per agent)
+        self.samples_per_agent = module_run.inputs.samples_per_agent
+
         agent_count = module_run.inputs.agent_count
 
         # Base paths for agents
@@ -81,11 +109,7 @@ class BasicModule:
             logger.error(f"Error accessing agent folders: {str(e)}")
             return []
 
-    def func(self, input_data: Dict[str, List[str]]):
-        logger.info(f"Running module function with {len(self.agents)} agents")
-        logger.debug(f"Input data received: {input_data}")
-
-        # Validate input_data format
+    def _validate_questions(self, input_data: Dict[str, List[str]]):
         if not isinstance(input_data, dict):
             raise ValueError("Input data must be a dictionary with questions as keys and lists of options as values.")
 
@@ -93,7 +117,7 @@ class BasicModule:
             if not isinstance(options, list):
                 raise ValueError(f"Expected a list of options for question '{question}', but got {type(options).__name__}.")
 
-        all_responses = []
+    def _summarize(self, input_data: Dict[str, List[str]], all_responses: List[dict]):
         response_counts = {}
         explanations = {}
 
@@ -103,10 +127,7 @@ class BasicModule:
             for option in options:
                 response_counts[question][option] = 0
 
-        for agent in self.agents:
-            agent_response = agent.categorical_resp(input_data)
-            all_responses.append(agent_response)
-
+        for agent_response in all_responses:
             for q_idx, question in enumerate(input_data):
                 response = agent_response['responses'][q_idx]
                 reasoning = agent_response['reasonings'][q_idx]
@@ -122,10 +143,367 @@ class BasicModule:
                 'visual': {option: f"{'█' * int(count / total * 20)} {count}/{total}" for option, count in response_counts[question].items()},
                 'explanations': explanations[question],
             }
+        return visual_summary
+
+    def _numerical_ranges(self, input_data: Dict[str, List[str]]):
+        # Every question maps to its [low, high] range; answers are floats if a
+        # bound has a decimal point and integers otherwise.
+        float_resp = any("." in str(bound) for range_spec in input_data.values()
+                         for bound in (range_spec if isinstance(range_spec, list) else [range_spec]))
+        ranges = {}
+        for question, range_spec in input_data.items():
+            bounds = parse_numerical_range(range_spec)
+            if bounds is None:
+                raise ValueError(f"Expected a [low, high] range for question '{question}', but got {range_spec}.")
+            ranges[question] = list(bounds) if float_resp else [int(bound) for bound in bounds]
+        return ranges, float_resp
+
+    def _map_agents(self, func, agent_indices):
+        # Calls func(agent) for the agents concurrently, in this run of the request
+        # scheduler, and yields (agent index, result) as the results arrive.
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(in_current_run(func), self.agents[agent_idx]): agent_idx
+                       for agent_idx in agent_indices}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def _validated_responses(self, ask, validate, on_valid=None):
+        # Every agent is asked with ask(agent) and its answers are validated
+        # (snapped to the declared options or range checked); the agents whose
+        # answers do not validate are queued and asked again, and only those agents.
+        responses = [None] * len(self.agents)
+        retry_queue = list(range(len(self.agents)))
+        retried = 0
+        for attempt in range(1 + self.validation_retries):
+            if attempt:
+                logger.info(f"Retrying {len(retry_queue)} agents with invalid answers")
+                retried += len(retry_queue)
+                response_stats.record_retries(len(retry_queue))
+            failed = []
+            for agent_idx, response in self._map_agents(ask, retry_queue):
+                responses[agent_idx] = validate(response)
+                if responses[agent_idx] is None:
+                    failed.append(agent_idx)
+                elif on_valid:
+                    on_valid(responses[agent_idx])
+            retry_queue = sorted(failed)
+            if not retry_queue:
+                break
+
+        if retry_queue:
+            logger.warning(f"No valid answer from {len(retry_queue)} of {len(self.agents)} agents")
+        return responses, {"retried": retried, "failed": len(retry_queue)}
+
+    def func(self, input_data: Dict[str, List[str]]):
+        logger.info(f"Running module function with {len(self.agents)} agents")
+        logger.debug(f"Input data received: {input_data}")
+
+        # Validate input_data format
+        self._validate_questions(input_data)
+
+        all_responses = []
+        validation = None
+        description_stats.reset()
+        usage_stats.reset()
+        response_stats.reset()
+        if self.samples_per_agent > 1:
+            # Every parsed sample counts in the summary, and each agent's own
+            # response distribution is returned with its samples. The samples
+            # that do not validate are requested again, but they cannot be streamed.
+            if self.stream:
+                raise ValueError("Sampled responses (samples_per_agent > 1) cannot be streamed; "
+                                 "set 'stream' to false in the LLM config.")
+            individual_responses = [None] * len(self.agents)
+            sample_agent = lambda agent: agent.categorical_resp_samples(input_data, self.samples_per_agent,
+                                                                        token_budget=self.token_budget,
+                                                                        prompt_version=self.prompt_version,
+                                                                        structured=self.structured_output,
+                                                                        retries=self.validation_retries)
+            for agent_idx, agent_samples in self._map_agents(sample_agent, range(len(self.agents))):
+                individual_responses[agent_idx] = agent_samples
+                all_responses.extend(sample for sample in agent_samples["samples"] if sample)
+        else:
+            individual_responses, validation = self._validated_responses(
+                lambda agent: agent.categorical_resp(input_data, token_budget=self.token_budget,
+                                                     prompt_version=self.prompt_version,
+                                                     stream=self.stream,
+                                                     structured=self.structured_output),
+                lambda response: validate_categorical_resp(input_data, response))
+            all_responses = [response for response in individual_responses if response is not None]
 
         return {
-            "individual_responses": all_responses,
-            "summary": visual_summary,
+            "individual_responses": individual_responses,
+            "summary": self._summarize(input_data, all_responses),
+            "samples_per_agent": self.samples_per_agent,
+            "num_agents": len(self.agents),
+            "validation": validation,
+            "description_stats": description_stats.package(),
+            "llm_usage": usage_stats.package(),
+            "response_stats": response_stats.package(),
+        }
+
+    def numerical_func(self, input_data: Dict[str, List[str]]):
+        logger.info(f"Running numerical survey with {len(self.agents)} agents")
+        logger.debug(f"Input data received: {input_data}")
+
+        ranges, float_resp = self._numerical_ranges(input_data)
+
+        # The answers are aggregated as they arrive, so the summary takes the
+        # same memory for any population size.
+        question_stats = {question: NumericalQuestionStats(ranges[question], float_resp)
+                          for question in input_data}
+
+        def add_response(response):
+            for question, value in zip(input_data, response["responses"]):
+                question_stats[question].add(value)
+
+        description_stats.reset()
+        usage_stats.reset()
+        response_stats.reset()
+        individual_responses, validation = self._validated_responses(
+            lambda agent: agent.numerical_resp(ranges, float_resp, token_budget=self.token_budget,
+                                               prompt_version=self.prompt_version,
+                                               stream=self.stream,
+                                               structured=self.structured_output),
+            lambda response: validate_numerical_resp(ranges, response, float_resp),
+            on_valid=add_response)
+
+        return {
+            "individual_responses": individual_responses,
+            "summary": {question: stats.summary() for question, stats in question_stats.items()},
+            # Packaged statistics that merge_numerical_summaries combines across shards
+            "sketches": {question: stats.package() for question, stats in question_stats.items()},
+            "num_agents": len(self.agents),
+            "validation": validation,
+            "description_stats": description_stats.package(),
+            "llm_usage": usage_stats.package(),
+            "response_stats": response_stats.package(),
+        }
+
+    def questionnaire_func(self, input_data: Dict[str, List[dict]]):
+        questions = input_data.get("questions") if isinstance(input_data, dict) else None
+        self._validate_questionnaire(questions)
+        logger.info(f"Running a {len(questions)}-question questionnaire with {len(self.agents)} agents")
+
+        aggregates = self._questionnaire_aggregates(questions)
+        description_stats.reset()
+        usage_stats.reset()
+        response_stats.reset()
+        individual_responses = [None] * len(self.agents)
+        unanswered = 0
+        ask_agent = lambda agent: agent.ask(questions, token_budget=self.token_budget,
+                                            prompt_version=self.prompt_version, stream=self.stream)
+        for agent_idx, answers in self._map_agents(ask_agent, range(len(self.agents))):
+            individual_responses[agent_idx] = answers
+            unanswered += self._add_answers(questions, aggregates, answers)
+
+        return {
+            "individual_responses": individual_responses,
+            "summary": self._questionnaire_summary(questions, aggregates),
+            "num_agents": len(self.agents),
+            "num_unanswered": unanswered,
+            "description_stats": description_stats.package(),
+            "llm_usage": usage_stats.package(),
+            "response_stats": response_stats.package(),
+        }
+
+    def _validate_questionnaire(self, questions: List[dict]):
+        if not isinstance(questions, list) or not questions:
+            raise ValueError("Input data must have a non-empty 'questions' list.")
+        for question in questions:
+            if question.get("response-type") not in ["categorical", "int", "float", "open"]:
+                raise ValueError(f"Unknown response type for question '{question.get('question')}'.")
+
+    def _questionnaire_aggregates(self, questions: List[dict]):
+        # Every type is aggregated as the answers arrive: option counts for
+        # categorical questions, mergeable statistics for numerical ones, and
+        # a bounded sample of answers for open ones.
+        aggregates = []
+        for question in questions:
+            if question["response-type"] == "categorical":
+                aggregates.append({option: 0 for option in question["response-options"]})
+            elif question["response-type"] in ["int", "float"]:
+                aggregates.append(NumericalQuestionStats(question.get("response-scale"),
+                                                         question["response-type"] == "float"))
+            else:
+                aggregates.append({"count": 0, "total_chars": 0, "examples": []})
+        return aggregates
+
+    def _add_answers(self, questions: List[dict], aggregates: list, answers: List[dict]):
+        # Adds one agent's answers to the aggregates and returns the number of
+        # questions it left unanswered.
+        unanswered = 0
+        for question, aggregate, answer in zip(questions, aggregates, answers):
+            response = answer["response"]
+            if response is None:
+                unanswered += 1
+            elif question["response-type"] == "categorical":
+                aggregate[response] += 1
+            elif question["response-type"] in ["int", "float"]:
+                aggregate.add(response)
+            else:
+                aggregate["count"] += 1
+                aggregate["total_chars"] += len(response)
+                if len(aggregate["examples"]) < OPEN_ANSWER_EXAMPLES:
+                    aggregate["examples"].append(response)
+        return unanswered
+
+    def _questionnaire_summary(self, questions: List[dict], aggregates: list):
+        summary = {}
+        for question, aggregate in zip(questions, aggregates):
+            if question["response-type"] == "categorical":
+                total = sum(aggregate.values())
+                summary[question["question"]] = {
+                    "type": "categorical",
+                    "counts": aggregate,
+                    "percentages": {option: f"{(count / total * 100):.1f}%" if total else None
+                                    for option, count in aggregate.items()},
+                }
+            elif question["response-type"] in ["int", "float"]:
+                summary[question["question"]] = {"type": question["response-type"], **aggregate.summary()}
+            else:
+                summary[question["question"]] = {
+                    "type": "open",
+                    "count": aggregate["count"],
+                    "mean_chars": aggregate["total_chars"] / aggregate["count"] if aggregate["count"] else None,
+                    "examples": aggregate["examples"],
+                }
+        return summary
+
+    def multi_func(self, input_data: Dict[str, List[dict]]):
+        groups = input_data.get("groups") if isinstance(input_data, dict) else None
+        if not isinstance(groups, list) or not groups:
+            raise ValueError("Input data must have a non-empty 'groups' list.")
+        # Groups are {"type": "categorical" | "numerical" | "questionnaire",
+        # "questions": ...} with the input data of func, numerical_func or
+        # questionnaire_func as their questions.
+        for group in groups:
+            validate_question_group(group)
+            if group["type"] == "categorical":
+                self._validate_questions(group["questions"])
+            elif group["type"] == "numerical":
+                group["questions"], group["float_resp"] = self._numerical_ranges(group["questions"])
+            else:
+                self._validate_questionnaire(group["questions"])
+        logger.info(f"Running {len(groups)} question groups with {len(self.agents)} agents")
+
+        # Numerical and questionnaire answers are aggregated as they arrive;
+        # categorical responses are summarized at the end.
+        aggregates = []
+        for group in groups:
+            if group["type"] == "numerical":
+                aggregates.append({question: NumericalQuestionStats(range_spec, group["float_resp"])
+                                   for question, range_spec in group["questions"].items()})
+            elif group["type"] == "questionnaire":
+                aggregates.append(self._questionnaire_aggregates(group["questions"]))
+            else:
+                aggregates.append(None)
+        unanswered = [0] * len(groups)
+        lock = threading.Lock()
+
+        def add_response(group_idx, agent_idx, response):
+            group = groups[group_idx]
+            with lock:
+                if group["type"] == "numerical":
+                    for question, value in zip(group["questions"], response["responses"]):
+                        aggregates[group_idx][question].add(value)
+                elif group["type"] == "questionnaire":
+                    unanswered[group_idx] += self._add_answers(group["questions"],
+                                                               aggregates[group_idx], response)
+
+        description_stats.reset()
+        usage_stats.reset()
+        response_stats.reset()
+        results = run_question_groups(self.agents, groups, token_budget=self.token_budget,
+                                      prompt_version=self.prompt_version, stream=self.stream,
+                                      structured=self.structured_output,
+                                      retries=self.validation_retries, on_response=add_response)
+
+        group_outputs = []
+        for group, aggregate, responses, group_unanswered in zip(groups, aggregates, results, unanswered):
+            if group["type"] == "categorical":
+                valid = [response for response in responses if response is not None]
+                summary = self._summarize(group["questions"], valid)
+            elif group["type"] == "numerical":
+                valid = [response for response in responses if response is not None]
+                summary = {question: stats.summary() for question, stats in aggregate.items()}
+            else:
+                valid = responses
+                summary = self._questionnaire_summary(group["questions"], aggregate)
+            group_outputs.append({
+                "type": group["type"],
+                "individual_responses": responses,
+                "summary": summary,
+                "num_failed": len(responses) - len(valid),
+                "num_unanswered": group_unanswered,
+            })
+            if group["type"] == "numerical":
+                # Packaged statistics that merge_numerical_summaries combines across shards
+                group_outputs[-1]["sketches"] = {question: stats.package() for question, stats in aggregate.items()}
+
+        return {
+            "groups": group_outputs,
+            "num_agents": len(self.agents),
+            "description_stats": description_stats.package(),
+            "llm_usage": usage_stats.package(),
+            "response_stats": response_stats.package(),
+        }
+
+    def submit_batch(self, input_data: Dict[str, List[str]]):
+        logger.info(f"Submitting a batch job for {len(self.agents)} agents")
+        self._validate_questions(input_data)
+
+        job = submit_survey_job(self.agents, input_data,
+                                batch_client=self.llm_config.get("batch_client"),
+                                token_budget=self.token_budget,
+                                prompt_version=self.prompt_version,
+                                max_tokens=self.llm_config.get("max_tokens", 1500))
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "batch_client": job["batch_client"],
+            "num_agents": len(job["agent_ids"]),
+        }
+
+    def collect_batch(self, input_data: Dict[str, Union[List[str], str]]):
+        job_id = input_data.get("job_id")
+        if not job_id:
+            raise ValueError("Missing 'job_id' in input data.")
+        if isinstance(job_id, list):
+            job_id = job_id[0]
+
+        job, responses = collect_survey_job(job_id, wait=str(input_data.get("wait", "")).lower() == "true")
+        if responses is None:
+            return {"job_id": job_id, "status": job["status"]}
+
+        all_responses = [response for response in responses if response is not None]
+        failed = len(responses) - len(all_responses)
+        if failed:
+            logger.warning(f"No usable response for {failed} of {len(responses)} agents in job {job_id}")
+
+        return {
+            "job_id": job_id,
+            "status": job["status"],
+            "individual_responses": responses,
+            "summary": self._summarize(job["questions"], all_responses),
+            "num_agents": len(responses),
+            "num_failed": failed,
+        }
+
+    def reflect_all(self, input_data: Dict[str, Any]):
+        anchor = input_data.get("anchor") if isinstance(input_data, dict) else None
+        if not isinstance(anchor, str) or not anchor.strip():
+            raise ValueError("Input data must have a non-empty 'anchor' string.")
+        logger.info(f"Running reflection on '{anchor}' for {len(self.agents)} agents")
+
+        reflections = reflect_all(self.agents, anchor)
+        failed = sum(1 for agent_reflections in reflections if agent_reflections is None)
+        if failed:
+            logger.warning(f"Reflection failed for {failed} of {len(self.agents)} agents")
+
+        return {
+            "reflections": reflections,
+            "num_reflections": sum(len(r) for r in reflections if r),
             "num_agents": len(self.agents),
         }
 
@@ -134,7 +512,16 @@ def run(module_run: AgentRunInput):
     method = getattr(basic_module, module_run.inputs.func_name, None)
     if method is None:
         raise ValueError(f"Method '{module_run.inputs.func_name}' not found in BasicModule")
-    return method(module_run.inputs.func_input_data)
+
+    # Concurrent runs in this process share the LLM request slots: each run gets
+    # its weighted share, and interactive runs go before batch runs.
+    with scheduler_run(weight=module_run.inputs.weight, priority=module_run.inputs.priority) as run_id:
+        logger.info(f"Run {run_id} scheduled with priority '{module_run.inputs.priority}' "
+                    f"and weight {module_run.inputs.weight}")
+        response = method(module_run.inputs.func_input_data)
+        if isinstance(response, dict):
+            response["scheduler"] = request_scheduler.package(run_id)
+    return response
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Run agent simulations with custom questions and options.')
@@ -142,6 +529,10 @@ def parse_arguments():
     parser.add_argument('--options', type=str, required=True, help='Comma-separated options for the question (e.g., "Yes,No,Undecided").')
     parser.add_argument('--llm_config_name', type=str, default='model_2', help='The LLM configuration name to use.')
     parser.add_argument('--agent_count', type=int, default=1, help='The number of agents to simulate.')
+    parser.add_argument('--samples_per_agent', type=int, default=1, help='The number of sampled responses per agent.')
+    parser.add_argument('--priority', type=str, default='interactive', choices=['interactive', 'batch'],
+                        help='The priority of the run\'s LLM requests.')
+    parser.add_argument('--weight', type=float, default=1.0, help='The fair share weight of the run\'s LLM requests.')
 
     return parser.parse_args()
 
@@ -185,6 +576,9 @@ if __name__ == "__main__":
         },
         llm_config_name=args.llm_config_name,
         agent_count=args.agent_count,
+        samples_per_agent=args.samples_per_agent,
+        priority=args.priority,
+        weight=args.weight,
     )
 
     module_run = AgentRunInput(
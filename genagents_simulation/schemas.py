@@ -1,8 +1,12 @@
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Any, Dict
 
 class InputSchema(BaseModel):
     func_name: str
-    func_input_data: Dict[str, List[str]]
+    func_input_data: Dict[str, Any]
     llm_config_name: str
     agent_count: int
+    samples_per_agent: int = 1
+    # Scheduling of the run's LLM requests among concurrent runs
+    priority: str = "interactive"
+    weight: float = 1.0
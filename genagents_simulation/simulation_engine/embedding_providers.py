@@ -0,0 +1,101 @@
+import re
+import zlib
+from typing import List
+
+import numpy as np
+
+from genagents_simulation.simulation_engine.settings import *
+from genagents_simulation.simulation_engine.gpt_structure import *
+
+
+# ============================================================================
+# ###################### [SECTION 1: OPENAI PROVIDER] ########################
+# ============================================================================
+
+class OpenAIEmbeddingProvider:
+  """Embeds texts with OpenAI's embedding API."""
+  def __init__(self, model: str = "text-embedding-3-small",
+               batch_size: int = 256):
+    self.model = model
+    self.batch_size = batch_size
+    self.name = f"openai/{model}"
+
+
+  def embed(self, texts: List[str]) -> List[List[float]]:
+    """Embed <texts>, one API request per <batch_size> texts."""
+    embeddings = []
+    for start in range(0, len(texts), self.batch_size):
+      embeddings += get_text_embeddings(texts[start:start + self.batch_size],
+                                        self.model)
+    return embeddings
+
+
+# ============================================================================
+# ###################### [SECTION 2: LOCAL PROVIDER] #########################
+# ============================================================================
+
+class HashingEmbeddingProvider:
+  """Embeds texts locally, without network calls, by hashing their word
+     unigrams and character n-grams into a fixed number of dimensions (the
+     hashing trick) with sublinear term frequencies. Vectors are unit
+     length, so cosine similarity reflects shared words and word pieces."""
+  def __init__(self, dim: int = 1024, ngram_min: int = 3, ngram_max: int = 5):
+    self.dim = dim
+    self.ngram_min = ngram_min
+    self.ngram_max = ngram_max
+    self.name = f"local/hashing-{dim}"
+
+
+  def _features(self, text: str) -> List[str]:
+    words = re.findall(r"\w+", text.lower())
+    features = [f"w:{word}" for word in words]
+    padded = f" {' '.join(words)} "
+    for n in range(self.ngram_min, self.ngram_max + 1):
+      features += [padded[i:i + n] for i in range(len(padded) - n + 1)]
+    return features
+
+
+  def embed_one(self, text: str) -> List[float]:
+    hashes = np.array([zlib.crc32(feature.encode("utf-8"))
+                       for feature in self._features(text)], dtype=np.int64)
+    if len(hashes) == 0:
+      return [0.0] * self.dim
+
+    # The bucket comes from the low bits of the hash and the sign from a
+    # higher bit, so that colliding features tend to cancel out.
+    signs = np.where((hashes >> 31) & 1, -1.0, 1.0)
+    vector = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim)
+    vector = np.sign(vector) * np.log1p(np.abs(vector))
+    length = np.linalg.norm(vector)
+    if length > 0:
+      vector = vector / length
+    return vector.tolist()
+
+
+  def embed(self, texts: List[str]) -> List[List[float]]:
+    return [self.embed_one(text) for text in texts]
+
+
+# ============================================================================
+# ######################### [SECTION 3: REGISTRY] ############################
+# ============================================================================
+
+_providers = dict()
+
+
+def get_embedding_provider(name: str = None):
+  """Return the embedding provider for a model name. Names are
+     'openai/<model>' or 'local/hashing-<dim>'; bare OpenAI model names are
+     accepted as well. Defaults to EMBEDDING_MODEL."""
+  name = name or EMBEDDING_MODEL
+  if name not in _providers:
+    if name.startswith("local/hashing-"):
+      provider = HashingEmbeddingProvider(int(name.rsplit("-", 1)[1]))
+    elif name.startswith("openai/"):
+      provider = OpenAIEmbeddingProvider(name.split("/", 1)[1])
+    elif "/" not in name:
+      provider = OpenAIEmbeddingProvider(name)
+    else:
+      raise ValueError(f"Unknown embedding model '{name}'.")
+    _providers[name] = provider
+  return _providers[name]
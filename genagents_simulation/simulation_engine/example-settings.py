@@ -10,11 +10,16 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "API_KEY")
 KEY_OWNER = os.getenv("KEY_OWNER", "NAME")
 
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
-MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE", "4"))
+MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE", "10"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "16"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "32"))
 LLM_VERS = os.getenv("LLM_VERS", "gpt-4o-mini")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "openai/text-embedding-3-small")
+DESCRIPTION_CACHE_MAX_CHARS = int(os.getenv("DESCRIPTION_CACHE_MAX_CHARS", "50000000"))
 
 BASE_DIR = f"{Path(__file__).resolve().parent.parent}"
 
 ## To do: Are the following needed in the new structure? Ideally Populations_Dir is for the user to define.
 POPULATIONS_DIR = f"{BASE_DIR}/agent_bank/populations" 
 LLM_PROMPT_DIR = f"{BASE_DIR}/simulation_engine/prompt_template"
+BATCH_JOB_DIR = os.getenv("BATCH_JOB_DIR", f"{BASE_DIR}/batch_jobs")
@@ -10,6 +10,8 @@ import shutil, errno
 
 from os import listdir
 
+from genagents_simulation.simulation_engine.llm_json_parser import extract_first_json_dict
+
 
 def create_folder_if_not_there(curr_path): 
   """
@@ -237,41 +239,6 @@ def generate_alphanumeric_string(length):
   return result
 
 
-def extract_first_json_dict(input_str):
-  try:
-    # Replace curly quotes with standard double quotes
-    input_str = (input_str.replace("“", "\"")
-                          .replace("”", "\"")
-                          .replace("‘", "'")
-                          .replace("’", "'"))
-    
-    # Find the first occurrence of '{' in the input_str
-    start_index = input_str.index('{')
-    
-    # Initialize a count to keep track of open and close braces
-    count = 1
-    end_index = start_index + 1
-    
-    # Loop to find the closing '}' for the first JSON dictionary
-    while count > 0 and end_index < len(input_str):
-        if input_str[end_index] == '{':
-            count += 1
-        elif input_str[end_index] == '}':
-            count -= 1
-        end_index += 1
-    
-    # Extract the JSON substring
-    json_str = input_str[start_index:end_index]
-    
-    # Parse the JSON string into a Python dictionary
-    json_dict = json.loads(json_str)
-    
-    return json_dict
-  except ValueError:
-    # Handle the case where the JSON parsing fails
-    return None
-
-
 def read_file_to_string(file_path):
   try:
     with open(file_path, 'r', encoding='utf-8') as file:
@@ -1,9 +1,21 @@
 import openai
+import json
+import os
+import re
+import threading
 import time
+import types
+import uuid
 import base64
+import contextlib
+import contextvars
+import heapq
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
 
 from genagents_simulation.simulation_engine.settings import *
+from genagents_simulation.simulation_engine.llm_json_parser import FirstJSONObjectScanner
 
 openai.api_key = OPENAI_API_KEY
 
@@ -52,32 +64,140 @@ def generate_prompt(prompt_input: Union[str, List[str]],
 
 def gpt_request(prompt: str, 
                 model: str = "gpt-4o", 
-                max_tokens: int = 1500) -> str:
-  """Make a request to OpenAI's GPT model."""
+                max_tokens: int = 1500, 
+                response_format: dict = None) -> str:
+  """Make a request to OpenAI's GPT model. <response_format> (e.g. a JSON 
+     schema for structured outputs) is passed on when given."""
+  extra = {"response_format": response_format} if response_format else {}
   if model == "o1-preview": 
     try:
       client = openai.OpenAI(api_key=OPENAI_API_KEY)
+      start = time.perf_counter()
       response = client.chat.completions.create(
         model=model,
-        messages=[{"role": "user", "content": prompt}]
+        messages=[{"role": "user", "content": prompt}],
+        **extra
       )
+      usage_stats.record(response, time.perf_counter() - start)
       return response.choices[0].message.content
     except Exception as e:
       return f"GENERATION ERROR: {str(e)}"
 
   try:
     client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    start = time.perf_counter()
     response = client.chat.completions.create(
       model=model,
       messages=[{"role": "user", "content": prompt}],
       max_tokens=max_tokens,
-      temperature=0.7
+      temperature=0.7,
+      **extra
     )
+    usage_stats.record(response, time.perf_counter() - start)
     return response.choices[0].message.content
   except Exception as e:
     return f"GENERATION ERROR: {str(e)}"
 
 
+_accepted_arguments = dict()
+
+
+def _accepts_argument(method: callable, name: str) -> bool:
+  """Return whether the client <method> takes the keyword argument <name>."""
+  key = (getattr(method, "__qualname__", repr(method)), name)
+  if key not in _accepted_arguments:
+    try:
+      parameters = inspect.signature(method).parameters
+      _accepted_arguments[key] = name in parameters or any(
+        parameter.kind == parameter.VAR_KEYWORD 
+        for parameter in parameters.values())
+    except (TypeError, ValueError):
+      _accepted_arguments[key] = False
+  return _accepted_arguments[key]
+
+
+def gpt_request_stream(prompt: str, 
+                       model: str = "gpt-4o", 
+                       max_tokens: int = 1500, 
+                       stop_when: callable = None, 
+                       response_format: dict = None) -> str:
+  """Make a streaming request to OpenAI's GPT model. Every content chunk is
+     passed to <stop_when>, and the stream is closed as soon as it returns 
+     True, so the rest of the completion is neither waited for nor 
+     generated."""
+  extra = {"response_format": response_format} if response_format else {}
+  try:
+    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    # Clients older than stream_options (such as the pinned openai 1.6.0) 
+    # reject it; their streams report no usage.
+    if _accepts_argument(client.chat.completions.create, "stream_options"):
+      extra["stream_options"] = {"include_usage": True}
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
+      model=model,
+      messages=[{"role": "user", "content": prompt}],
+      max_tokens=max_tokens,
+      temperature=0.7,
+      stream=True,
+      **extra
+    )
+    chunks = []
+    usage = None
+    try:
+      for event in stream:
+        usage = getattr(event, "usage", None) or usage
+        if not event.choices:
+          continue
+        chunk = event.choices[0].delta.content or ""
+        chunks += [chunk]
+        if stop_when and stop_when(chunk):
+          break
+    finally:
+      stream.close()
+    # The usage only arrives with the last event of a stream that was read 
+    # to the end (and only if stream_options was sent); without it, the 
+    # request is counted without tokens.
+    usage_stats.record(types.SimpleNamespace(usage=usage), 
+                       time.perf_counter() - start)
+    return "".join(chunks)
+  except Exception as e:
+    return f"GENERATION ERROR: {str(e)}"
+
+
+def gpt_request_samples(prompt: str, 
+                        n: int, 
+                        model: str = "gpt-4o", 
+                        max_tokens: int = 1500, 
+                        response_format: dict = None) -> List[str]:
+  """Make one request to OpenAI's GPT model for <n> sampled completions of 
+     the same prompt (the `n` parameter), so the prompt tokens are paid 
+     once. Backends that return fewer choices than asked for are asked 
+     again for the rest. Failed samples are "GENERATION ERROR: ..." 
+     strings. <response_format> is passed on when given."""
+  extra = {"response_format": response_format} if response_format else {}
+  samples = []
+  try:
+    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    while len(samples) < n:
+      with request_scheduler.slot():
+        start = time.perf_counter()
+        response = client.chat.completions.create(
+          model=model,
+          messages=[{"role": "user", "content": prompt}],
+          max_tokens=max_tokens,
+          temperature=0.7,
+          n=n - len(samples),
+          **extra
+        )
+      usage_stats.record(response, time.perf_counter() - start)
+      if not response.choices:
+        break
+      samples += [choice.message.content for choice in response.choices]
+  except Exception as e:
+    samples += [f"GENERATION ERROR: {str(e)}"] * (n - len(samples))
+  return samples[:n]
+
+
 def gpt4_vision(messages: List[dict], max_tokens: int = 1500) -> str:
   """Make a request to OpenAI's GPT-4 Vision model."""
   try:
@@ -102,8 +222,14 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
                        verbose: bool = False,
                        max_tokens: int = 1500,
                        file_attachment: str = None,
-                       file_type: str = None) -> tuple:
-  """Generate a response using GPT models with error handling & retries."""
+                       file_type: str = None,
+                       stream: bool = False,
+                       response_format: dict = None) -> tuple:
+  """Generate a response using GPT models with error handling & retries. 
+     With <stream>, the response is streamed and cut off once its first 
+     JSON object is complete. <response_format> constrains the output 
+     (e.g. to a JSON schema). Every request waits for a slot of the 
+     request scheduler (see RequestScheduler)."""
   if file_attachment and file_type:
     prompt = generate_prompt(prompt_input, prompt_lib_file)
     messages = [{"role": "user", "content": prompt}]
@@ -119,7 +245,8 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
               {"url": f"data:image/jpeg;base64,{base64_image}"}}
         ]
       })
-      response = gpt4_vision(messages, max_tokens)
+      with request_scheduler.slot():
+        response = gpt4_vision(messages, max_tokens)
 
     elif file_type.lower() == 'pdf':
       pdf_text = extract_text_from_pdf_file(file_attachment)
@@ -127,12 +254,20 @@ def chat_safe_generate(prompt_input: Union[str, List[str]],
       instruction = generate_prompt(prompt_input, prompt_lib_file)
       prompt = f"{pdf}"
       prompt += f"<End of the PDF attachment>\n=\nTask description:\n{instruction}"
-      response = gpt_request(prompt, gpt_version, max_tokens)
+      with request_scheduler.slot():
+        response = gpt_request(prompt, gpt_version, max_tokens)
 
   else:
     prompt = generate_prompt(prompt_input, prompt_lib_file)
     for i in range(repeat):
-      response = gpt_request(prompt, model=gpt_version)
+      with request_scheduler.slot():
+        if stream:
+          response = gpt_request_stream(
+            prompt, gpt_version, max_tokens, FirstJSONObjectScanner().feed, 
+            response_format)
+        else:
+          response = gpt_request(prompt, model=gpt_version, 
+                                 response_format=response_format)
       if response != "GENERATION ERROR":
         break
       time.sleep(2**i)
@@ -164,10 +299,530 @@ def get_text_embedding(text: str,
   return response
 
 
+def get_text_embeddings(texts: List[str], 
+                        model: str = "text-embedding-3-small"
+                        ) -> List[List[float]]:
+  """Generate embeddings for a list of texts in a single API request. The 
+     returned vectors are in the same order as the input texts."""
+  if not texts: 
+    return []
+  for text in texts: 
+    if not isinstance(text, str) or not text.strip():
+      raise ValueError("Input texts must be non-empty strings.")
+
+  texts = [text.replace("\n", " ").strip() for text in texts]
+  data = openai.embeddings.create(input=texts, model=model).data
+  data = sorted(data, key=lambda item: item.index)
+  return [item.embedding for item in data]
+
+
+# ============================================================================
+# ###################### [SECTION 4: TOKEN ESTIMATES] ########################
+# ============================================================================
+
+try:
+  import tiktoken
+except ImportError:
+  tiktoken = None
+
+_encodings = dict()
+
+
+def _get_encoding(model: str):
+  """Return the tiktoken encoding of <model>, or None when tiktoken is not
+     installed or does not know the model."""
+  if tiktoken is None:
+    return None
+  if model not in _encodings:
+    try:
+      _encodings[model] = tiktoken.encoding_for_model(model)
+    except KeyError:
+      _encodings[model] = tiktoken.get_encoding("o200k_base")
+  return _encodings[model]
+
+
+def estimate_tokens(text: str, model: str = None) -> int:
+  """Estimate the number of tokens of <text>. Uses tiktoken when it is
+     installed; otherwise every word counts one token per six characters
+     (at least one) and every punctuation mark one token, which slightly
+     overestimates BPE tokenizers on English text."""
+  encoding = _get_encoding(model or LLM_VERS)
+  if encoding is not None:
+    return len(encoding.encode(text, disallowed_special=()))
+  return sum(-(-len(piece) // 6) if piece[0].isalnum() else 1
+             for piece in re.findall(r"\w+|[^\w\s]", text))
+
+
+
+# ============================================================================
+# ####################### [SECTION 5: USAGE STATS] ###########################
+# ============================================================================
+
+class RunStats:
+  """Base of thread-safe counters that are kept per scheduler run (see 
+     scheduler_run), so concurrent runs in one process each count (and 
+     reset) their own. Subclasses return their zeroed counters from 
+     new_counters and read and update those of the current run, 
+     self.counters(), while holding self.lock. The counters of a run are 
+     dropped when the run ends."""
+
+  instances = []
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.runs = dict()
+    RunStats.instances += [self]
+
+
+  def new_counters(self) -> dict:
+    raise NotImplementedError
+
+
+  def counters(self) -> dict:
+    run_id = _current_run.get()[0]
+    if run_id not in self.runs:
+      self.runs[run_id] = self.new_counters()
+    return self.runs[run_id]
+
+
+  def reset(self):
+    with self.lock:
+      self.runs[_current_run.get()[0]] = self.new_counters()
 
 
+  def discard(self, run_id: str):
+    with self.lock:
+      self.runs.pop(run_id, None)
 
 
+class UsageStats(RunStats):
+  """Totals of the token usage reported by chat completion responses. 
+     cached_tokens counts the prompt tokens that the provider served from 
+     its prompt cache (usage.prompt_tokens_details), which is what the 
+     prefix-cache prompt layouts are meant to raise."""
 
+  def new_counters(self) -> dict:
+    return {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, 
+            "completion_tokens": 0, "latency": 0.0}
 
 
+  @staticmethod
+  def _field(value, name):
+    # Fields that the installed openai models do not declare (such as 
+    # prompt_tokens_details on openai 1.6.0) come back as plain dicts.
+    if isinstance(value, dict):
+      return value.get(name)
+    return getattr(value, name, None)
+
+
+  def record(self, response, latency=0.0):
+    usage = self._field(response, "usage")
+    details = self._field(usage, "prompt_tokens_details")
+    with self.lock:
+      counters = self.counters()
+      counters["requests"] += 1
+      counters["latency"] += latency
+      counters["prompt_tokens"] += self._field(usage, "prompt_tokens") or 0
+      counters["completion_tokens"] += (
+        self._field(usage, "completion_tokens") or 0)
+      counters["cached_tokens"] += self._field(details, "cached_tokens") or 0
+
+
+  def package(self):
+    with self.lock:
+      counters = dict(self.counters())
+    return {
+      "requests": counters["requests"],
+      "prompt_tokens": counters["prompt_tokens"],
+      "cached_tokens": counters["cached_tokens"],
+      "completion_tokens": counters["completion_tokens"],
+      "cached_ratio": (counters["cached_tokens"] / counters["prompt_tokens"]
+                       if counters["prompt_tokens"] else None),
+      "mean_latency": (counters["latency"] / counters["requests"]
+                       if counters["requests"] else None)}
+
+
+usage_stats = UsageStats()
+
+
+# ============================================================================
+# ######################## [SECTION 6: BATCH API] ############################
+# ============================================================================
+
+def batch_request_line(custom_id: str, 
+                       prompt: str, 
+                       model: str = "gpt-4o", 
+                       max_tokens: int = 1500) -> dict:
+  """Return the batch input line of the chat completion request that 
+     gpt_request would send for <prompt>."""
+  return {"custom_id": custom_id,
+          "method": "POST",
+          "url": "/v1/chat/completions",
+          "body": {"model": model,
+                   "messages": [{"role": "user", "content": prompt}],
+                   "max_tokens": max_tokens,
+                   "temperature": 0.7}}
+
+
+def batch_response_content(line: dict) -> Union[str, None]:
+  """Return the message content of a batch output line, or None when the 
+     request failed."""
+  response = line.get("response") or dict()
+  if line.get("error") or response.get("status_code") != 200:
+    return None
+  try:
+    return response["body"]["choices"][0]["message"]["content"]
+  except (KeyError, IndexError, TypeError):
+    return None
+
+
+class LocalBatchClient:
+  """Stand-in for the subset of the OpenAI batch API that the batch jobs use
+     (client.files.create/content and client.batches.create/retrieve), for 
+     testing batch jobs and for models or clients without a batch endpoint 
+     (the 'synchronous' batch client). It sends ordinary requests, so it 
+     gets none of the batch endpoint's cost savings.
+     Files and batches are kept under <folder>, so a batch can be retrieved 
+     from another process. A batch's requests are sent by a background 
+     thread of the process that created it, as a 'batch' priority run of 
+     the request scheduler; retrieve only reads its state (and restarts the
+     thread if the process that ran it is gone)."""
+
+  def __init__(self, folder: str):
+    self.folder = folder
+    self.files = types.SimpleNamespace(create=self._create_file, 
+                                       content=self._file_content)
+    self.batches = types.SimpleNamespace(create=self._create_batch, 
+                                         retrieve=self._retrieve_batch)
+
+
+  def _write_file(self, data: bytes) -> str:
+    file_id = f"file-{uuid.uuid4().hex}"
+    os.makedirs(f"{self.folder}/files", exist_ok=True)
+    with open(f"{self.folder}/files/{file_id}", "wb") as f:
+      f.write(data)
+    return file_id
+
+
+  def _create_file(self, file, purpose: str = "batch"):
+    return types.SimpleNamespace(id=self._write_file(file.read()))
+
+
+  def _file_content(self, file_id: str):
+    with open(f"{self.folder}/files/{file_id}", "rb") as f:
+      return types.SimpleNamespace(text=f.read().decode("utf-8"))
+
+
+  def _read_batch(self, batch_id: str) -> dict:
+    with open(f"{self.folder}/batches/{batch_id}.json") as f:
+      return json.load(f)
+
+
+  def _write_batch(self, batch: dict) -> None:
+    os.makedirs(f"{self.folder}/batches", exist_ok=True)
+    file_name = f"{self.folder}/batches/{batch['id']}.json"
+    with open(f"{file_name}.tmp", "w") as f:
+      json.dump(batch, f)
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+  def _create_batch(self, input_file_id: str, endpoint: str, 
+                    completion_window: str = "24h", metadata: dict = None):
+    batch = {"id": f"batch-{uuid.uuid4().hex}",
+             "status": "validating",
+             "input_file_id": input_file_id,
+             "output_file_id": None,
+             "error_file_id": None,
+             "worker_pid": None}
+    self._write_batch(batch)
+    return types.SimpleNamespace(**self._start_batch(batch))
+
+
+  def _start_batch(self, batch: dict) -> dict:
+    batch["status"] = "in_progress"
+    batch["worker_pid"] = os.getpid()
+    self._write_batch(batch)
+    threading.Thread(target=in_current_run(self._run_batch), 
+                     args=(batch["id"],), daemon=True).start()
+    return batch
+
+
+  def _send_request(self, line: dict) -> dict:
+    body = line["body"]
+    with request_scheduler.slot():
+      content = gpt_request(body["messages"][0]["content"], 
+                            model=body["model"], 
+                            max_tokens=body.get("max_tokens", 1500))
+    if content.startswith("GENERATION ERROR"):
+      return {"custom_id": line["custom_id"], "response": None,
+              "error": {"message": content}}
+    return {"custom_id": line["custom_id"],
+            "response": {"status_code": 200,
+                         "body": {"choices": [{"message": {
+                           "role": "assistant", "content": content}}]}},
+            "error": None}
+
+
+  def _run_batch(self, batch_id: str) -> None:
+    batch = self._read_batch(batch_id)
+    try:
+      lines = [json.loads(line) for line in 
+               self._file_content(batch["input_file_id"]).text.splitlines()
+               if line.strip()]
+      with scheduler_run(f"local-{batch_id}", priority="batch"):
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+          output = list(executor.map(in_current_run(self._send_request), 
+                                     lines))
+      batch["output_file_id"] = self._write_file(
+        "".join(json.dumps(line) + "\n" for line in output).encode("utf-8"))
+      batch["status"] = "completed"
+    except Exception as e:
+      print (f"Local batch {batch_id} failed: {str(e)}")
+      batch["status"] = "failed"
+    self._write_batch(batch)
+
+
+  def _retrieve_batch(self, batch_id: str):
+    batch = self._read_batch(batch_id)
+    if batch["status"] == "validating" or (
+        batch["status"] == "in_progress" 
+        and not _process_exists(batch["worker_pid"])):
+      batch = self._start_batch(batch)
+    return types.SimpleNamespace(**batch)
+
+
+def _process_exists(pid: int) -> bool:
+  if not pid:
+    return False
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+# Batch client names, by what they do: 'openai' submits to OpenAI's batch 
+# endpoint (at its batch discount), 'synchronous' sends every request of the
+# batch as an ordinary request from a background thread (LocalBatchClient, 
+# at the ordinary price). 'local' is the former name of 'synchronous', kept
+# for jobs submitted under it. 
+BATCH_CLIENTS = ["openai", "synchronous"]
+
+
+def get_batch_client(name: str):
+  """Return the batch API client for <name> (see BATCH_CLIENTS). There is
+     no default, so a config without a 'batch_client' fails here instead of
+     quietly sending ordinary requests."""
+  if name in ["synchronous", "local"]:
+    return LocalBatchClient(f"{BATCH_JOB_DIR}/local_batch_client")
+  if name == "openai":
+    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    if not hasattr(client, "batches"):
+      raise ValueError(f"The installed openai client ({openai.__version__}) "
+                       f"has no batch API; upgrade openai, or set the "
+                       f"'synchronous' batch client to send the batch as "
+                       f"ordinary requests.")
+    return client
+  if not name:
+    raise ValueError(f"No batch client is configured: set 'batch_client' "
+                     f"in the LLM config to one of {BATCH_CLIENTS}. Only "
+                     f"'openai' uses the batch endpoint; 'synchronous' sends"
+                     f" ordinary requests.")
+  raise ValueError(f"Unknown batch client '{name}'; expected one of "
+                   f"{BATCH_CLIENTS}.")
+
+
+# ============================================================================
+# #################### [SECTION 7: REQUEST SCHEDULER] ########################
+# ============================================================================
+
+# Request priorities, from the first served to the last. Waiting interactive
+# requests always go before waiting batch requests.
+REQUEST_PRIORITIES = ["interactive", "batch"]
+
+# The run of the requests made outside of scheduler_run.
+DEFAULT_RUN = ("default", 1.0, "interactive")
+
+_current_run = contextvars.ContextVar("scheduler_run", default=DEFAULT_RUN)
+
+
+class RequestScheduler:
+  """Process-wide scheduler of LLM requests from concurrent runs (module 
+     runs, jobs) sharing one API quota. At most <max_concurrency> requests 
+     are in flight; the others wait in a queue. Waiting requests are served
+     by priority, and within a priority by weighted fair queuing across 
+     runs (self-clocked: a request's finish tag is the larger of the 
+     priority's virtual time and its run's last tag, plus 1 / the run's 
+     weight, and the smallest tag goes first). A run with thousands of 
+     queued requests therefore gets its weighted share of the slots, and 
+     the few requests of a short run are served next to it instead of after
+     it. Queue depths and wait times are kept per run."""
+
+  def __init__(self, max_concurrency: int):
+    self.max_concurrency = max_concurrency
+    self.condition = threading.Condition()
+    self.active = 0
+    self.queue = []
+    self.count = 0
+    self.virtual_time = {priority: 0.0 for priority in REQUEST_PRIORITIES}
+    self.last_tags = dict()
+    self.runs = dict()
+    self.reset()
+
+
+  def reset(self):
+    with self.condition:
+      self.requests = 0
+      self.wait = 0.0
+      self.max_wait = 0.0
+      self.max_queue_depth = 0
+
+
+  def _run_stats(self, run_id: str) -> dict:
+    if run_id not in self.runs:
+      self.runs[run_id] = {"requests": 0, "queued": 0, "active": 0, 
+                           "wait": 0.0, "max_wait": 0.0, "users": 0}
+    return self.runs[run_id]
+
+
+  def acquire(self, run: tuple = None) -> None:
+    """Waits until a request of <run> ((run id, weight, priority), the 
+       current scheduler_run by default) may be sent."""
+    run_id, weight, priority = run or _current_run.get()
+    start = time.perf_counter()
+    with self.condition:
+      # The priority's virtual time is that of the last served request, so
+      # a run that was idle does not bank credit for later.
+      tag = (max(self.virtual_time[priority], self.last_tags.get(run_id, 0.0))
+             + 1.0 / weight)
+      self.last_tags[run_id] = tag
+      self.count += 1
+      entry = (REQUEST_PRIORITIES.index(priority), tag, self.count)
+      heapq.heappush(self.queue, entry)
+      stats = self._run_stats(run_id)
+      stats["queued"] += 1
+      self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+
+      while self.active >= self.max_concurrency or self.queue[0] != entry:
+        self.condition.wait()
+      heapq.heappop(self.queue)
+      self.active += 1
+      self.virtual_time[priority] = tag
+
+      wait = time.perf_counter() - start
+      stats["queued"] -= 1
+      stats["active"] += 1
+      stats["requests"] += 1
+      stats["wait"] += wait
+      stats["max_wait"] = max(stats["max_wait"], wait)
+      self.requests += 1
+      self.wait += wait
+      self.max_wait = max(self.max_wait, wait)
+      # The next request may be servable too (e.g. after a cap increase).
+      self.condition.notify_all()
+
+
+  def release(self, run: tuple = None) -> None:
+    run_id = (run or _current_run.get())[0]
+    with self.condition:
+      self.active -= 1
+      self._run_stats(run_id)["active"] -= 1
+      self.condition.notify_all()
+
+
+  @contextlib.contextmanager
+  def slot(self):
+    """Holds one request slot of the current run for the with block."""
+    run = _current_run.get()
+    self.acquire(run)
+    try:
+      yield
+    finally:
+      self.release(run)
+
+
+  def set_max_concurrency(self, max_concurrency: int) -> None:
+    with self.condition:
+      self.max_concurrency = max_concurrency
+      self.condition.notify_all()
+
+
+  def register(self, run_id: str) -> None:
+    with self.condition:
+      self._run_stats(run_id)["users"] += 1
+
+
+  def unregister(self, run_id: str) -> bool:
+    """Forgets the state of <run_id> once no scheduler_run uses it. 
+       Returns whether it was forgotten."""
+    with self.condition:
+      stats = self._run_stats(run_id)
+      stats["users"] -= 1
+      if stats["users"] <= 0 and not stats["queued"] and not stats["active"]:
+        del self.runs[run_id]
+        self.last_tags.pop(run_id, None)
+        return True
+      return False
+
+
+  def package(self, run_id: str = None) -> dict:
+    """Returns the scheduler's queue depth and wait times, with those of 
+       <run_id> when given."""
+    with self.condition:
+      queue_depth = {run: stats["queued"] for run, stats in self.runs.items()
+                     if stats["queued"]}
+      package = {
+        "max_concurrency": self.max_concurrency,
+        "active": self.active,
+        "queue_depth": len(self.queue),
+        "queue_depth_by_run": queue_depth,
+        "max_queue_depth": self.max_queue_depth,
+        "requests": self.requests,
+        "mean_wait": self.wait / self.requests if self.requests else None,
+        "max_wait": self.max_wait}
+      if run_id is not None and run_id in self.runs:
+        stats = self.runs[run_id]
+        package["run"] = {
+          "run_id": run_id,
+          "requests": stats["requests"],
+          "queue_depth": stats["queued"],
+          "mean_wait": (stats["wait"] / stats["requests"] 
+                        if stats["requests"] else None),
+          "max_wait": stats["max_wait"]}
+      return package
+
+
+request_scheduler = RequestScheduler(MAX_CONCURRENT_REQUESTS)
+
+
+@contextlib.contextmanager
+def scheduler_run(run_id: str = None, 
+                  weight: float = 1.0, 
+                  priority: str = "interactive"):
+  """Makes the LLM requests of the with block (and of the threads it starts
+     with in_current_run) requests of the run <run_id> (a new id by 
+     default), with the given fair-share <weight> and <priority> 
+     ('interactive' or 'batch'). Yields the run id."""
+  if priority not in REQUEST_PRIORITIES:
+    raise ValueError(f"Unknown request priority '{priority}'.")
+  if weight <= 0:
+    raise ValueError("The weight of a run must be positive.")
+  run_id = run_id or uuid.uuid4().hex[:16]
+  request_scheduler.register(run_id)
+  token = _current_run.set((run_id, float(weight), priority))
+  try:
+    yield run_id
+  finally:
+    _current_run.reset(token)
+    if request_scheduler.unregister(run_id):
+      for stats in RunStats.instances:
+        stats.discard(run_id)
+
+
+def in_current_run(func: callable) -> callable:
+  """Returns <func> bound to the caller's scheduler run, for functions that
+     run in other threads (such as a thread pool's workers)."""
+  context = contextvars.copy_context()
+  return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
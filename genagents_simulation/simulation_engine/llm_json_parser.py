@@ -2,56 +2,182 @@ import json
 import re
 
 
+_json_decoder = json.JSONDecoder()
+
+# Curly quotes that models sometimes write in place of JSON quotes. 
+_CURLY_QUOTES = str.maketrans({"“": "\"", "”": "\"", "‘": "'", "’": "'"})
+
+
 def extract_first_json_dict(input_str):
-  try:
-    # Replace curly quotes with standard double quotes
-    input_str = (input_str.replace("“", "\"")
-                          .replace("”", "\"")
-                          .replace("‘", "'")
-                          .replace("’", "'"))
-    
-    # Find the first occurrence of '{' in the input_str
-    start_index = input_str.index('{')
-    
-    # Initialize a count to keep track of open and close braces
-    count = 1
-    end_index = start_index + 1
-    
-    # Loop to find the closing '}' for the first JSON dictionary
-    while count > 0 and end_index < len(input_str):
-        if input_str[end_index] == '{':
-            count += 1
-        elif input_str[end_index] == '}':
-            count -= 1
-        end_index += 1
-    
-    # Extract the JSON substring
-    json_str = input_str[start_index:end_index]
-    
-    # Parse the JSON string into a Python dictionary
-    json_dict = json.loads(json_str)
-    
-    return json_dict
-  except ValueError:
-    # Handle the case where the JSON parsing fails
+  """
+  Parsing the first JSON object in <input_str>, ignoring any text around 
+  it. The object is decoded from its first '{' by json's raw_decode, which
+  understands strings (so a '}' in a reasoning string does not end it) and 
+  stops at the end of the object. Curly quotes are replaced with straight 
+  quotes only if the object does not parse as it is. 
+
+  Returns: 
+    The dictionary, or None if there is no (valid) JSON object
+  """
+  start_index = input_str.find("{")
+  if start_index < 0: 
+    return None
+  try: 
+    return _json_decoder.raw_decode(input_str, start_index)[0]
+  except ValueError: 
+    pass
+
+  normalized = input_str.translate(_CURLY_QUOTES)
+  if normalized == input_str: 
+    return None
+  try: 
+    return _json_decoder.raw_decode(normalized, start_index)[0]
+  except ValueError: 
     return None
 
 
+def _extract_response_fields(input_str): 
+  """
+  Returns the "Response" and "Reasoning" values of the per-question entries
+  of the first JSON object in <input_str>, in question order, or None if 
+  it is not such an object. A response that is only the object (such as 
+  a structured output) is parsed directly. 
+  """
+  try: 
+    json_dict = json.loads(input_str)
+  except ValueError: 
+    json_dict = extract_first_json_dict(input_str)
+  if not isinstance(json_dict, dict) or not json_dict: 
+    return None
+  entries = list(json_dict.values())
+  if not all(isinstance(entry, dict) and "Response" in entry 
+             for entry in entries): 
+    return None
+  return ([entry["Response"] for entry in entries], 
+          [entry.get("Reasoning", "") for entry in entries])
+
+
 def extract_first_json_dict_categorical(input_str): 
-  reasoning_pattern = r'"Reasoning":\s*"([^"]+)"'
-  response_pattern = r'"Response":\s*"([^"]+)"'
+  fields = _extract_response_fields(input_str)
+  if fields is not None: 
+    return [str(response) for response in fields[0]], fields[1]
+
+  # Falling back on the fields of output that is not valid JSON, whose 
+  # strings may also be single quoted. 
+  reasoning_pattern = r'"Reasoning":\s*"([^"]+)"|\'Reasoning\':\s*\'([^\']+)\''
+  response_pattern = r'"Response":\s*"([^"]+)"|\'Response\':\s*\'([^\']+)\''
 
-  reasonings = re.findall(reasoning_pattern, input_str)
-  responses = re.findall(response_pattern, input_str)
+  reasonings = ["".join(groups) for groups in 
+                re.findall(reasoning_pattern, input_str)]
+  responses = ["".join(groups) for groups in 
+               re.findall(response_pattern, input_str)]
 
   return responses, reasonings
 
 
 def extract_first_json_dict_numerical(input_str): 
-  reasoning_pattern = re.compile(r'"Reasoning":\s*"([^"]+)"')
-  response_pattern = re.compile(r'"Response":\s*(\d+\.?\d*)')
+  fields = _extract_response_fields(input_str)
+  if fields is not None and all(
+      isinstance(response, (int, float)) 
+      or re.fullmatch(r"\s*-?\d+\.?\d*\s*", str(response)) 
+      for response in fields[0]): 
+    return [str(response).strip() for response in fields[0]], fields[1]
+
+  reasoning_pattern = re.compile(
+    r'"Reasoning":\s*"([^"]+)"|\'Reasoning\':\s*\'([^\']+)\'')
+  response_pattern = re.compile(
+    r'["\']Response["\']:\s*["\']?(-?\d+\.?\d*)')
 
-  reasonings = reasoning_pattern.findall(input_str)
+  reasonings = ["".join(groups) for groups in 
+                reasoning_pattern.findall(input_str)]
   responses = response_pattern.findall(input_str)
   return responses, reasonings
 
+
+# The only characters that change the state of FirstJSONObjectScanner. 
+_JSON_SCANNER_CHARS = re.compile(r'[{}"\\]')
+
+
+class FirstJSONObjectScanner: 
+  """
+  Incrementally finds where the first JSON object of a streamed response 
+  ends. Text before the first '{' is skipped, and braces inside JSON 
+  strings (including escaped quotes) are not counted, so a '}' in a 
+  reasoning string does not end the object early. Only braces, quotes and
+  backslashes are visited, so long strings are skipped at regex speed. 
+  """
+  def __init__(self): 
+    self.chunks = []
+    self.length = 0
+    self.start = None
+    self.end = None
+    self.depth = 0
+    self.in_string = False
+    self.escaped_at = None
+
+
+  def feed(self, chunk): 
+    """
+    Scanning the next <chunk> of the response. 
+
+    Returns: 
+      True once the first JSON object is complete
+    """
+    if self.end is not None: 
+      return True
+    offset = self.length
+    self.chunks += [chunk]
+    self.length += len(chunk)
+
+    for match in _JSON_SCANNER_CHARS.finditer(chunk): 
+      index = offset + match.start()
+      char = match.group()
+      if index == self.escaped_at: 
+        continue
+      if self.start is None: 
+        if char == "{": 
+          self.start = index
+          self.depth = 1
+        continue
+      if self.in_string: 
+        if char == "\\": 
+          self.escaped_at = index + 1
+        elif char == '"': 
+          self.in_string = False
+      elif char == '"': 
+        self.in_string = True
+      elif char == "{": 
+        self.depth += 1
+      elif char == "}": 
+        self.depth -= 1
+        if self.depth == 0: 
+          self.end = index + 1
+          return True
+    return False
+
+
+  def text(self): 
+    """
+    Returns the response scanned so far. 
+    """
+    return "".join(self.chunks)
+
+
+  def first_object(self): 
+    """
+    Returns the text of the first JSON object, or None while it is not 
+    complete. 
+    """
+    if self.end is None: 
+      return None
+    return self.text()[self.start:self.end]
+
+
+  def first_dict(self): 
+    """
+    Returns the first JSON object parsed with extract_first_json_dict, or 
+    None while it is not complete (or if it is not valid JSON). 
+    """
+    if self.end is None: 
+      return None
+    return extract_first_json_dict(self.first_object())
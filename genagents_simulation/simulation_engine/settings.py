@@ -11,12 +11,21 @@ KEY_OWNER = "host"
 
 DEBUG = False
 
-MAX_CHUNK_SIZE = 4
+MAX_CHUNK_SIZE = 10
+
+MAX_WORKERS = 16
+
+MAX_CONCURRENT_REQUESTS = 32
 
 LLM_VERS = "gpt-4o-mini"
 
+EMBEDDING_MODEL = "openai/text-embedding-3-small"
+
+DESCRIPTION_CACHE_MAX_CHARS = 50_000_000
+
 BASE_DIR = f"{Path(__file__).resolve().parent.parent}"
 
 # To do: Are the following needed in the new structure? Ideally Populations_Dir is for the user to define.
 POPULATIONS_DIR = f"{BASE_DIR}/agent_bank/populations"
 LLM_PROMPT_DIR = f"{BASE_DIR}/simulation_engine/prompt_template"
+BATCH_JOB_DIR = f"{BASE_DIR}/batch_jobs"
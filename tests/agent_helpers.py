@@ -0,0 +1,59 @@
+import numpy as np
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.simulation_engine.embedding_providers import (
+    get_embedding_provider,
+)
+
+
+# An offline embedding model, so agents can be built and saved without API
+# calls.
+EMBEDDING_MODEL = "local/hashing-64"
+
+MEMORIES = ["I grew up on a farm in Iowa.",
+            "I work as a nurse at the county hospital.",
+            "I voted in every election since I turned eighteen.",
+            "My daughter moved to Chicago last spring.",
+            "I volunteer at the food bank on weekends."]
+
+
+def add_memories(agent, memories, time_step=1):
+    """
+    Adds <memories> as observations without asking the LLM for their
+    importance.
+    """
+    agent.memory_stream._add_nodes(time_step, "observation", memories,
+                                   [5] * len(memories), None)
+
+
+def agent_state(agent):
+    """
+    Returns what an agent round trip must keep: its scratch, its packaged
+    nodes, and the embedding of every content.
+    """
+    stream = agent.memory_stream
+    contents = stream.get_contents_by_row()
+    return {"scratch": dict(agent.scratch),
+            "nodes": stream.package_nodes(),
+            "embeddings": {content: np.asarray(stream.matrix.get(row))
+                           for row, content in enumerate(contents)}}
+
+
+def assert_same_state(agent, expected):
+    state = agent_state(agent)
+    assert state["scratch"] == expected["scratch"]
+    assert state["nodes"] == expected["nodes"]
+    assert state["embeddings"].keys() == expected["embeddings"].keys()
+    for content, vector in expected["embeddings"].items():
+        np.testing.assert_allclose(state["embeddings"][content], vector,
+                                   rtol=1e-6, atol=1e-9)
+
+
+def make_agent(memories=MEMORIES, first_name="Ada"):
+    agent = GenerativeAgent()
+    agent.scratch = {"first_name": first_name, "last_name": "Lovelace",
+                     "age": 40}
+    agent.memory_stream.embedding_provider = get_embedding_provider(
+        EMBEDDING_MODEL)
+    add_memories(agent, memories)
+    return agent
@@ -0,0 +1,167 @@
+import json
+import random
+
+import numpy as np
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.genagents.modules.ann_index import (
+    IVFIndex,
+    normalize_rows,
+)
+
+from tests.agent_helpers import add_memories, make_agent
+
+
+def _clustered(n_rows, dim=32, n_clusters=40, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    labels = rng.randint(n_clusters, size=n_rows)
+    return centers[labels] + rng.normal(size=(n_rows, dim))
+
+
+def _recall(index, vectors, queries, k):
+    vectors = normalize_rows(vectors)
+    hits = 0
+    for query in normalize_rows(queries):
+        exact = np.argpartition(-(vectors @ query), k - 1)[:k]
+        hits += len(np.intersect1d(exact, index.search(query)))
+    return hits / (k * len(queries))
+
+
+def _memories(count, seed=0):
+    # Short sentences over a small vocabulary, so that the hashed embeddings
+    # share n-grams.
+    rng = random.Random(seed)
+    people = ["my sister", "my neighbor", "the nurse", "my son", "a farmer",
+              "the mayor", "my friend", "the teacher"]
+    verbs = ["talked about", "worried about", "laughed about", "voted on",
+             "read about", "argued over", "planned", "forgot"]
+    things = ["the harvest", "taxes", "the election", "the hospital",
+              "church", "the weather", "school", "the food bank", "prices",
+              "the river"]
+    return [f"On day {count}, {rng.choice(people)} {rng.choice(verbs)} "
+            f"{rng.choice(things)}." for count in range(count)]
+
+
+def test_build_calibrates_n_probe_to_the_recall_target():
+    vectors, queries = np.split(_clustered(3200), [3000])
+    index = IVFIndex(recall_target=0.9, min_size=1000, calibration_k=50)
+    assert index.needs_rebuild()
+    index.build(vectors)
+
+    assert len(index) == index.built_size == 3000
+    assert len(index.centroids) == int(np.sqrt(3000))
+    assert sorted(row for rows in index.lists for row in rows) == \
+        list(range(3000))
+    assert 0 < index.n_probe < len(index.centroids)
+    # Calibration samples stored vectors, but new queries from the same
+    # distribution reach the target too.
+    assert _recall(index, vectors, queries, 50) >= index.recall_target
+    assert not index.needs_rebuild()
+
+    # A higher target probes more clusters.
+    assert index.calibrate(normalize_rows(vectors)) == index.n_probe
+    index.recall_target = 0.99
+    assert index.calibrate(normalize_rows(vectors)) > index.n_probe
+
+
+def test_add_keeps_the_lists_and_triggers_rebuilds():
+    vectors = _clustered(1200)
+    index = IVFIndex(min_size=100)
+    index.build(vectors[:400])
+    capacities = set()
+    for row in range(400, 1200):
+        index.add(row, vectors[row])
+        capacities.add(len(index._assignments))
+        # The clusters are fixed, so the index grows past twice its built
+        # size before it is rebuilt.
+        assert index.needs_rebuild() == (row >= 800)
+    # The buffer doubled a few times instead of growing with every row.
+    assert len(capacities) <= 3
+    assert len(index) == 1200
+
+    added = index.assignments.copy()
+    lists = [sorted(rows) for rows in index.lists]
+    index._assign_all(normalize_rows(vectors))
+    np.testing.assert_array_equal(added, index.assignments)
+    assert lists == [list(rows) for rows in index.lists]
+
+    index.build(vectors)
+    assert not index.needs_rebuild()
+
+
+def test_package_round_trips():
+    vectors = _clustered(600)
+    index = IVFIndex(recall_target=0.8, min_size=100, n_lists=12, seed=3)
+    index.build(vectors[:500])
+    for row in range(500, 600):
+        index.add(row, vectors[row])
+
+    loaded = IVFIndex.from_package(json.loads(json.dumps(index.package())))
+    assert loaded.package() == index.package()
+    assert len(loaded) == 600
+    assert not loaded.needs_rebuild()
+    for query in normalize_rows(vectors[:20]):
+        np.testing.assert_array_equal(np.sort(loaded.search(query)),
+                                      np.sort(index.search(query)))
+
+    assert IVFIndex.from_package(IVFIndex().package()).needs_rebuild()
+
+
+def test_retrieve_with_the_index_matches_exact_retrieval():
+    memories = _memories(1500)
+    agent = make_agent(memories)
+    stream = agent.memory_stream
+    # Memories the stream does not have.
+    queries = _memories(20, seed=1)
+
+    def retrieve():
+        retrieved = stream.retrieve(queries, time_step=2, n_count=30,
+                                    hp=[0, 1, 0])
+        return {query: {node.content for node in nodes}
+                for query, nodes in retrieved.items()}
+
+    exact = retrieve()
+    index = stream.attach_index(IVFIndex(recall_target=0.9, min_size=1000,
+                                         calibration_k=30))
+    approximate = retrieve()
+    # The index is built at the first retrieval over more than <min_size>
+    # nodes.
+    assert index.centroids is not None and len(index) == len(stream.matrix)
+    assert index.n_probe < len(index.centroids)
+    hits = sum(len(exact[query] & approximate[query]) for query in queries)
+    assert hits / (30 * len(queries)) >= index.recall_target
+
+    # New memories are added to the index without rebuilding it.
+    centroids = index.centroids
+    add_memories(agent, ["The election was on the radio again."], 3)
+    assert len(index) == len(stream.matrix)
+    assert index.centroids is centroids
+
+
+def test_stale_index_is_rebuilt_after_loading(tmp_path):
+    agent_folder = str(tmp_path / "agent")
+    agent = make_agent(_memories(300))
+    index = agent.memory_stream.attach_index(IVFIndex(min_size=200))
+    agent.memory_stream.retrieve(["the election"], time_step=2)
+    assert index.centroids is not None
+    agent.save(agent_folder, compact=True)
+
+    # An index saved for the same nodes is loaded as is.
+    loaded = GenerativeAgent(agent_folder).memory_stream.index
+    assert loaded.package() == index.package()
+    with open(f"{agent_folder}/memory_stream/ann_index.json") as json_file:
+        stale_package = json_file.read()
+
+    # An index saved for fewer nodes than the agent now has is reset, and
+    # rebuilt over all the rows at the next retrieval.
+    add_memories(agent, _memories(50, seed=1), time_step=3)
+    agent.save(agent_folder, compact=True)
+    with open(f"{agent_folder}/memory_stream/ann_index.json", "w") as json_file:
+        json_file.write(stale_package)
+    stream = GenerativeAgent(agent_folder).memory_stream
+    assert stream.index.centroids is None
+    assert stream.index.min_size == 200
+    stream.retrieve(["the election"], time_step=4)
+    assert stream.index.centroids is not None
+    assert len(stream.index) == len(stream.matrix) == 350
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from genagents_simulation.genagents import batch_jobs
+from genagents_simulation.simulation_engine import gpt_structure
+
+from tests.agent_helpers import make_agent
+
+
+ANSWERS = {"Ada": "Yes", "Carl": "no."}
+
+
+def _gpt_request(prompt, model="gpt-4o", max_tokens=1500,
+                 response_format=None):
+    # Bob's request fails; the others answer by name.
+    if "Bob" in prompt:
+        return "GENERATION ERROR"
+    name = next(name for name in ANSWERS if name in prompt)
+    return json.dumps({"1": {"Reasoning": f"{name} thinks so",
+                             "Response": ANSWERS[name]}})
+
+
+@pytest.fixture
+def batch_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, "BATCH_JOB_DIR", str(tmp_path))
+    monkeypatch.setattr(gpt_structure, "BATCH_JOB_DIR", str(tmp_path))
+    monkeypatch.setattr(gpt_structure, "gpt_request", _gpt_request)
+    return tmp_path
+
+
+def test_synchronous_batch_round_trips_to_the_agents(batch_dir):
+    agents = [make_agent(first_name=name) for name in ["Carl", "Bob", "Ada"]]
+    questions = {"Do you vote?": ["Yes", "No"]}
+    job = batch_jobs.submit_survey_job(agents, questions, "synchronous")
+    assert job["agent_ids"] == [str(agent.id) for agent in agents]
+
+    job, responses = batch_jobs.collect_survey_job(
+        job["id"], wait=True, poll_interval=0.01, timeout=10)
+    assert job["status"] == "completed"
+    # Results are mapped back by position, and the failed line is None.
+    assert responses == [
+        {"responses": ["No"], "reasonings": ["Carl thinks so"]},
+        None,
+        {"responses": ["Yes"], "reasonings": ["Ada thinks so"]}]
+    # Collecting again reads the saved results.
+    assert batch_jobs.collect_survey_job(job["id"])[1] == responses
+
+
+def test_batch_client_must_be_configured(batch_dir):
+    agents = [make_agent()]
+    for name in [None, "batch"]:
+        with pytest.raises(ValueError):
+            batch_jobs.submit_survey_job(agents, {"Q": ["Yes", "No"]}, name)
+    # Nothing was written for the rejected jobs.
+    assert list(batch_dir.iterdir()) == []
+
+
+def test_unknown_batch_job(batch_dir):
+    with pytest.raises(ValueError):
+        batch_jobs.collect_survey_job("missing")
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.genagents.modules.embedding_matrix import (
+    DenseMatrix,
+    load_matrix,
+    package_matrix,
+    quantize_matrix,
+)
+from genagents_simulation.genagents.population import quantize_population
+
+from tests.agent_helpers import MEMORIES, make_agent
+
+
+def _dense(n_rows=64, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = DenseMatrix()
+    for vector in rng.normal(size=(n_rows, dim)):
+        matrix.append(vector)
+    return matrix
+
+
+@pytest.mark.parametrize("kind", ["float", "int8", "pq"])
+def test_package_round_trips_every_kind(kind):
+    matrix = quantize_matrix(_dense(), kind)
+    loaded = load_matrix(package_matrix(matrix))
+    assert loaded.kind == matrix.kind == kind
+    assert len(loaded) == len(matrix)
+    np.testing.assert_allclose(loaded.to_dense(), matrix.to_dense())
+
+
+@pytest.mark.parametrize("kind, min_cosine", [("int8", 0.99), ("pq", 0.5)])
+def test_quantized_rows_approximate_the_originals(kind, min_cosine):
+    dense = _dense()
+    original = dense.to_dense()
+    approximate = quantize_matrix(dense, kind).to_dense()
+    cosines = (original * approximate).sum(1) / (
+        np.linalg.norm(original, axis=1) * np.linalg.norm(approximate, axis=1))
+    assert cosines.min() > min_cosine
+
+
+@pytest.mark.parametrize("kind", ["int8", "pq"])
+def test_quantized_agent_round_trips(tmp_path, kind):
+    agent_folder = str(tmp_path / "agent")
+    agent = make_agent()
+    agent.memory_stream.quantize(kind)
+    agent.save(agent_folder)
+    assert os.path.exists(f"{agent_folder}/memory_stream/embeddings_q.npz")
+
+    loaded = GenerativeAgent(agent_folder)
+    assert loaded.memory_stream.matrix.kind == kind
+    assert loaded.memory_stream.package_nodes() == \
+        agent.memory_stream.package_nodes()
+    assert loaded.memory_stream.get_contents_by_row() == \
+        agent.memory_stream.get_contents_by_row()
+    np.testing.assert_allclose(loaded.memory_stream.matrix.to_dense(),
+                               agent.memory_stream.matrix.to_dense())
+
+
+def test_quantize_population(tmp_path):
+    population_folder = str(tmp_path / "population")
+    make_agent(MEMORIES).save(f"{population_folder}/ada")
+    make_agent(MEMORIES[:2], "Bob").save(f"{population_folder}/bob")
+    assert quantize_population(population_folder, "int8",
+                               keep_full_precision=False) == 2
+
+    for name in ["ada", "bob"]:
+        agent_folder = f"{population_folder}/{name}"
+        assert not os.path.exists(
+            f"{agent_folder}/memory_stream/embeddings_unit.npz")
+        assert GenerativeAgent(agent_folder).memory_stream.matrix.kind == \
+            "int8"
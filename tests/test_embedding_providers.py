@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from genagents_simulation.genagents.genagents import (
+    GenerativeAgent,
+    read_population_meta,
+)
+from genagents_simulation.genagents.modules.embedding_store import (
+    get_embedding_store,
+)
+from genagents_simulation.genagents.population import reembed_population
+from genagents_simulation.simulation_engine.embedding_providers import (
+    HashingEmbeddingProvider,
+    OpenAIEmbeddingProvider,
+    get_embedding_provider,
+)
+
+from tests.agent_helpers import MEMORIES, make_agent
+
+
+def test_hashing_embeddings_are_unit_length_and_deterministic():
+    provider = HashingEmbeddingProvider(64)
+    vectors = np.array(provider.embed(MEMORIES))
+    assert vectors.shape == (len(MEMORIES), 64)
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0)
+    assert provider.embed(MEMORIES) == HashingEmbeddingProvider(64).embed(
+        MEMORIES)
+    assert provider.embed_one("!!!") == [0.0] * 64
+
+
+def test_hashing_embeddings_reflect_shared_words():
+    provider = HashingEmbeddingProvider()
+    query, close, far = np.array(provider.embed(
+        ["I work as a nurse", "She works as a nurse at night",
+         "The stock market fell sharply"]))
+    assert query @ close > query @ far
+
+
+def test_get_embedding_provider_names():
+    assert get_embedding_provider("local/hashing-64") is \
+        get_embedding_provider("local/hashing-64")
+    assert get_embedding_provider("local/hashing-128").dim == 128
+    openai_provider = get_embedding_provider("openai/text-embedding-3-large")
+    assert isinstance(openai_provider, OpenAIEmbeddingProvider)
+    assert openai_provider.model == "text-embedding-3-large"
+    assert get_embedding_provider("text-embedding-3-small").name == \
+        "openai/text-embedding-3-small"
+    with pytest.raises(ValueError):
+        get_embedding_provider("other/model")
+
+
+def test_agent_keeps_its_embedding_model(tmp_path):
+    agent_folder = str(tmp_path / "agent")
+    make_agent().save(agent_folder)
+    loaded = GenerativeAgent(agent_folder)
+    assert loaded.memory_stream.embedding_provider.name == "local/hashing-64"
+
+
+def test_reembed_population_round_trips(tmp_path):
+    population_folder = str(tmp_path / "population")
+    make_agent(MEMORIES).save(f"{population_folder}/ada")
+    make_agent(MEMORIES[:2], "Bob").save(f"{population_folder}/bob")
+
+    assert reembed_population(population_folder, "local/hashing-128") == 2
+    assert read_population_meta(population_folder)["embedding_model"] == \
+        "local/hashing-128"
+    provider = get_embedding_provider("local/hashing-128")
+    for name, memories in [("ada", MEMORIES), ("bob", MEMORIES[:2])]:
+        stream = GenerativeAgent(f"{population_folder}/{name}").memory_stream
+        assert stream.embedding_provider is provider
+        contents = stream.get_contents_by_row()
+        assert contents == memories
+        np.testing.assert_allclose(stream.matrix.to_dense(),
+                                   provider.embed(contents), atol=1e-12)
+    # Agents already on the model are left as they are.
+    assert reembed_population(population_folder, "local/hashing-128") == 0
+
+
+def test_store_rejects_vectors_of_another_model(tmp_path):
+    store = get_embedding_store(str(tmp_path / "store"))
+    make_agent().memory_stream.share_embeddings(store)
+    agent = make_agent()
+    agent.memory_stream.embedding_provider = get_embedding_provider(
+        "local/hashing-128")
+    with pytest.raises(ValueError):
+        agent.memory_stream.share_embeddings(store)
@@ -0,0 +1,174 @@
+import os
+import shutil
+
+import numpy as np
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.genagents.modules.embedding_store import (
+    EmbeddingStore,
+    content_hash,
+    get_embedding_store,
+    read_embedding_refs,
+    release_embedding_refs,
+    write_embedding_refs,
+)
+from genagents_simulation.genagents.population import (
+    migrate_to_embedding_store,
+)
+
+from tests.agent_helpers import (
+    MEMORIES,
+    add_memories,
+    agent_state,
+    assert_same_state,
+    make_agent,
+)
+
+
+def _refcount(store, content):
+    return int(store.refcounts[store.key_to_row[content_hash(content)]])
+
+
+def _population(tmp_path):
+    population_folder = str(tmp_path / "population")
+    agents = {"ada": make_agent(MEMORIES),
+              "bob": make_agent(MEMORIES[:3] + ["I fix bicycles."], "Bob")}
+    for name, agent in agents.items():
+        agent.save(f"{population_folder}/{name}")
+    return population_folder, agents
+
+
+def test_migrated_population_round_trips(tmp_path):
+    population_folder, agents = _population(tmp_path)
+    states = {name: agent_state(agent) for name, agent in agents.items()}
+    result = migrate_to_embedding_store(population_folder)
+
+    # The memories both agents have are stored once, with two references.
+    assert result == {"agents": 2, "references": 9, "vectors": 6}
+    store = get_embedding_store(f"{population_folder}/embedding_store")
+    assert _refcount(store, MEMORIES[0]) == 2
+    assert _refcount(store, MEMORIES[4]) == 1
+
+    for name, state in states.items():
+        agent_folder = f"{population_folder}/{name}"
+        assert not os.path.exists(
+            f"{agent_folder}/memory_stream/embeddings_unit.npz")
+        store_folder, refs = read_embedding_refs(
+            f"{agent_folder}/memory_stream")
+        assert store_folder == store.store_folder
+        assert refs == {content: content_hash(content)
+                        for content in state["embeddings"]}
+        agent = GenerativeAgent(agent_folder)
+        assert agent.memory_stream.matrix.kind == "shared"
+        assert_same_state(agent, state)
+
+
+def test_store_reloads_from_disk(tmp_path):
+    population_folder, _ = _population(tmp_path)
+    migrate_to_embedding_store(population_folder)
+    store = get_embedding_store(f"{population_folder}/embedding_store")
+    reloaded = EmbeddingStore(store.store_folder)
+    assert reloaded.keys == store.keys
+    assert reloaded.refcounts[:len(reloaded)].tolist() == \
+        store.refcounts[:len(store)].tolist()
+    assert (reloaded.matrix.to_dense() == store.matrix.to_dense()).all()
+
+
+def test_saving_a_shared_agent_updates_its_references(tmp_path):
+    population_folder, _ = _population(tmp_path)
+    migrate_to_embedding_store(population_folder)
+    store = get_embedding_store(f"{population_folder}/embedding_store")
+    agent_folder = f"{population_folder}/bob"
+
+    agent = GenerativeAgent(agent_folder)
+    add_memories(agent, [MEMORIES[4], "I sold my old truck."], time_step=2)
+    agent.save(agent_folder, compact=True)
+    assert _refcount(store, MEMORIES[4]) == 2
+    assert _refcount(store, "I sold my old truck.") == 1
+    assert_same_state(GenerativeAgent(agent_folder), agent_state(agent))
+
+    # Writing fewer references releases the dropped ones.
+    refs = {MEMORIES[0]: content_hash(MEMORIES[0])}
+    write_embedding_refs(f"{agent_folder}/memory_stream", store, refs)
+    assert _refcount(store, MEMORIES[0]) == 2
+    assert _refcount(store, MEMORIES[4]) == 1
+    assert _refcount(store, "I fix bicycles.") == 0
+    assert EmbeddingStore(store.store_folder).refcounts[
+        store.key_to_row[content_hash("I fix bicycles.")]] == 0
+
+
+def test_release_embedding_refs(tmp_path):
+    population_folder, _ = _population(tmp_path)
+    migrate_to_embedding_store(population_folder)
+    store = get_embedding_store(f"{population_folder}/embedding_store")
+    memory_stream_folder = f"{population_folder}/ada/memory_stream"
+
+    release_embedding_refs(memory_stream_folder)
+    assert read_embedding_refs(memory_stream_folder) == (None, {})
+    assert _refcount(store, MEMORIES[0]) == 1
+    assert _refcount(store, MEMORIES[4]) == 0
+    # Releasing again is a no-op.
+    release_embedding_refs(memory_stream_folder)
+    assert _refcount(store, MEMORIES[0]) == 1
+
+
+def test_agent_saves_append_to_the_index_log(tmp_path, monkeypatch):
+    population_folder = str(tmp_path / "population")
+    for count in range(40):
+        make_agent([f"Memory {count} of agent {count}.", MEMORIES[0]],
+                   f"Agent{count}").save(f"{population_folder}/{count}")
+    rewrites = []
+    write_index = EmbeddingStore._write_index
+    monkeypatch.setattr(EmbeddingStore, "_write_index",
+                        lambda store: rewrites.append(1) or write_index(store))
+
+    migrate_to_embedding_store(population_folder)
+    # Each of the 80 store saves appends to the log; index.json is only
+    # rewritten when the log outgrows it.
+    assert len(rewrites) <= 10
+    store = get_embedding_store(f"{population_folder}/embedding_store")
+    assert os.path.exists(f"{store.store_folder}/index_log.jsonl")
+    assert _refcount(store, MEMORIES[0]) == 40
+
+    reloaded = EmbeddingStore(store.store_folder)
+    assert reloaded.keys == store.keys
+    assert reloaded.refcounts[:len(reloaded)].tolist() == \
+        store.refcounts[:len(store)].tolist()
+    assert (reloaded.matrix.to_dense() == store.matrix.to_dense()).all()
+
+
+def test_index_log_survives_crashes(tmp_path):
+    store_folder = str(tmp_path / "store")
+    store = EmbeddingStore(store_folder)
+    store.add("a", [1.0, 0.0])
+    store.update_refs(["a"], [])
+    store.save()
+    store.add("b", [0.0, 1.0])
+    store.update_refs(["b"], [])
+    store.save()
+    log_file_name = f"{store_folder}/index_log.jsonl"
+    shutil.copy(log_file_name, f"{tmp_path}/old_log.jsonl")
+
+    # A save that crashed after its vectors, before its log line ended.
+    with open(f"{store_folder}/vectors.f64", "ab") as vector_file:
+        vector_file.write(b"\0" * 16)
+    with open(log_file_name, "ab") as log_file:
+        log_file.write(b'{"generation": ')
+    reloaded = EmbeddingStore(store_folder)
+    assert reloaded.keys == ["a", "b"]
+    assert reloaded.refcounts[:2].tolist() == [1, 1]
+    reloaded.add("c", [1.0, 1.0])
+    reloaded.save()
+    assert EmbeddingStore(store_folder).keys == ["a", "b", "c"]
+    np.testing.assert_array_equal(
+        EmbeddingStore(store_folder).matrix.to_dense(),
+        [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]])
+
+    # A log left behind by a crash after index.json was rewritten belongs
+    # to the previous generation and is not replayed.
+    reloaded.update_refs([], ["a"])
+    reloaded.save(rewrite_index=True)
+    shutil.copy(f"{tmp_path}/old_log.jsonl", log_file_name)
+    final = EmbeddingStore(store_folder)
+    assert final.keys == ["a", "b", "c"]
+    assert final.refcounts[:3].tolist() == [0, 1, 0]
@@ -0,0 +1,87 @@
+import json
+import os
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+
+from tests.agent_helpers import (
+    add_memories,
+    agent_state,
+    assert_same_state,
+    make_agent,
+)
+
+
+def test_fork_does_not_change_its_parent():
+    agent = make_agent()
+    expected = agent_state(agent)
+    branch = agent.fork()
+    add_memories(branch, ["I moved to Denver."], time_step=2)
+    branch.update_scratch({"age": 41})
+    assert_same_state(agent, expected)
+    assert branch.memory_stream.count_nodes() == \
+        agent.memory_stream.count_nodes() + 1
+
+
+def test_fork_of_a_saved_agent_round_trips_as_a_fork_folder(tmp_path):
+    parent_folder = str(tmp_path / "agent")
+    fork_folder = str(tmp_path / "fork")
+    agent = make_agent()
+    agent.save(parent_folder)
+    parent_state = agent_state(agent)
+
+    branch = agent.fork()
+    add_memories(branch, ["I moved to Denver."], time_step=2)
+    branch.update_scratch({"age": 41})
+    branch.save(fork_folder)
+
+    # The fork folder only holds its changes.
+    with open(f"{fork_folder}/fork.json") as json_file:
+        fork = json.load(json_file)
+    assert fork["nodes"] == agent.memory_stream.count_nodes()
+    assert os.path.abspath(os.path.join(fork_folder, fork["parent"])) == \
+        os.path.abspath(parent_folder)
+    assert not os.path.exists(f"{fork_folder}/memory_stream/nodes.json")
+    with open(f"{fork_folder}/scratch.json") as json_file:
+        assert json.load(json_file) == {"age": 41}
+
+    assert_same_state(GenerativeAgent(fork_folder), agent_state(branch))
+    assert_same_state(GenerativeAgent(parent_folder), parent_state)
+
+
+def test_saved_fork_keeps_appending_its_changes(tmp_path):
+    parent_folder = str(tmp_path / "agent")
+    fork_folder = str(tmp_path / "fork")
+    agent = make_agent()
+    agent.save(parent_folder)
+    branch = agent.fork()
+    branch.save(fork_folder)
+
+    loaded = GenerativeAgent(fork_folder)
+    add_memories(loaded, ["I started learning the cello."], time_step=3)
+    loaded.save(fork_folder)
+    assert os.path.exists(f"{fork_folder}/fork.json")
+    assert_same_state(GenerativeAgent(fork_folder), agent_state(loaded))
+
+
+def test_fork_of_an_unsaved_agent_is_saved_in_full(tmp_path):
+    fork_folder = str(tmp_path / "fork")
+    branch = make_agent().fork()
+    add_memories(branch, ["I moved to Denver."], time_step=2)
+    branch.save(fork_folder)
+
+    assert not os.path.exists(f"{fork_folder}/fork.json")
+    assert os.path.exists(f"{fork_folder}/memory_stream/nodes.json")
+    assert_same_state(GenerativeAgent(fork_folder), agent_state(branch))
+
+
+def test_compacting_a_fork_detaches_it_from_its_parent(tmp_path):
+    parent_folder = str(tmp_path / "agent")
+    fork_folder = str(tmp_path / "fork")
+    agent = make_agent()
+    agent.save(parent_folder)
+    branch = agent.fork()
+    add_memories(branch, ["I moved to Denver."], time_step=2)
+    branch.save(fork_folder, compact=True)
+
+    assert not os.path.exists(f"{fork_folder}/fork.json")
+    assert_same_state(GenerativeAgent(fork_folder), agent_state(branch))
@@ -0,0 +1,37 @@
+from types import SimpleNamespace
+
+from genagents_simulation.simulation_engine.gpt_structure import (
+    scheduler_run,
+    usage_stats,
+)
+
+
+def test_usage_stats_counts_cached_tokens_of_dict_details():
+    # openai 1.6.0 does not declare prompt_tokens_details, so it is a dict.
+    response = SimpleNamespace(usage=SimpleNamespace(
+        prompt_tokens=100, completion_tokens=5,
+        prompt_tokens_details={"cached_tokens": 64}))
+    with scheduler_run():
+        usage_stats.record(response, latency=0.5)
+        package = usage_stats.package()
+    assert package["requests"] == 1
+    assert package["prompt_tokens"] == 100
+    assert package["cached_tokens"] == 64
+    assert package["completion_tokens"] == 5
+    assert package["cached_ratio"] == 0.64
+
+
+def test_usage_stats_counts_model_and_missing_details():
+    with scheduler_run():
+        usage_stats.record(SimpleNamespace(usage=SimpleNamespace(
+            prompt_tokens=50, completion_tokens=2,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=32))))
+        usage_stats.record(SimpleNamespace(usage={
+            "prompt_tokens": 10, "completion_tokens": 1,
+            "prompt_tokens_details": None}))
+        usage_stats.record(SimpleNamespace(usage=None))
+        package = usage_stats.package()
+    assert package["requests"] == 3
+    assert package["prompt_tokens"] == 60
+    assert package["cached_tokens"] == 32
+    assert package["completion_tokens"] == 3
@@ -0,0 +1,194 @@
+import json
+
+import pytest
+
+from genagents_simulation.genagents.modules import interaction
+from genagents_simulation.genagents.modules.interaction import (
+    ASK_ANSWER_TOKENS,
+    _main_agent_desc,
+    categorical_resp_samples,
+    chunk_questions,
+    estimate_answer_tokens,
+    prepare_agent_descs,
+    render_persona,
+)
+from genagents_simulation.genagents.modules.response_validation import (
+    response_stats,
+    validate_numerical_resp,
+)
+from genagents_simulation.simulation_engine.gpt_structure import (
+    estimate_tokens,
+    scheduler_run,
+)
+
+from tests.agent_helpers import MEMORIES, add_memories, make_agent
+
+
+def _int_question(count):
+    return {"question": f"Q{count}", "response-type": "int",
+            "response-scale": [0, 10]}
+
+
+def _open_question(count, char_limit):
+    return {"question": f"Q{count}", "response-type": "open",
+            "response-char-limit": char_limit}
+
+
+def test_estimate_answer_tokens_by_type():
+    assert estimate_answer_tokens(_int_question(0)) == ASK_ANSWER_TOKENS + 4
+    assert estimate_answer_tokens(_open_question(0, 400)) == \
+        ASK_ANSWER_TOKENS + 100
+    assert estimate_answer_tokens(
+        {"question": "Q", "response-type": "open"}) == ASK_ANSWER_TOKENS + 50
+    short = {"question": "Q", "response-type": "categorical",
+             "response-options": ["Yes", "No"]}
+    long = dict(short, **{"response-options": ["Yes", "No " * 40]})
+    assert estimate_answer_tokens(short) < estimate_answer_tokens(long)
+
+
+def test_chunk_questions_empty():
+    assert chunk_questions([]) == []
+
+
+def test_chunk_questions_by_size():
+    questions = [_int_question(count) for count in range(7)]
+    assert chunk_questions(questions, max_chunk_size=3,
+                           token_budget=10000) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_chunk_questions_by_token_budget():
+    questions = [_int_question(count) for count in range(5)]
+    tokens = estimate_answer_tokens(questions[0])
+    assert chunk_questions(questions, max_chunk_size=100,
+                           token_budget=2 * tokens) == [[0, 1], [2, 3], [4]]
+
+
+def test_chunk_questions_keeps_order_and_every_question():
+    questions = [_int_question(0), _open_question(1, 4000), _int_question(2),
+                 _open_question(3, 400), _int_question(4)]
+    chunks = chunk_questions(questions, max_chunk_size=10, token_budget=300)
+    assert [index for chunk in chunks for index in chunk] == list(range(5))
+    for chunk in chunks:
+        tokens = sum(estimate_answer_tokens(questions[index])
+                     for index in chunk)
+        assert len(chunk) == 1 or tokens <= 300
+
+
+def test_chunk_questions_oversized_question_gets_its_own_chunk():
+    questions = [_int_question(0), _open_question(1, 8000), _int_question(2)]
+    assert chunk_questions(questions, max_chunk_size=10,
+                           token_budget=500) == [[0], [1], [2]]
+
+
+def test_numerical_answers_are_validated_not_truncated(monkeypatch):
+    def chat_safe_generate(prompt_input, prompt_lib_file, gpt_version,
+                           repeat, fail_safe, func_clean_up, verbose=False,
+                           **kwargs):
+        return (func_clean_up('{"Q1": {"Reasoning": "r", "Response": 3.7}}'),
+                "", prompt_input, fail_safe)
+
+    monkeypatch.setattr(interaction, "chat_safe_generate", chat_safe_generate)
+    questions = {"Q1": [0, 10]}
+    output = interaction.run_gpt_generate_numerical_resp(
+        "agent", questions, float_resp=False)[0]
+    assert output["responses"] == ["3.7"]
+    assert validate_numerical_resp(questions, output) is None
+    assert validate_numerical_resp(questions, output, float_resp=True) == {
+        "responses": [3.7], "reasonings": ["r"]}
+
+
+def _count_renders(monkeypatch):
+    renders = []
+    render = interaction._render_agent_desc
+
+    def counting_render(agent, anchor, token_budget=None):
+        renders.append(anchor)
+        return render(agent, anchor, token_budget)
+
+    monkeypatch.setattr(interaction, "_render_agent_desc", counting_render)
+    return renders
+
+
+def test_description_cache_is_invalidated_by_scratch_updates(monkeypatch):
+    renders = _count_renders(monkeypatch)
+    agent = make_agent()
+    description = _main_agent_desc(agent, "farm")
+    assert _main_agent_desc(agent, "farm") == description
+    assert len(renders) == 1
+
+    agent.update_scratch({"age": 41})
+    updated = _main_agent_desc(agent, "farm")
+    assert len(renders) == 2
+    assert "'age': 41" in updated and "'age': 40" not in updated
+    assert _main_agent_desc(agent, "farm") == updated
+    assert len(renders) == 2
+
+
+def test_description_cache_is_invalidated_by_new_memories(monkeypatch):
+    renders = _count_renders(monkeypatch)
+    agent = make_agent()
+    assert prepare_agent_descs(agent, ["farm", "election"]) == {
+        "farm": _main_agent_desc(agent, "farm"),
+        "election": _main_agent_desc(agent, "election")}
+    # prepare_agent_descs rendered both from one retrieval.
+    assert renders == []
+
+    add_memories(agent, ["I moved back to the farm last year."], time_step=2)
+    description = _main_agent_desc(agent, "farm")
+    assert renders == ["farm"]
+    assert "I moved back to the farm last year." in description
+    # Another agent's cache entries are its own.
+    other = make_agent()
+    assert "I moved back" not in _main_agent_desc(other, "farm")
+
+
+def test_budgeted_description_stays_within_the_token_budget():
+    memories = [f"{memory} It was day {count}."
+                for count in range(30) for memory in MEMORIES]
+    agent = make_agent(memories)
+    header_tokens = estimate_tokens(
+        f"Self description: {render_persona(agent.scratch)}\n==\n"
+        f"Other observations about the subject:\n\n")
+    full = _main_agent_desc(agent, "hospital")
+    for token_budget in [header_tokens, header_tokens + 15, 200, 800]:
+        description = _main_agent_desc(agent, "hospital", token_budget)
+        assert estimate_tokens(description) <= token_budget, token_budget
+        assert render_persona(agent.scratch) in description
+        # Budgeted descriptions keep a subset of the memories.
+        memories = description.split("subject:\n\n")[1].splitlines()
+        assert set(memories) <= set(full.splitlines())
+    assert description.count("\n") > 10
+    assert estimate_tokens(full) > 800
+
+
+def test_categorical_resp_samples_are_validated_and_retried(monkeypatch):
+    batches = [["Yes", "no.", "Maybe later", None], ["yes", "Perhaps"]]
+    requests = []
+
+    def gpt_request_samples(prompt, n, model="gpt-4o", max_tokens=1500,
+                            response_format=None):
+        requests.append((n, response_format["json_schema"]["name"]))
+        return [json.dumps({"1": {"Reasoning": "r", "Response": answer}})
+                if answer else "GENERATION ERROR: timeout"
+                for answer in batches[len(requests) - 1][:n]]
+
+    monkeypatch.setattr(interaction, "gpt_request_samples",
+                        gpt_request_samples)
+    questions = {"Do you vote?": ["Yes", "No"]}
+    with scheduler_run():
+        output = categorical_resp_samples(make_agent(), questions, 4,
+                                          structured=True, retries=1)
+        stats = response_stats.package()
+
+    # Only the two invalid samples are requested again, in one request.
+    assert requests == [(4, "categorical_resp"), (2, "categorical_resp")]
+    assert [sample and sample["responses"] for sample in output["samples"]] \
+        == [["Yes"], ["No"], ["Yes"], None]
+    assert output["distribution"] == {
+        "Do you vote?": {"Yes": 2 / 3, "No": 1 / 3}}
+    assert stats["responses"] == 6
+    assert stats["parse_failures"] == 1
+    assert stats["retries"] == 2
+
+    with pytest.raises(ValueError):
+        categorical_resp_samples(make_agent(), questions, 4, stream=True)
@@ -0,0 +1,128 @@
+from genagents_simulation.simulation_engine.llm_json_parser import (
+    FirstJSONObjectScanner,
+    extract_first_json_dict,
+    extract_first_json_dict_categorical,
+    extract_first_json_dict_numerical,
+)
+
+
+def _scan(chunks):
+    scanner = FirstJSONObjectScanner()
+    done = [scanner.feed(chunk) for chunk in chunks]
+    return scanner, done
+
+
+def test_scanner_skips_text_before_the_object():
+    scanner, done = _scan(['Sure! Here is the answer: {"a": 1} trailing'])
+    assert done == [True]
+    assert scanner.first_object() == '{"a": 1}'
+    assert scanner.first_dict() == {"a": 1}
+
+
+def test_scanner_ignores_braces_inside_strings():
+    text = '{"Reasoning": "a set {x} or }", "Response": "A"}'
+    scanner, done = _scan([text])
+    assert done == [True]
+    assert scanner.first_object() == text
+
+
+def test_scanner_handles_escaped_quotes_and_backslashes():
+    text = r'{"a": "say \"}\" now", "b": "c:\\", "d": "}"}'
+    scanner, _ = _scan([text + " more"])
+    assert scanner.first_object() == text
+    assert scanner.first_dict() == {"a": 'say "}" now', "b": "c:\\", "d": "}"}
+
+
+def test_scanner_handles_nested_objects():
+    text = '{"q1": {"Response": "A"}, "q2": {"Response": "B"}}'
+    scanner, _ = _scan([text, "{}"])
+    assert scanner.first_object() == text
+
+
+def test_scanner_completes_across_chunk_boundaries():
+    text = r'{"a": "x\"}", "b": {"c": 1}}'
+    # One character per chunk splits every escape and brace from its
+    # neighbours.
+    scanner, done = _scan(list("noise " + text))
+    assert done[-1] is True
+    assert done.index(True) == len(done) - 1
+    assert scanner.first_object() == text
+
+
+def test_scanner_escape_split_across_chunks():
+    scanner, done = _scan(['{"a": "x\\', '"}"', "}"])
+    assert done == [False, False, True]
+    assert scanner.first_dict() == {"a": 'x"}'}
+
+
+def test_scanner_is_incomplete_until_the_object_closes():
+    scanner, done = _scan(['text {"a": {"b": 1}', ", "])
+    assert done == [False, False]
+    assert scanner.first_object() is None
+    assert scanner.first_dict() is None
+    assert scanner.text() == 'text {"a": {"b": 1}, '
+
+
+def test_scanner_without_an_object():
+    scanner, done = _scan(["no json here", " at all }"])
+    assert done == [False, False]
+    assert scanner.first_object() is None
+
+
+def test_scanner_stops_after_the_first_object():
+    scanner, done = _scan(['{"a": 1}', '{"b": 2}'])
+    assert done == [True, True]
+    assert scanner.first_dict() == {"a": 1}
+
+
+def test_extract_ignores_surrounding_text():
+    text = 'Here you go:\n```json\n{"a": [1, 2], "b": "c"}\n```\nThanks'
+    assert extract_first_json_dict(text) == {"a": [1, 2], "b": "c"}
+
+
+def test_extract_keeps_braces_inside_strings():
+    text = '{"Reasoning": "because }{ is odd", "Response": "A"} {"x": 1}'
+    assert extract_first_json_dict(text) == {
+        "Reasoning": "because }{ is odd", "Response": "A"}
+
+
+def test_extract_returns_only_the_first_object():
+    assert extract_first_json_dict('{"a": 1} and {"b": 2}') == {"a": 1}
+
+
+def test_extract_normalizes_curly_quotes_only_when_needed():
+    assert extract_first_json_dict('{\u201ca\u201d: \u201cb\u201d}') == {"a": "b"}
+    # Curly quotes inside a valid object are left as they are.
+    assert extract_first_json_dict('{"a": "\u201cquoted\u201d"}') == {
+        "a": "\u201cquoted\u201d"}
+
+
+def test_extract_invalid_or_missing_objects():
+    assert extract_first_json_dict("no object") is None
+    assert extract_first_json_dict("") is None
+    assert extract_first_json_dict('{"a": 1') is None
+    assert extract_first_json_dict("{'a': 1}") is None
+
+
+def test_extract_categorical_fields():
+    text = ('{"Q1": {"Reasoning": "r1", "Response": "Yes"}, '
+            '"Q2": {"Reasoning": "r2", "Response": 3}}')
+    assert extract_first_json_dict_categorical(text) == (
+        ["Yes", "3"], ["r1", "r2"])
+
+
+def test_extract_categorical_falls_back_on_single_quotes():
+    text = "{'Q1': {'Reasoning': 'r1', 'Response': 'No'}"
+    assert extract_first_json_dict_categorical(text) == (["No"], ["r1"])
+
+
+def test_extract_numerical_fields():
+    text = ('prefix {"Q1": {"Reasoning": "r", "Response": 4.5}, '
+            '"Q2": {"Reasoning": "s", "Response": " -2 "}}')
+    assert extract_first_json_dict_numerical(text) == (
+        ["4.5", "-2"], ["r", "s"])
+
+
+def test_extract_numerical_falls_back_on_the_number_pattern():
+    text = '{"Q1": {"Reasoning": "r", "Response": "7 out of 10"}}'
+    assert extract_first_json_dict_numerical(text) == (["7"], ["r"])
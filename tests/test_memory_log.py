@@ -0,0 +1,91 @@
+import os
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.genagents.modules.memory_log import (
+    append_memory_log,
+    atomic_write_json,
+    read_committed_log,
+)
+
+from tests.agent_helpers import (
+    add_memories,
+    agent_state,
+    assert_same_state,
+    make_agent,
+)
+
+
+def test_atomic_write_json_replaces_the_file(tmp_path):
+    file_name = str(tmp_path / "data.json")
+    atomic_write_json(file_name, {"a": 1})
+    atomic_write_json(file_name, {"a": 2})
+    with open(file_name) as json_file:
+        assert json_file.read() == '{"a": 2}'
+    assert os.listdir(tmp_path) == ["data.json"]
+
+
+def test_memory_log_entries_round_trip(tmp_path):
+    folder = str(tmp_path)
+    committed = append_memory_log(folder, [{"node_id": 0}], ["a", "b"],
+                                  [[1.0, 2.0], [3.0, 4.0]], {0: 3})
+    committed = append_memory_log(folder, [], [], [], {1: 4}, committed)
+    entries, log_bytes, vector_bytes = read_committed_log(folder)
+    assert (log_bytes, vector_bytes) == committed
+    assert [entry["nodes"] for entry, _ in entries] == [[{"node_id": 0}], []]
+    assert entries[0][0]["last_retrieved"] == {"0": 3}
+    assert entries[0][1].tolist() == [[1.0, 2.0], [3.0, 4.0]]
+    assert entries[1][1].shape == (0, 0)
+
+
+def test_memory_log_ignores_and_drops_an_unfinished_entry(tmp_path):
+    folder = str(tmp_path)
+    committed = append_memory_log(folder, [], ["a"], [[1.0, 2.0]], {})
+    # A crashed save: its vectors were written but its line was not
+    # finished.
+    with open(f"{folder}/log_vectors.f64", "ab") as vector_file:
+        vector_file.write(b"\0" * 16)
+    with open(f"{folder}/log.jsonl", "ab") as log_file:
+        log_file.write(b'{"nodes": [')
+    entries, log_bytes, vector_bytes = read_committed_log(folder)
+    assert len(entries) == 1 and (log_bytes, vector_bytes) == committed
+
+    append_memory_log(folder, [], ["b"], [[3.0, 4.0]], {})
+    entries = read_committed_log(folder)[0]
+    assert [entry["contents"] for entry, _ in entries] == [["a"], ["b"]]
+    assert entries[1][1].tolist() == [[3.0, 4.0]]
+
+
+def test_incremental_saves_append_to_the_log(tmp_path):
+    agent_folder = str(tmp_path / "agent")
+    agent = make_agent()
+    agent.save(agent_folder)
+    with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
+        nodes_json = json_file.read()
+
+    add_memories(agent, ["I adopted a dog named Biscuit."], time_step=2)
+    agent.memory_stream.retrieve(["farm"], time_step=3, n_count=2,
+                                 stateless=False)
+    agent.update_scratch({"age": 41})
+    agent.save(agent_folder)
+
+    # The full files are kept and the changes are only appended.
+    with open(f"{agent_folder}/memory_stream/nodes.json") as json_file:
+        assert json_file.read() == nodes_json
+    entries = read_committed_log(f"{agent_folder}/memory_stream")[0]
+    assert len(entries) == 1
+    assert entries[0][0]["contents"] == ["I adopted a dog named Biscuit."]
+    assert entries[0][0]["last_retrieved"]
+
+    assert_same_state(GenerativeAgent(agent_folder), agent_state(agent))
+
+
+def test_compacting_save_drops_the_log(tmp_path):
+    agent_folder = str(tmp_path / "agent")
+    agent = make_agent()
+    agent.save(agent_folder)
+    add_memories(agent, ["I adopted a dog named Biscuit."], time_step=2)
+    agent.save(agent_folder)
+    agent.save(agent_folder, compact=True)
+
+    assert not os.path.exists(f"{agent_folder}/memory_stream/log.jsonl")
+    assert_same_state(GenerativeAgent(agent_folder), agent_state(agent))
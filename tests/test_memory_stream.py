@@ -0,0 +1,37 @@
+from genagents_simulation.genagents.modules import memory_stream
+
+from tests.agent_helpers import make_agent
+
+
+class CountingProvider:
+    """
+    Wraps an embedding provider and records the texts of every embed call.
+    """
+    def __init__(self, provider):
+        self.provider = provider
+        self.name = provider.name
+        self.calls = []
+
+    def embed(self, texts):
+        self.calls += [list(texts)]
+        return self.provider.embed(texts)
+
+
+def test_reflect_embeds_its_reflections_in_one_call(monkeypatch):
+    reflections = ["I care about my community.",
+                   "Family matters a lot to me.",
+                   "I value steady work."]
+    monkeypatch.setattr(memory_stream, "generate_reflection",
+                        lambda records, anchor, count: list(reflections))
+    monkeypatch.setattr(memory_stream, "generate_importance_score",
+                        lambda records: [7] * len(records))
+    agent = make_agent()
+    stream = agent.memory_stream
+    provider = CountingProvider(stream.embedding_provider)
+    stream.embedding_provider = provider
+
+    assert stream.reflect("values", time_step=2) == reflections
+    # One call embeds the anchor for retrieval, and one call all the
+    # reflections.
+    assert provider.calls == [["values"], reflections]
+    assert stream.count_nodes("reflection") == len(reflections)
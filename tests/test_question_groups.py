@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+from genagents_simulation.genagents.modules import interaction
+from genagents_simulation.genagents.modules.response_validation import (
+    response_stats,
+)
+from genagents_simulation.genagents.question_groups import (
+    run_question_groups,
+)
+from genagents_simulation.simulation_engine.gpt_structure import (
+    scheduler_run,
+)
+
+from tests.agent_helpers import make_agent
+
+
+GROUPS = [{"type": "categorical",
+           "questions": {"Do you vote?": ["Yes", "No"]}},
+          {"type": "numerical",
+           "questions": {"How hopeful are you?": [0, 10]}}]
+
+ANSWERS = {"categorical_resp": {"Do you vote?": "Yes"},
+           "numerical_resp": {"How hopeful are you?": 7}}
+
+
+def _chat_safe_generate(prompt_input, prompt_lib_file, gpt_version, repeat,
+                        fail_safe, func_clean_up, verbose=False, **kwargs):
+    # Requests with Bob's description fail; the others answer by type.
+    if "Bob" in prompt_input[0]:
+        raise RuntimeError("connection reset")
+    answers = next(answers for kind, answers in ANSWERS.items()
+                   if f"/{kind}/" in prompt_lib_file)
+    text = json.dumps({question: {"Reasoning": "r", "Response": answer}
+                       for question, answer in answers.items()})
+    return func_clean_up(text), "", prompt_input, fail_safe
+
+
+@pytest.fixture
+def agents(monkeypatch):
+    monkeypatch.setattr(interaction, "chat_safe_generate",
+                        _chat_safe_generate)
+    agents = [make_agent(first_name=name) for name in ["Ada", "Bob", "Carl"]]
+    for agent in agents:
+        stream = agent.memory_stream
+        stream.retrieve_calls = []
+
+        def retrieve(focal_points, *args, stream=stream,
+                     retrieve=stream.retrieve, **kwargs):
+            stream.retrieve_calls += [list(focal_points)]
+            return retrieve(focal_points, *args, **kwargs)
+
+        stream.retrieve = retrieve
+    return agents
+
+
+def test_one_retrieval_per_agent_covers_every_group(agents):
+    with scheduler_run():
+        results = run_question_groups(agents, GROUPS, max_workers=4)
+        stats = response_stats.package()
+
+    anchors = ["Do you vote?", "How hopeful are you?"]
+    for agent in agents:
+        assert agent.memory_stream.retrieve_calls == [anchors]
+    assert results[0] == [{"responses": ["Yes"], "reasonings": ["r"]}, None,
+                          {"responses": ["Yes"], "reasonings": ["r"]}]
+    assert results[1] == [{"responses": [7], "reasonings": ["r"]}, None,
+                          {"responses": [7], "reasonings": ["r"]}]
+    # Bob's failed requests are counted, and leave the other agents'
+    # results in place.
+    assert stats["request_errors"] == 2
+    assert stats["retrieval_errors"] == 0
+
+
+def test_failed_retrieval_is_counted(agents):
+    def retrieve(*args, **kwargs):
+        raise RuntimeError("embedding service unavailable")
+
+    agents[0].memory_stream.retrieve = retrieve
+    responses = []
+    with scheduler_run():
+        results = run_question_groups(
+            agents, GROUPS,
+            on_response=lambda *response: responses.append(response[:2]))
+        stats = response_stats.package()
+
+    # Ada's requests render their descriptions themselves, and fail again.
+    assert [row[0] for row in results] == [None, None]
+    assert [row[2] for row in results] == [
+        {"responses": ["Yes"], "reasonings": ["r"]},
+        {"responses": [7], "reasonings": ["r"]}]
+    assert sorted(responses) == [(0, 2), (1, 2)]
+    assert stats["retrieval_errors"] == 1
+    assert stats["request_errors"] == 4
+
+
+def test_structured_responses_are_validated(monkeypatch):
+    formats = []
+
+    def chat_safe_generate(prompt_input, prompt_lib_file, gpt_version,
+                           repeat, fail_safe, func_clean_up, verbose=False,
+                           response_format=None, **kwargs):
+        formats.append(response_format["json_schema"]["name"])
+        # Structured output in the schema's shape, whose numerical answer
+        # is out of range.
+        if "/categorical_resp/" in prompt_lib_file:
+            entry = {"Q": "Do you vote?", "Reasoning": "r",
+                     "Response": "yes."}
+        else:
+            entry = {"Q": "How hopeful are you?", "Reasoning": "r",
+                     "Response": 12}
+        return (func_clean_up(json.dumps({"1": entry})), "", prompt_input,
+                fail_safe)
+
+    monkeypatch.setattr(interaction, "chat_safe_generate", chat_safe_generate)
+    with scheduler_run():
+        results = run_question_groups([make_agent()], GROUPS,
+                                      structured=True, retries=1)
+        stats = response_stats.package()
+
+    # Both go through the validators: the option is snapped, and the
+    # answer out of range is asked again and then rejected.
+    assert results == [[{"responses": ["Yes"], "reasonings": ["r"]}], [None]]
+    assert sorted(formats) == ["categorical_resp", "numerical_resp",
+                               "numerical_resp"]
+    assert stats["retries"] == 1
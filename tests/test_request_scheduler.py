@@ -0,0 +1,116 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from genagents_simulation.simulation_engine.gpt_structure import (
+    RequestScheduler,
+    _current_run,
+    in_current_run,
+    request_scheduler,
+    scheduler_run,
+)
+
+
+HOLDER = ("holder", 1.0, "interactive")
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def _service_order(runs):
+    """
+    Queues one request per run of <runs>, in order, behind a request that
+    holds the only slot, then releases it. Returns the run ids in the order
+    their requests were served.
+    """
+    scheduler = RequestScheduler(1)
+    scheduler.acquire(HOLDER)
+    order = []
+
+    def _request(run):
+        scheduler.acquire(run)
+        order.append(run[0])
+        scheduler.release(run)
+
+    threads = []
+    for count, run in enumerate(runs):
+        thread = threading.Thread(target=_request, args=(run,))
+        thread.start()
+        threads += [thread]
+        # Every request is queued before the next one arrives.
+        _wait_for(lambda: len(scheduler.queue) == count + 1)
+    scheduler.release(HOLDER)
+    for thread in threads:
+        thread.join(5)
+    return order
+
+
+def test_equal_weights_interleave_runs():
+    runs = [("A", 1.0, "interactive")] * 6 + [("B", 1.0, "interactive")] * 2
+    assert _service_order(runs) == ["A", "B", "A", "B", "A", "A", "A", "A"]
+
+
+def test_weights_share_slots_in_proportion():
+    runs = [("A", 1.0, "interactive")] * 4 + [("B", 2.0, "interactive")] * 6
+    assert _service_order(runs) == ["B", "A", "B", "B", "A", "B", "B", "A",
+                                    "B", "A"]
+
+
+def test_interactive_requests_go_before_batch_requests():
+    runs = [("C", 1.0, "batch")] * 3 + [("D", 1.0, "interactive")] * 2
+    assert _service_order(runs) == ["D", "D", "C", "C", "C"]
+
+
+def test_concurrency_cap_and_its_increase():
+    scheduler = RequestScheduler(1)
+    run = ("A", 1.0, "interactive")
+    scheduler.acquire(run)
+    thread = threading.Thread(target=scheduler.acquire, args=(run,))
+    thread.start()
+    _wait_for(lambda: len(scheduler.queue) == 1)
+    assert scheduler.active == 1
+    scheduler.set_max_concurrency(2)
+    thread.join(5)
+    assert scheduler.active == 2 and not scheduler.queue
+    package = scheduler.package("A")
+    assert package["requests"] == 2
+    assert package["run"]["requests"] == 2
+    assert package["run"]["queue_depth"] == 0
+
+
+def test_unregister_forgets_only_idle_runs():
+    scheduler = RequestScheduler(2)
+    run = ("A", 1.0, "interactive")
+    scheduler.register("A")
+    scheduler.acquire(run)
+    assert scheduler.unregister("A") is False
+    scheduler.release(run)
+    scheduler.register("A")
+    assert scheduler.unregister("A") is True
+    assert "A" not in scheduler.runs and "A" not in scheduler.last_tags
+
+
+def test_scheduler_run_is_carried_to_worker_threads():
+    with scheduler_run("job", weight=2, priority="batch") as run_id:
+        assert run_id == "job"
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            runs = list(executor.map(
+                in_current_run(lambda _: _current_run.get()), range(2)))
+    assert runs == [("job", 2.0, "batch")] * 2
+    assert _current_run.get()[0] == "default"
+    assert "job" not in request_scheduler.runs
+
+
+def test_scheduler_run_rejects_invalid_runs():
+    with pytest.raises(ValueError):
+        with scheduler_run(priority="urgent"):
+            pass
+    with pytest.raises(ValueError):
+        with scheduler_run(weight=0):
+            pass
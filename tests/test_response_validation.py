@@ -0,0 +1,214 @@
+from genagents_simulation.genagents.modules.response_validation import (
+    OptionSnapper,
+    categorical_resp_schema,
+    get_option_snapper,
+    json_schema_response_format,
+    numerical_resp_schema,
+    parse_numerical_range,
+    validate_answer,
+    validate_categorical_resp,
+    validate_numerical_resp,
+)
+
+
+LIKERT = ["Strongly disagree", "Disagree", "Neutral", "Agree",
+          "Strongly agree"]
+
+
+def _conforms(schema, value):
+    """
+    Checks <value> against the subset of JSON schema the response schemas
+    use.
+    """
+    if schema["type"] == "object":
+        return (isinstance(value, dict)
+                and set(value) == set(schema["properties"])
+                and all(_conforms(schema["properties"][key], value[key])
+                        for key in value))
+    if schema["type"] == "string":
+        return isinstance(value, str) and value in schema.get("enum", [value])
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    return ((schema["type"] == "number" or isinstance(value, int))
+            and schema.get("minimum", value) <= value
+            and value <= schema.get("maximum", value))
+
+
+def test_snap_exact_and_normalized_options():
+    snapper = OptionSnapper(["Yes", "No"])
+    assert snapper.snap("Yes") == "Yes"
+    assert snapper.snap("  yes. ") == "Yes"
+    assert snapper.snap('"NO"') == "No"
+
+
+def test_snap_response_containing_one_option():
+    snapper = OptionSnapper(["Yes", "No"])
+    assert snapper.snap("Yes, definitely") == "Yes"
+
+
+def test_snap_prefers_the_longest_contained_option():
+    snapper = OptionSnapper(LIKERT)
+    assert snapper.snap("I strongly agree") == "Strongly agree"
+    assert snapper.snap("I agree") == "Agree"
+
+
+def test_snap_fuzzy_match_of_a_misspelling():
+    snapper = OptionSnapper(LIKERT)
+    assert snapper.snap("Strongly dissagree") == "Strongly disagree"
+
+
+def test_snap_rejects_ambiguous_and_unrelated_responses():
+    snapper = OptionSnapper(["Yes", "No"])
+    assert snapper.snap("Yes and no") is None
+    assert snapper.snap("Maybe") is None
+    # The miss is cached as well.
+    assert snapper.table["maybe"] is None
+
+
+def test_snap_non_string_options():
+    snapper = OptionSnapper([1, 2, 3])
+    assert snapper.snap("2") == 2
+    assert snapper.snap("4") is None
+
+
+def test_snap_rejects_malformed_answers():
+    snapper = OptionSnapper(["Yes", "No"])
+    for answer in [["Yes"], {"Response": "Yes"}, None]:
+        assert snapper.snap(answer) is None
+    assert validate_categorical_resp(
+        {"Q1": ["Yes", "No"]},
+        {"responses": [["Yes"]], "reasonings": [""]}) is None
+    assert validate_answer({"question": "Q1", "response-type": "categorical",
+                            "response-options": ["Yes", "No"]},
+                           {"Response": "Yes"}) is None
+
+
+def test_get_option_snapper_is_cached_per_option_list():
+    assert get_option_snapper(["Yes", "No"]) is \
+        get_option_snapper(("Yes", "No"))
+    assert get_option_snapper(["Yes", "No"]) is not \
+        get_option_snapper(["No", "Yes"])
+
+
+def test_validate_categorical_resp():
+    questions = {"Q1": ["Yes", "No"], "Q2": LIKERT}
+    response = {"responses": ["yes.", "strongly agree"],
+                "reasonings": ["r1", "r2"]}
+    assert validate_categorical_resp(questions, response) == {
+        "responses": ["Yes", "Strongly agree"], "reasonings": ["r1", "r2"]}
+    assert validate_categorical_resp(
+        questions, {"responses": ["Yes"], "reasonings": ["r1"]}) is None
+    assert validate_categorical_resp(
+        questions, {"responses": ["Yes", "Perhaps"],
+                    "reasonings": ["r1", "r2"]}) is None
+    assert validate_categorical_resp(questions, None) is None
+
+
+def test_parse_numerical_range():
+    assert parse_numerical_range([0, 10]) == (0.0, 10.0)
+    assert parse_numerical_range((5, 1)) == (1.0, 5.0)
+    assert parse_numerical_range("1-5") == (1.0, 5.0)
+    assert parse_numerical_range("1 to 5") == (1.0, 5.0)
+    assert parse_numerical_range("-10 - 10") == (-10.0, 10.0)
+    assert parse_numerical_range("0.5-2.5") == (0.5, 2.5)
+    assert parse_numerical_range("any number") is None
+    assert parse_numerical_range(["a", "b"]) is None
+
+
+def test_validate_numerical_resp_integers():
+    questions = {"Q1": [0, 10], "Q2": "1-5"}
+    response = {"responses": ["7", 3.0], "reasonings": ["r1", "r2"]}
+    validated = validate_numerical_resp(questions, response)
+    assert validated == {"responses": [7, 3], "reasonings": ["r1", "r2"]}
+    assert all(isinstance(value, int) for value in validated["responses"])
+
+
+def test_validate_numerical_resp_rejects_invalid_answers():
+    questions = {"Q1": [0, 10]}
+    for answer in ["7.5", "11", "-1", "seven", None, "nan", "inf"]:
+        response = {"responses": [answer], "reasonings": [""]}
+        assert validate_numerical_resp(questions, response) is None, answer
+    assert validate_numerical_resp(
+        questions, {"responses": [], "reasonings": []}) is None
+    assert validate_numerical_resp(questions, None) is None
+
+
+def test_validate_numerical_resp_floats():
+    questions = {"Q1": [0, 1]}
+    response = {"responses": ["0.25"], "reasonings": [""]}
+    assert validate_numerical_resp(questions, response, float_resp=True) == {
+        "responses": [0.25], "reasonings": [""]}
+    assert validate_numerical_resp(questions, response) is None
+
+
+def test_validate_numerical_resp_without_a_known_range():
+    questions = {"Q1": "any number"}
+    response = {"responses": ["1000"], "reasonings": [""]}
+    assert validate_numerical_resp(questions, response) == {
+        "responses": [1000], "reasonings": [""]}
+
+
+def _categorical_entry(question, options, response):
+    per_option = {str(option): "" for option in options}
+    return {"Q": question, "Option Interpretation": per_option,
+            "Option Choice": per_option, "Reasoning": "",
+            "Response": response}
+
+
+def _numerical_entry(question, response):
+    return {"Q": question, "Range Interpretation": "", "Reasoning": "",
+            "Response": response}
+
+
+def test_categorical_resp_schema_matches_the_questions():
+    questions = {"Q1": ["Yes", "No"], "Q2": [1, 2, 3]}
+    schema = categorical_resp_schema(questions)
+    assert schema["required"] == ["1", "2"]
+    assert schema["additionalProperties"] is False
+    assert [schema["properties"][key]["properties"]["Response"]["enum"]
+            for key in ["1", "2"]] == [["Yes", "No"], ["1", "2", "3"]]
+
+    answer = {"1": _categorical_entry("Q1", ["Yes", "No"], "No"),
+              "2": _categorical_entry("Q2", [1, 2, 3], "3")}
+    assert _conforms(schema, answer)
+    for response in ["no", "Maybe", 3]:
+        answer["2"]["Response"] = response
+        assert not _conforms(schema, answer)
+    del answer["2"]
+    assert not _conforms(schema, answer)
+    # Every answer the schema allows is validated to its option.
+    assert validate_categorical_resp(
+        questions, {"responses": ["No", "3"], "reasonings": ["", ""]}) == {
+            "responses": ["No", 3], "reasonings": ["", ""]}
+
+    assert json_schema_response_format("categorical_resp", schema) == {
+        "type": "json_schema",
+        "json_schema": {"name": "categorical_resp", "schema": schema,
+                        "strict": True}}
+
+
+def test_numerical_resp_schema_matches_the_questions():
+    questions = {"Q1": [0, 10], "Q2": "0.5-2.5", "Q3": "any number"}
+    schema = numerical_resp_schema(questions)
+    responses = [schema["properties"][key]["properties"]["Response"]
+                 for key in ["1", "2", "3"]]
+    # Integer bounds are rounded inwards.
+    assert responses == [{"type": "integer", "minimum": 0, "maximum": 10},
+                         {"type": "integer", "minimum": 1, "maximum": 2},
+                         {"type": "integer"}]
+    assert numerical_resp_schema(questions, float_resp=True)["properties"][
+        "2"]["properties"]["Response"] == {
+            "type": "number", "minimum": 0.5, "maximum": 2.5}
+
+    for answers, conforms in [([10, 1, -5], True), ([11, 1, 0], False),
+                              ([5, 0, 0], False), ([5.5, 1, 0], False),
+                              (["5", 1, 0], False)]:
+        answer = {str(count + 1): _numerical_entry(question, response)
+                  for count, (question, response)
+                  in enumerate(zip(questions, answers))}
+        assert _conforms(schema, answer) == conforms, answers
+        # Every answer the schema allows also passes the validator.
+        if conforms:
+            assert validate_numerical_resp(
+                questions, {"responses": answers,
+                            "reasonings": [""] * 3}) is not None
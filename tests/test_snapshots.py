@@ -0,0 +1,113 @@
+import os
+import shutil
+
+import pytest
+
+from genagents_simulation.genagents.genagents import GenerativeAgent
+from genagents_simulation.genagents.snapshots import (
+    diff_snapshots,
+    get_snapshot_folder,
+    list_snapshots,
+    read_chunk,
+    restore_snapshot,
+    snapshot_population,
+    write_chunk,
+)
+
+from tests.agent_helpers import (
+    MEMORIES,
+    add_memories,
+    agent_state,
+    assert_same_state,
+    make_agent,
+)
+
+
+def _read_tree(population_folder):
+    """
+    Returns the bytes of every file of a population, by relative path,
+    without its snapshots.
+    """
+    tree = dict()
+    for root, dirs, files in os.walk(population_folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            with open(path, "rb") as data_file:
+                tree[os.path.relpath(path, population_folder)] = \
+                    data_file.read()
+    return tree
+
+
+def _population(tmp_path):
+    population_folder = str(tmp_path / "population")
+    agents = {"ada": make_agent(MEMORIES),
+              "bob": make_agent(MEMORIES[:2], "Bob")}
+    for name, agent in agents.items():
+        agent.save(f"{population_folder}/{name}")
+    with open(f"{population_folder}/population.json", "w") as json_file:
+        json_file.write('{"embedding_model": "local/hashing-64"}')
+    return population_folder, agents
+
+
+def test_chunks_are_content_addressed(tmp_path):
+    snapshot_folder = str(tmp_path)
+    chunk_hash = write_chunk(snapshot_folder, b"memory")
+    assert write_chunk(snapshot_folder, b"memory") == chunk_hash
+    assert read_chunk(snapshot_folder, chunk_hash) == b"memory"
+    assert len(os.listdir(f"{snapshot_folder}/chunks")) == 1
+
+
+def test_restore_round_trips_a_population(tmp_path):
+    population_folder, agents = _population(tmp_path)
+    states = {name: agent_state(agent) for name, agent in agents.items()}
+    tree = _read_tree(population_folder)
+    snapshot_id = snapshot_population(population_folder, "baseline")
+
+    # Changing one agent, deleting another and adding a third.
+    ada = GenerativeAgent(f"{population_folder}/ada")
+    add_memories(ada, ["I adopted a dog named Biscuit."], time_step=2)
+    ada.save(f"{population_folder}/ada")
+    shutil.rmtree(f"{population_folder}/bob")
+    make_agent(["I fix bicycles."], "Carl").save(f"{population_folder}/carl")
+
+    assert diff_snapshots(population_folder, snapshot_id)["agents"] == {
+        "added": ["carl"], "removed": ["bob"], "changed": ["ada"]}
+
+    restore_snapshot(population_folder, snapshot_id)
+    assert _read_tree(population_folder) == tree
+    assert diff_snapshots(population_folder, snapshot_id)["agents"] == {
+        "added": [], "removed": [], "changed": []}
+    for name, state in states.items():
+        assert_same_state(GenerativeAgent(f"{population_folder}/{name}"),
+                          state)
+
+
+def test_snapshots_share_unchanged_chunks(tmp_path):
+    population_folder, _ = _population(tmp_path)
+    first_id = snapshot_population(population_folder, "first")
+    chunk_folder = f"{get_snapshot_folder(population_folder)}/chunks"
+    n_chunks = sum(len(files) for _, _, files in os.walk(chunk_folder))
+
+    ada = GenerativeAgent(f"{population_folder}/ada")
+    add_memories(ada, ["I adopted a dog named Biscuit."], time_step=2)
+    ada.save(f"{population_folder}/ada")
+    second_id = snapshot_population(population_folder, "second")
+
+    # Only ada's two new memory log files, her meta.json (which records
+    # the id of the loaded agent) and her file listing are stored again.
+    new_chunks = sum(len(files) for _, _, files in os.walk(chunk_folder))
+    assert new_chunks - n_chunks == 4
+    assert diff_snapshots(population_folder, first_id, second_id) == {
+        "agents": {"added": [], "removed": [], "changed": ["ada"]},
+        "files": {"added": [], "removed": [], "changed": []}}
+    assert {(snapshot["id"], snapshot["message"], snapshot["agents"])
+            for snapshot in list_snapshots(population_folder)} == {
+        (first_id, "first", 2), (second_id, "second", 2)}
+
+
+def test_unknown_snapshot(tmp_path):
+    population_folder, _ = _population(tmp_path)
+    assert list_snapshots(population_folder) == []
+    with pytest.raises(ValueError):
+        restore_snapshot(population_folder, "missing")
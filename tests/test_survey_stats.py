@@ -0,0 +1,141 @@
+import json
+import random
+import statistics
+
+import pytest
+
+from genagents_simulation.genagents.survey_stats import (
+    Histogram,
+    NumericalQuestionStats,
+    QuantileSketch,
+    RunningStats,
+    merge_numerical_summaries,
+)
+
+
+def _values(n=1000, seed=0):
+    rng = random.Random(seed)
+    return [rng.gauss(3.0, 2.0) for _ in range(n)]
+
+
+def _shards(values, n_shards=4, seed=1):
+    rng = random.Random(seed)
+    shards = [[] for _ in range(n_shards)]
+    for value in values:
+        shards[rng.randrange(n_shards)] += [value]
+    return shards
+
+
+def _merged(cls, shards, *args):
+    merged = cls(*args)
+    for shard in shards:
+        part = cls(*args)
+        for value in shard:
+            part.add(value)
+        merged.merge(part)
+    return merged
+
+
+def test_running_stats_matches_statistics():
+    values = _values()
+    stats = RunningStats()
+    for value in values:
+        stats.add(value)
+    assert stats.count == len(values)
+    assert stats.mean == pytest.approx(statistics.fmean(values))
+    assert stats.variance() == pytest.approx(statistics.variance(values))
+    assert (stats.min, stats.max) == (min(values), max(values))
+
+
+def test_running_stats_merge_equals_single_pass():
+    values = _values()
+    single = RunningStats()
+    for value in values:
+        single.add(value)
+    merged = _merged(RunningStats, _shards(values) + [[]])
+    assert merged.count == single.count
+    assert merged.mean == pytest.approx(single.mean)
+    assert merged.variance() == pytest.approx(single.variance())
+    assert (merged.min, merged.max) == (single.min, single.max)
+
+
+def test_running_stats_small_counts():
+    stats = RunningStats()
+    assert stats.variance() is None
+    stats.add(5)
+    assert stats.variance() is None
+    assert RunningStats.from_package(
+        json.loads(json.dumps(stats.package()))).package() == stats.package()
+
+
+def test_quantile_sketch_merge_equals_single_pass():
+    values = _values() + [0.0] * 10
+    single = QuantileSketch()
+    for value in values:
+        single.add(value)
+    merged = _merged(QuantileSketch, _shards(values), 0.01)
+    assert merged.count == single.count
+    assert merged.zeros == single.zeros
+    assert merged.positive == single.positive
+    assert merged.negative == single.negative
+    for q in [0, 0.05, 0.25, 0.5, 0.75, 0.95, 1]:
+        assert merged.quantile(q) == single.quantile(q)
+
+
+def test_quantile_sketch_relative_accuracy():
+    values = sorted(abs(value) + 0.1 for value in _values())
+    sketch = QuantileSketch(alpha=0.01)
+    for value in values:
+        sketch.add(value)
+    for q in [0.05, 0.5, 0.95]:
+        exact = values[int(q * (len(values) - 1))]
+        assert sketch.quantile(q) == pytest.approx(exact, rel=0.01)
+
+
+def test_quantile_sketch_negative_values_and_package():
+    sketch = QuantileSketch()
+    for value in [-4, -2, 0, 2, 4]:
+        sketch.add(value)
+    assert sketch.quantile(0) == pytest.approx(-4, rel=0.01)
+    assert sketch.quantile(0.5) == 0.0
+    assert sketch.quantile(1) == pytest.approx(4, rel=0.01)
+    restored = QuantileSketch.from_package(
+        json.loads(json.dumps(sketch.package())))
+    assert restored.quantile(0.25) == sketch.quantile(0.25)
+    assert QuantileSketch().quantile(0.5) is None
+
+
+def test_quantile_sketch_rejects_different_accuracies():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_histogram_bins_and_merge():
+    histogram = Histogram(1, 5)
+    assert histogram.bins() == ["1", "2", "3", "4", "5"]
+    for value in [1, 3, 3, 7, -2]:
+        histogram.add(value)
+    assert histogram.counts == [2, 0, 2, 0, 1]
+    with pytest.raises(ValueError):
+        histogram.merge(Histogram(0, 5))
+
+
+def test_numerical_summaries_merge_equals_single_pass():
+    rng = random.Random(2)
+    values = [rng.randint(0, 10) for _ in range(500)]
+    single = NumericalQuestionStats([0, 10])
+    for value in values:
+        single.add(value)
+    packages = []
+    for shard in _shards(values):
+        stats = NumericalQuestionStats([0, 10])
+        for value in shard:
+            stats.add(value)
+        packages += [{"Q": json.loads(json.dumps(stats.package()))}]
+    merged = merge_numerical_summaries(packages)["Q"]
+    summary, expected = merged.summary(), single.summary()
+    assert summary["mean"] == pytest.approx(expected.pop("mean"))
+    assert summary["variance"] == pytest.approx(expected.pop("variance"))
+    assert summary["std"] == pytest.approx(expected.pop("std"))
+    for key, value in expected.items():
+        assert summary[key] == value, key